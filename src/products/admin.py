@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from products.models import Section, Product, Shop, Currency, Price
+from products.models import (
+    Section, Product, Shop, Currency, Price, ExchangeRate)
 
 
 admin.site.register(Section)
@@ -8,3 +9,4 @@ admin.site.register(Product)
 admin.site.register(Shop)
 admin.site.register(Currency)
 admin.site.register(Price)
+admin.site.register(ExchangeRate)
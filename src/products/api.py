@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+from decimal import Decimal, InvalidOperation
+
+from django.utils import timezone
+
+from shiny_ninja.api import json_response, json_error, parse_ids
+from products.models import Shop, Product, Currency, Price
+from products import basket as baskets
+
+
+# Most products whose prices one request may ask for.
+MAX_PRODUCTS = 1000
+
+
+def shops(request):
+
+    return json_response(
+        request,
+        {'results': list(
+            Shop.objects.order_by('name').values(
+                'id', 'name', 'description'))})
+
+
+def products(request):
+
+    found = Product.objects.order_by('name')
+
+    if request.GET.get('section', '').isdigit():
+
+        found = found.filter(section=request.GET['section'])
+
+    return json_response(
+        request,
+        {'results': list(
+            found.values('id', 'name', 'description', 'section'))})
+
+
+def prices(request):
+    """The prices in effect now of many products, at one shop or all.
+
+    Products are given as comma separated ids, and resolved with as few
+    queries as Price.objects.in_effect needs.
+    """
+
+    try:
+
+        product_ids = parse_ids(request.GET.get('products', ''))
+        shop = parse_ids(request.GET.get('shop', '')) or [None]
+
+    except ValueError:
+
+        return json_error(request, "Ids must be integers")
+
+    if not product_ids or len(product_ids) > MAX_PRODUCTS:
+
+        return json_error(
+            request, "Give between 1 and %d products" % MAX_PRODUCTS)
+
+    now = timezone.now()
+    codes = dict(Currency.objects.values_list('id', 'code'))
+
+    resolved = Price.objects.in_effect(
+        (product, shop[0], now) for product in product_ids)
+
+    return json_response(
+        request,
+        {'results': [
+            {'id': price.id,
+             'product': price.product_id,
+             'shop': price.shop_id,
+             'value': price.value,
+             'currency': codes[price.currency_id],
+             'available': price.available,
+             'since': price.since,
+             'valid_until': price.valid_until}
+            for in_effect in resolved for price in in_effect]})
+
+
+def basket(request):
+    """Where to buy a basket of items for the least money.
+
+    Items are given as comma separated product:quantity pairs, along
+    with a currency code and optionally the most shops to visit.
+    """
+
+    try:
+
+        items = [(int(product), Decimal(quantity))
+                 for product, quantity in
+                 (item.split(':') for item in
+                  request.GET.get('items', '').split(',') if item)]
+
+        max_shops = (int(request.GET['shops'])
+                     if request.GET.get('shops') else None)
+
+        currency = Currency.objects.get(code=request.GET.get('currency'))
+
+    except (ValueError, InvalidOperation, Currency.DoesNotExist):
+
+        return json_error(request, "Malformed basket")
+
+    if not items or len(items) > MAX_PRODUCTS:
+
+        return json_error(
+            request, "Give between 1 and %d items" % MAX_PRODUCTS)
+
+    plan = baskets.plan(items, currency, max_shops)
+
+    return json_response(
+        request,
+        {'total': plan.total,
+         'exact': plan.exact,
+         'missing': plan.missing,
+         'shops': [
+             {'shop': shop,
+              'items': [{'product': product,
+                         'quantity': quantity,
+                         'price': price.id,
+                         'value': price.value}
+                        for product, quantity, price in bought]}
+             for shop, bought in sorted(plan.shops.items())]})
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+from array import array
+from decimal import Decimal
+from itertools import combinations
+
+from django.utils import timezone
+
+from products.models import Price, _id_of
+
+
+# Most combinations of shops tried for an exact plan. Bigger problems
+# are solved greedily and improved by swapping shops.
+EXACT_COMBINATIONS = 5000
+
+# Cost of an item at a shop not selling it, big enough for any plan to
+# prefer buying more items over buying them cheaper.
+UNAVAILABLE = 10 ** 12
+
+# Costs are kept as doubles, which hold whole numbers of cents exactly up
+# to 2 ** 53, since Python 2 arrays have no 64 bit integer type and a
+# long may only have 32 bits.
+COST_TYPECODE = 'd'
+
+
+class PriceMatrix(object):
+    """The costs of a basket of items at every shop selling any of them.
+
+    Items are (product, quantity) pairs. costs holds an array per shop,
+    with the cost of every item in cents, or UNAVAILABLE. Only prices in
+    the given currency count. The prices in effect are read with
+    Price.objects.in_effect.
+    """
+
+    def __init__(self, items, currency, when=None):
+
+        self.items = [(_id_of(product), Decimal(quantity))
+                      for product, quantity in items]
+
+        when = when or timezone.now()
+        currency = _id_of(currency)
+
+        resolved = Price.objects.in_effect(
+            (product, None, when) for product, quantity in self.items)
+
+        self.shops = []
+        self.costs = []
+        self.prices = {}
+
+        rows = {}
+        for index, ((product, quantity), prices) in enumerate(
+                zip(self.items, resolved)):
+
+            for price in prices:
+
+                if not price.available or price.currency_id != currency:
+
+                    continue
+
+                if price.shop_id not in rows:
+
+                    rows[price.shop_id] = len(self.shops)
+                    self.shops.append(price.shop_id)
+                    self.costs.append(
+                        array(COST_TYPECODE, [UNAVAILABLE]) * len(self.items))
+
+                row = rows[price.shop_id]
+
+                self.costs[row][index] = int(
+                    (price.value * quantity * 100).to_integral_value())
+                self.prices[row, index] = price
+
+
+class BasketPlan(object):
+
+    def __init__(self, matrix, chosen, exact):
+
+        self.exact = exact
+        self.shops = {}
+        self.missing = []
+
+        cents = 0
+        for index, (product, quantity) in enumerate(matrix.items):
+
+            cost, row = min([(matrix.costs[row][index], row)
+                             for row in chosen] or [(UNAVAILABLE, None)])
+
+            if cost >= UNAVAILABLE:
+
+                self.missing.append(product)
+                continue
+
+            cents += int(cost)
+            self.shops.setdefault(matrix.shops[row], []).append(
+                (product, quantity, matrix.prices[row, index]))
+
+        self.total = Decimal(cents).scaleb(-2)
+
+
+def plan(items, currency, max_shops=None, when=None):
+    """Plans where to buy (product, quantity) items for the least money.
+
+    Returns a BasketPlan with the items to buy at each shop as
+    (product id, quantity, price), their total cost and the products no
+    shop sells in the currency. With max_shops, the plan visits at most
+    that many shops. Such plans are exact unless there are more than
+    EXACT_COMBINATIONS combinations of shops to try.
+    """
+
+    matrix = PriceMatrix(items, currency, when)
+    chosen, exact = choose_shops(matrix.costs, max_shops)
+
+    return BasketPlan(matrix, chosen, exact)
+
+
+def choose_shops(costs, max_shops=None):
+    """Chooses the rows of costs whose column minima sum up the least.
+
+    Returns the chosen row indexes and whether the choice is optimal.
+    """
+
+    shops = len(costs)
+
+    if max_shops is None or max_shops >= shops:
+
+        # Every shop can be visited, so every item is bought where it is
+        # cheapest.
+        return [row for row in range(shops)
+                if any(cost < UNAVAILABLE for cost in costs[row])], True
+
+    if max_shops < 1:
+
+        return [], True
+
+    # Visiting one more shop never costs more, so only combinations of
+    # exactly max_shops shops need to be tried.
+    if _binomial(shops, max_shops) <= EXACT_COMBINATIONS:
+
+        return list(min(
+            combinations(range(shops), max_shops),
+            key=lambda chosen: _total(costs, chosen))), True
+
+    return _improved(costs, _greedy(costs, max_shops)), False
+
+
+def _total(costs, chosen):
+
+    return sum(map(min, *[costs[row] for row in chosen])) \
+        if len(chosen) > 1 else sum(costs[chosen[0]])
+
+
+def _greedy(costs, max_shops):
+
+    best = [UNAVAILABLE] * len(costs[0])
+    chosen = []
+
+    for step in range(max_shops):
+
+        row = min(
+            (row for row in range(len(costs)) if row not in chosen),
+            key=lambda row: sum(map(min, best, costs[row])))
+
+        chosen.append(row)
+        best = map(min, best, costs[row])
+
+    return chosen
+
+
+def _improved(costs, chosen):
+
+    # Swap a chosen shop for another one while that lowers the total.
+    total = _total(costs, chosen)
+    improved = True
+    while improved:
+
+        improved = False
+
+        for position in range(len(chosen)):
+
+            for row in range(len(costs)):
+
+                if row in chosen:
+
+                    continue
+
+                swapped = chosen[:position] + [row] + chosen[position + 1:]
+                swapped_total = _total(costs, swapped)
+
+                if swapped_total < total:
+
+                    chosen, total, improved = swapped, swapped_total, True
+
+    return chosen
+
+
+def _binomial(n, k):
+
+    result = 1
+    for i in range(min(k, n - k)):
+
+        result = result * (n - i) // (i + 1)
+
+    return result
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import calendar
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+def _id_of(obj):
+
+    return getattr(obj, 'id', obj)
+
+
+class PriceCache(object):
+    """Process-local LRU cache of resolved prices.
+
+    Entries are keyed by (product, shop, time bucket) and only answer
+    for instants inside the validity window of the cached price, so two
+    lookups in one bucket on either side of a price change never share
+    an answer. The cache is disabled unless settings.PRICE_CACHE_SIZE is
+    positive.
+    """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_size(self):
+
+        return getattr(settings, 'PRICE_CACHE_SIZE', 0)
+
+    @property
+    def bucket_seconds(self):
+
+        return getattr(settings, 'PRICE_CACHE_BUCKET', 60)
+
+    def key(self, product, shop, day):
+
+        seconds = calendar.timegm(day.utctimetuple())
+
+        return (_id_of(product), _id_of(shop),
+                seconds // self.bucket_seconds)
+
+    def get(self, product, shop, day, resolve):
+        """Returns the price in effect, calling resolve() on a miss.
+
+        resolve() must return a Price carrying a valid_until attribute,
+        or None, which is never cached.
+        """
+
+        max_size = self.max_size
+
+        if max_size <= 0:
+
+            return resolve()
+
+        key = self.key(product, shop, day)
+
+        with self.lock:
+
+            price = self.entries.get(key)
+
+            if price is not None and price.since <= day and (
+                    price.valid_until is None or day < price.valid_until):
+
+                del self.entries[key]
+                self.entries[key] = price
+                self.hits += 1
+
+                return price
+
+            self.misses += 1
+
+        price = resolve()
+
+        if price is not None:
+
+            with self.lock:
+
+                self.entries.pop(key, None)
+                self.entries[key] = price
+
+                while len(self.entries) > max_size:
+
+                    self.entries.popitem(last=False)
+
+        return price
+
+    def invalidate(self, product, shop):
+
+        pair = (_id_of(product), _id_of(shop))
+
+        with self.lock:
+
+            for key in [key for key in self.entries if key[:2] == pair]:
+
+                del self.entries[key]
+
+    def clear(self):
+
+        with self.lock:
+
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+
+        with self.lock:
+
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self.entries),
+                    'max_size': self.max_size}
+
+
+price_cache = PriceCache()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+
+from products.models import Product, Shop, Currency, Price
+
+
+ROWS_PER_BATCH = 500
+
+COLUMNS = ('product', 'shop', 'currency', 'value')
+
+
+class PriceImport(object):
+    """Imports prices from CSV lines with product, shop, currency and
+    value columns.
+
+    Products and shops are looked up by name and currencies by code,
+    all through maps read once. The shop column may be left out when a
+    shop is given for every row. Rows are checked against the prices in
+    effect a batch at a time, those not changing anything are skipped
+    and the rest are appended in bulk.
+    """
+
+    def __init__(self, shop=None, batch_size=ROWS_PER_BATCH):
+
+        self.shop = shop
+        self.batch_size = batch_size
+
+        self.products = _names(Product.objects.values_list('name', 'id'))
+        self.shops = _names(Shop.objects.values_list('name', 'id'))
+        self.currencies = dict(Currency.objects.values_list('code', 'id'))
+
+        self.value_field = Price._meta.get_field('value')
+
+        self.read = 0
+        self.imported = 0
+        self.skipped = 0
+        self.errors = []
+        self.seconds = 0
+
+    def rows_per_second(self):
+
+        return self.read / self.seconds if self.seconds else 0
+
+    def run(self, lines):
+
+        started = time.time()
+
+        batch = []
+        for number, row in enumerate(csv.DictReader(lines), 2):
+
+            self.read += 1
+
+            try:
+
+                batch.append(self.parse(row))
+
+            except ValidationError as error:
+
+                self.errors.append((number, u'; '.join(error.messages)))
+                continue
+
+            if len(batch) == self.batch_size:
+
+                self.import_batch(batch)
+                batch = []
+
+        if batch:
+
+            self.import_batch(batch)
+
+        self.seconds = time.time() - started
+
+        return self
+
+    def parse(self, row):
+
+        def lookup(kind, ids, key):
+
+            key = (key or '').decode('utf-8').strip()
+
+            if key not in ids:
+
+                raise ValidationError(u"Unknown %s: %s" % (kind, key))
+
+            if ids[key] is None:
+
+                raise ValidationError(u"Ambiguous %s: %s" % (kind, key))
+
+            return ids[key]
+
+        product = lookup('product', self.products, row.get('product'))
+
+        if self.shop is not None:
+
+            shop = self.shop.id
+
+        else:
+
+            shop = lookup('shop', self.shops, row.get('shop'))
+
+        currency = lookup('currency', self.currencies, row.get('currency'))
+
+        try:
+
+            value = Decimal((row.get('value') or '').strip().replace(',', '.'))
+
+        except InvalidOperation:
+
+            raise ValidationError(u"Not a price: %s" % row.get('value'))
+
+        field = self.value_field
+        value = field.clean(value, None)
+
+        if value.as_tuple().exponent < -field.decimal_places or \
+                abs(value) >= 10 ** (field.max_digits - field.decimal_places):
+
+            raise ValidationError(u"Not a price: %s" % value)
+
+        return product, shop, currency, value
+
+    def import_batch(self, batch):
+
+        now = timezone.now()
+
+        # The last row for a product and shop wins.
+        latest = {}
+        for product, shop, currency, value in batch:
+
+            latest[product, shop] = (currency, value)
+
+        pairs = list(latest)
+        in_effect = Price.objects.in_effect(
+            (product, shop, now) for product, shop in pairs)
+
+        prices = []
+        for (product, shop), current in zip(pairs, in_effect):
+
+            currency, value = latest[product, shop]
+
+            if current and current[0].available and (
+                    current[0].currency_id, current[0].value) == (
+                        currency, value):
+
+                continue
+
+            prices.append(
+                Price(product_id=product, shop_id=shop,
+                      currency_id=currency, value=value, since=now))
+
+        Price.objects.bulk_append(prices, self.batch_size)
+
+        self.imported += len(prices)
+        self.skipped += len(batch) - len(prices)
+
+
+def _names(pairs):
+
+    ids = {}
+    for name, object_id in pairs:
+
+        # Names shared by several rows map to None.
+        ids[name] = None if name in ids else object_id
+
+    return ids
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction, DatabaseError
+
+from products.models import Price
+
+
+class Command(NoArgsCommand):
+
+    help = ("Creates the price history indexes missing from databases "
+            "set up before they were declared.")
+
+    def handle_noargs(self, **options):
+
+        # syncdb never alters existing tables, so databases created
+        # before Price.Meta.index_together need the indexes added by hand.
+        statements = connection.creation.sql_indexes_for_model(
+            Price, no_style())
+
+        created = 0
+        for statement in statements:
+
+            try:
+
+                with transaction.atomic():
+
+                    connection.cursor().execute(statement)
+
+            except DatabaseError:
+
+                # The index is already there.
+                continue
+
+            created += 1
+
+        if connection.vendor == 'sqlite':
+
+            # Let the query planner know about the new indexes.
+            connection.cursor().execute(
+                "ANALYZE %s" % connection.ops.quote_name(
+                    Price._meta.db_table))
+
+        self.stdout.write(
+            "Created %d of %d price indexes." % (created, len(statements)))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import random
+from decimal import Decimal
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from products.models import Section, Shop, Currency, Product, Price
+from products import basket
+from shiny_ninja.benchmark import scratch_database, timings, percentile
+
+
+class Command(NoArgsCommand):
+
+    help = ("Measures basket planning for lists of 10 to 1000 items. Runs "
+            "against a scratch test database.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option(
+            '--sizes', default='10,100,1000',
+            help="Comma separated numbers of items in a basket."),
+        make_option(
+            '--shops', type='int', default=20,
+            help="Number of shops, each selling most of the products."),
+        make_option(
+            '--max-shops', default='3,6',
+            help="Comma separated caps on the shops of a plan."),
+        make_option(
+            '--repeat', type='int', default=5,
+            help="Number of timed runs per basket."),
+        make_option(
+            '--seed', type='int', default=0,
+            help="Seed for the price generator."))
+
+    def handle_noargs(self, **options):
+
+        rng = random.Random(options['seed'])
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        caps = [int(cap) for cap in options['max_shops'].split(',')]
+
+        with scratch_database():
+
+            currency, products = self.make_catalogue(
+                max(sizes), options['shops'], rng)
+
+            self.stdout.write("%8s %8s %10s %10s %10s %8s" % (
+                "items", "shops", "load ms", "solve ms", "total", "exact"))
+
+            for size in sizes:
+
+                items = [(product, rng.randint(1, 5))
+                         for product in rng.sample(products, size)]
+
+                load = timings(
+                    lambda: basket.PriceMatrix(items, currency),
+                    [()] * options['repeat'])
+
+                matrix = basket.PriceMatrix(items, currency)
+
+                for cap in caps:
+
+                    solve = timings(
+                        lambda: basket.choose_shops(matrix.costs, cap),
+                        [()] * options['repeat'])
+
+                    plan = basket.BasketPlan(
+                        matrix, *basket.choose_shops(matrix.costs, cap))
+
+                    self.stdout.write(
+                        "%8d %8d %10.2f %10.2f %10s %8s" % (
+                            size, cap,
+                            percentile(load, 0.5) * 1e3,
+                            percentile(solve, 0.5) * 1e3,
+                            plan.total, plan.exact))
+
+    def make_catalogue(self, size, shops, rng):
+
+        section = Section.objects.create(name="Bench")
+        currency = Currency.objects.create(
+            name="Bench", code="BNC", symbol="B")
+
+        Shop.objects.bulk_create(
+            Shop(name="Bench %d" % i) for i in range(shops))
+        shop_ids = list(
+            Shop.objects.filter(name__startswith="Bench ").
+            values_list('id', flat=True))
+
+        Product.objects.bulk_create(
+            Product(name="Bench %d" % i, section=section)
+            for i in range(size))
+        product_ids = list(
+            Product.objects.filter(section=section).
+            values_list('id', flat=True))
+
+        prices = [
+            Price(product_id=product, shop_id=shop, currency=currency,
+                  value=Decimal(rng.randint(50, 2000)) / 100)
+            for product in product_ids
+            for shop in shop_ids
+            if rng.random() < 0.8]
+
+        for start in range(0, len(prices), 500):
+
+            Price.objects.bulk_create(prices[start:start + 500])
+
+        return currency, product_ids
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import random
+import datetime
+from decimal import Decimal
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.utils import timezone
+
+from products.models import Section, Product, Shop, Currency, Price
+from shiny_ninja.benchmark import scratch_database, timings, percentile
+
+
+PRODUCTS = 50
+SHOPS = 20
+
+
+class Command(NoArgsCommand):
+
+    help = ("Measures Product.price_at latency as the price history grows. "
+            "Runs against a scratch test database.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option(
+            '--sizes', default='10000,100000,1000000',
+            help="Comma separated price history sizes to measure at, "
+                 "e.g. 10000,100000,1000000,10000000."),
+        make_option(
+            '--lookups', type='int', default=1000,
+            help="Number of price_at calls timed at every size."),
+        make_option(
+            '--seed', type='int', default=0,
+            help="Seed for the lookup generator."))
+
+    def handle_noargs(self, **options):
+
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        rng = random.Random(options['seed'])
+
+        with scratch_database():
+
+            products, shops, currency = self.make_catalogue()
+            start = timezone.now() - datetime.timedelta(days=365)
+
+            self.stdout.write("%12s %12s %12s" % ("rows", "median us", "p95 us"))
+
+            depth = 0
+            for size in sizes:
+
+                new_depth = max(size // (PRODUCTS * SHOPS), 1)
+                self.extend_history(
+                    products, shops, currency, start, depth, new_depth)
+                depth = new_depth
+
+                calls = [
+                    (rng.choice(products), rng.choice(shops),
+                     start + datetime.timedelta(hours=depth * rng.random()))
+                    for i in range(options['lookups'])]
+
+                results = timings(
+                    lambda product, shop, day: product.price_at(shop, day),
+                    calls)
+
+                self.stdout.write("%12d %12.1f %12.1f" % (
+                    depth * PRODUCTS * SHOPS,
+                    percentile(results, 0.5) * 1e6,
+                    percentile(results, 0.95) * 1e6))
+
+    def make_catalogue(self):
+
+        section = Section.objects.create(name="Benchmark")
+        currency = Currency.objects.create(
+            name="Benchmark", code="BEN", symbol="B")
+
+        Product.objects.bulk_create(
+            Product(name="Product %d" % i, section=section)
+            for i in range(PRODUCTS))
+        Shop.objects.bulk_create(
+            Shop(name="Shop %d" % i) for i in range(SHOPS))
+
+        return list(Product.objects.all()), list(Shop.objects.all()), currency
+
+    def extend_history(self, products, shops, currency, start, old, new):
+
+        def prices():
+
+            for step in range(old, new):
+
+                since = start + datetime.timedelta(hours=step)
+
+                for product in products:
+
+                    for shop in shops:
+
+                        yield Price(
+                            value=Decimal(step % 100 + 1),
+                            currency=currency,
+                            shop=shop,
+                            product=product,
+                            since=since)
+
+        with transaction.atomic():
+
+            batch = []
+            for price in prices():
+
+                batch.append(price)
+
+                if len(batch) == 10000:
+
+                    Price.objects.bulk_create(batch)
+                    batch = []
+
+            Price.objects.bulk_create(batch)
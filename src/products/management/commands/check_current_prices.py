@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db.models import Min
+from django.utils import timezone
+
+from products.models import Price, CurrentPrice
+
+
+class Command(NoArgsCommand):
+
+    help = ("Verifies the current price table against the price history "
+            "and optionally repairs it.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option(
+            '--fix', action='store_true', default=False,
+            help="Refresh every current price found to be wrong."),)
+
+    def handle_noargs(self, **options):
+
+        now = timezone.now()
+
+        pairs = list(
+            Price.objects.values_list('product', 'shop').distinct())
+
+        stored = dict(
+            ((current.product_id, current.shop_id), current)
+            for current in CurrentPrice.objects.all())
+
+        wrong = []
+        for start in range(0, len(pairs), Price.objects.TRIPLES_PER_QUERY):
+
+            chunk = pairs[start:start + Price.objects.TRIPLES_PER_QUERY]
+
+            resolved = Price.objects.in_effect(
+                (product, shop, now) for product, shop in chunk)
+
+            upcoming = dict(
+                ((row['product'], row['shop']), row['since__min'])
+                for row in Price.objects.filter(
+                    since__gt=now,
+                    product__in=set(product for product, shop in chunk),
+                    shop__in=set(shop for product, shop in chunk)).
+                values('product', 'shop').annotate(Min('since')))
+
+            for pair, prices in zip(chunk, resolved):
+
+                current = stored.pop(pair, None)
+                price_id = prices[0].id if prices else None
+
+                if current is None or not current.is_valid_at(now):
+
+                    # Missing and expired rows are refreshed on the next
+                    # lookup, so they can never serve a wrong price.
+                    continue
+
+                if (current.price_id != price_id or
+                        current.valid_until != upcoming.get(pair)):
+
+                    wrong.append(pair)
+
+        # Whatever is left refers to pairs with no price history at all.
+        wrong.extend(stored)
+
+        for product, shop in wrong:
+
+            self.stdout.write(
+                "Wrong current price for product %d at shop %d" % (
+                    product, shop))
+
+            if options['fix']:
+
+                CurrentPrice.refresh(product, shop, now)
+
+        self.stdout.write(
+            "Checked %d products at shops, %d wrong%s." % (
+                len(pairs), len(wrong),
+                ", fixed" if options['fix'] and wrong else ""))
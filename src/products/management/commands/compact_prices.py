@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+
+from products.retention import (
+    PriceCompaction, parse_policy, PRODUCTS_PER_BATCH)
+
+
+class Command(NoArgsCommand):
+
+    help = ("Removes prices repeating the previous one of their product "
+            "and shop, and downsamples old price history according to "
+            "PRICE_HISTORY_RETENTION. Prices purchases refer to are kept.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option(
+            '--policy',
+            help="Retention steps overriding the setting, "
+                 "e.g. 30:day,365:month."),
+        make_option(
+            '--batch-size', type='int', default=PRODUCTS_PER_BATCH,
+            help="Number of products whose history is compacted at once."),
+        make_option(
+            '--dry-run', action='store_true', default=False,
+            help="Only count the prices which would be removed."),)
+
+    def handle_noargs(self, **options):
+
+        try:
+
+            policy = (parse_policy(options['policy'])
+                      if options['policy'] else None)
+
+        except ValueError as error:
+
+            raise CommandError("Bad policy: %s" % error)
+
+        free = _free_bytes()
+
+        compaction = PriceCompaction(
+            policy, dry_run=options['dry_run'],
+            batch_size=options['batch_size']).run()
+
+        self.stdout.write(
+            "%s %d of %d prices: %d repeated, %d downsampled." % (
+                "Would remove" if options['dry_run'] else "Removed",
+                compaction.merged + compaction.downsampled,
+                compaction.examined,
+                compaction.merged, compaction.downsampled))
+
+        if free is not None and not options['dry_run']:
+
+            # SQLite keeps freed pages for reuse, VACUUM returns them.
+            self.stdout.write(
+                "Freed %d bytes of database pages." % (_free_bytes() - free))
+
+
+def _free_bytes():
+
+    if connection.vendor != 'sqlite':
+
+        return None
+
+    cursor = connection.cursor()
+
+    cursor.execute("PRAGMA freelist_count")
+    pages, = cursor.fetchone()
+
+    cursor.execute("PRAGMA page_size")
+    page_size, = cursor.fetchone()
+
+    return pages * page_size
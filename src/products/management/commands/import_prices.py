@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from products.models import Shop
+from products.imports import PriceImport, ROWS_PER_BATCH
+
+
+class Command(BaseCommand):
+
+    args = "<file.csv>"
+
+    help = ("Imports prices from a CSV file with product, shop, currency "
+            "and value columns. Prices which did not change are skipped.")
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--shop',
+            help="Name of the shop of every row, instead of a shop column."),
+        make_option(
+            '--batch-size', type='int', default=ROWS_PER_BATCH,
+            help="Number of rows checked and inserted at a time."),)
+
+    def handle(self, *args, **options):
+
+        if len(args) != 1:
+
+            raise CommandError("Give exactly one file to import.")
+
+        shop = None
+
+        if options['shop']:
+
+            try:
+
+                shop = Shop.objects.get(name=options['shop'])
+
+            except (Shop.DoesNotExist, Shop.MultipleObjectsReturned):
+
+                raise CommandError("No single shop named %s." % options['shop'])
+
+        with open(args[0], 'rU') as lines:
+
+            with transaction.atomic():
+
+                result = PriceImport(shop, options['batch_size']).run(lines)
+
+        for number, error in result.errors:
+
+            self.stderr.write("Line %d: %s" % (number, error))
+
+        self.stdout.write(
+            "Imported %d of %d rows, skipped %d, rejected %d "
+            "in %.1f s (%d rows/s)." % (
+                result.imported, result.read, result.skipped,
+                len(result.errors), result.seconds,
+                result.rows_per_second()))
@@ -2,11 +2,19 @@
 
 import os.path
 import datetime
+from decimal import Decimal
 
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import Min
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver, Signal
 from django.conf import settings
 from django.utils import timezone
-from django.core.exceptions import ValidationError
+from django.utils.dateparse import parse_datetime
+from django.core.exceptions import ValidationError, ImproperlyConfigured
+
+from products.cache import price_cache
+from products.rates import RateTable, MissingRate, exchange_rates
 
 
 class Section(models.Model):
@@ -37,57 +45,81 @@ class Product(models.Model):
 
     def price_at(self, shop, day):
 
-        prices = Price.objects.filter(
-            product=self,
-            shop=shop,
-            since__lte=day).order_by('-since')
+        def resolve():
 
-        if prices.count() == 0:
+            prices, = Price.objects.in_effect([(self, shop, day)])
 
-            return None
+            if not prices:
+
+                return None
 
-        return prices[0]
+            return prices[0]
+
+        return price_cache.get(self, shop, day, resolve)
 
     def current_price(self, shop):
 
-        now = timezone.now()
+        return price_cache.get(
+            self, shop, timezone.now(),
+            lambda: CurrentPrice.lookup(self, shop))
+
+    def min_price_at(self, day, currency=None):
+        """Returns the cheapest prices in effect on the day.
+
+        Prices in several currencies are compared converted into the
+        given currency, or the base one, leaving out those with no known
+        rate. Every price carries the value compared as compared_value.
+        """
+
+        in_effect, = Price.objects.in_effect([(self, None, day)])
 
-        return self.price_at(shop, now)
+        if currency is None and len(
+                set(price.currency_id for price in in_effect)) > 1:
 
-    def min_price_at(self, day):
+            currency = Currency.base()
 
-        shops = Shop.objects.filter(
-            price__product=self)
+        if currency is not None:
+
+            table = ExchangeRate.table()
 
         min_price_value = None
 
         prices = []
-        for shop in shops:
+        for price in in_effect:
 
-            price = self.price_at(shop, day)
+            price.compared_value = price.value
 
-            if price is not None:
+            if currency is not None:
+
+                try:
+
+                    price.compared_value = table.convert(
+                        price.value, price.currency_id, currency, day)
+
+                except MissingRate:
 
-                if min_price_value is None:
+                    continue
 
-                    min_price_value = price.value
-                    prices.append(price)
+            if min_price_value is None:
 
-                elif price.value < min_price_value:
+                min_price_value = price.compared_value
+                prices.append(price)
 
-                    min_price_value = price.value
-                    prices = [price]
+            elif price.compared_value < min_price_value:
 
-                elif price.value == min_price_value:
+                min_price_value = price.compared_value
+                prices = [price]
 
-                    prices.append(price)
+            elif price.compared_value == min_price_value:
+
+                prices.append(price)
 
         return prices
 
-    def min_current_price(self):
+    def min_current_price(self, currency=None):
 
         return self.min_price_at(
-            timezone.now())
+            timezone.now(), currency)
 
     def change_current_price(self, shop, value, currency):
 
@@ -136,6 +168,24 @@ class Currency(models.Model):
 
         return self.code
 
+    @classmethod
+    def base(cls):
+        """Returns the currency of settings.BASE_CURRENCY.
+
+        Raises ImproperlyConfigured when there is no such currency, since
+        amounts in several currencies cannot be compared without it.
+        """
+
+        code = getattr(settings, 'BASE_CURRENCY', None)
+        currency = cls.objects.filter(code=code).first()
+
+        if currency is None:
+
+            raise ImproperlyConfigured(
+                "BASE_CURRENCY %r is not a known currency" % code)
+
+        return currency
+
 
 def positive(value):
 
@@ -145,6 +195,161 @@ def positive(value):
             "The value must be positive")
 
 
+def _id_of(obj):
+
+    return getattr(obj, 'id', obj)
+
+
+def _as_datetime(value):
+
+    # Computed columns of raw queries come back from SQLite as strings.
+    if value is None or isinstance(value, datetime.datetime):
+
+        return value
+
+    value = parse_datetime(value)
+
+    if settings.USE_TZ and timezone.is_naive(value):
+
+        value = timezone.make_aware(value, timezone.utc)
+
+    return value
+
+
+class ExchangeRate(models.Model):
+    """What one unit of a currency was worth in another from a day on."""
+
+    source = models.ForeignKey(Currency, related_name='rates_from')
+    target = models.ForeignKey(Currency, related_name='rates_to')
+
+    rate = models.DecimalField(
+        max_digits=12, decimal_places=6,
+        validators=[positive])
+    day = models.DateField(default=datetime.date.today)
+
+    class Meta:
+
+        unique_together = [('source', 'target', 'day')]
+
+    def __unicode__(self):
+
+        return "1 %s = %s %s since %s" % (
+            self.source, self.rate, self.target,
+            self.day.strftime("%Y-%m-%d"))
+
+    @classmethod
+    def table(cls):
+        """Returns the whole rate history, loaded once per process."""
+
+        return exchange_rates.get(
+            lambda: RateTable(
+                cls.objects.values_list('source', 'target', 'day', 'rate')))
+
+
+# Sent with the (product id, shop id) pairs of prices added in bulk, which
+# post_save is not sent for.
+prices_appended = Signal(providing_args=['pairs'])
+
+
+class PriceManager(models.Manager):
+
+    # Every triple costs four query parameters and one compound SELECT
+    # member, so keep chunks well below SQLite's limits for both.
+    TRIPLES_PER_QUERY = 200
+
+    def bulk_append(self, prices, batch_size=500):
+        """Inserts many prices with bulk_create, batch_size at a time.
+
+        Whatever is derived from the price history is then brought up to
+        date through the prices_appended signal.
+        """
+
+        prices = list(prices)
+
+        for start in range(0, len(prices), batch_size):
+
+            self.bulk_create(prices[start:start + batch_size])
+
+        prices_appended.send(
+            sender=self.model,
+            pairs=set((price.product_id, price.shop_id) for price in prices))
+
+    def in_effect(self, triples):
+        """Resolves the prices in effect for (product, shop, instant) triples.
+
+        Returns a list with one list of prices per triple, in order. A
+        shop of None stands for every shop, in which case the list holds
+        the price in effect at each shop having one. Every price carries
+        a valid_until attribute with the 'since' of the next price for
+        its product and shop, or None. Each chunk of triples is resolved
+        with a single greatest-per-group query.
+        """
+
+        triples = list(triples)
+        resolved = [[] for triple in triples]
+
+        for start in range(0, len(triples), self.TRIPLES_PER_QUERY):
+
+            chunk = triples[start:start + self.TRIPLES_PER_QUERY]
+
+            latest = {}
+            for price in self._in_effect_query(start, chunk):
+
+                price.valid_until = _as_datetime(price.valid_until)
+                key = (price.triple_index, price.shop_id)
+
+                if key not in latest or latest[key].id < price.id:
+
+                    latest[key] = price
+
+            for (index, shop_id), price in sorted(latest.items()):
+
+                resolved[index].append(price)
+
+        return resolved
+
+    def _in_effect_query(self, start, triples):
+
+        qn = connection.ops.quote_name
+
+        members = []
+        params = []
+        for index, (product, shop, instant) in enumerate(triples, start):
+
+            members.append(
+                "SELECT %s AS idx, %s AS product_id, "
+                "%s AS shop_id, %s AS instant")
+            params.extend([
+                index, _id_of(product),
+                None if shop is None else _id_of(shop),
+                connection.ops.value_to_db_datetime(instant)])
+
+        # CROSS JOIN pins the join order on SQLite, so that the shops are
+        # known before the history is read and every step is a seek on
+        # the (product, shop, since) index whatever the history length.
+        return self.raw(
+            "SELECT price.*, triple.idx AS triple_index, ("
+            "SELECT MIN(later.since) FROM %(prices)s later "
+            "WHERE later.product_id = price.product_id "
+            "AND later.shop_id = price.shop_id "
+            "AND later.since > price.since) AS valid_until "
+            "FROM (%(triples)s) triple "
+            "CROSS JOIN %(shops)s shop "
+            "CROSS JOIN %(prices)s price "
+            "WHERE (triple.shop_id IS NULL OR shop.id = triple.shop_id) "
+            "AND price.product_id = triple.product_id "
+            "AND price.shop_id = shop.id "
+            "AND price.since = ("
+            "SELECT MAX(latest.since) FROM %(prices)s latest "
+            "WHERE latest.product_id = triple.product_id "
+            "AND latest.shop_id = shop.id "
+            "AND latest.since <= triple.instant)" % {
+                'prices': qn(self.model._meta.db_table),
+                'shops': qn(Shop._meta.db_table),
+                'triples': " UNION ALL ".join(members)},
+            params)
+
+
 class Price(models.Model):
 
     value = models.DecimalField(
@@ -158,6 +363,14 @@ class Price(models.Model):
     shop = models.ForeignKey(Shop)
     product = models.ForeignKey(Product)
 
+    objects = PriceManager()
+
+    class Meta:
+
+        # Price history is append-only and always read as "the latest
+        # row for a product and shop up to some instant".
+        index_together = [['product', 'shop', 'since']]
+
     def value_if_available(self):
 
         if self.available:
@@ -171,3 +384,184 @@ class Price(models.Model):
         return "%s for %s at %s since %s" % (
             self.value, self.product,
             self.shop, self.since.strftime("%Y-%m-%d"))
+
+
+class CurrentPrice(models.Model):
+
+    product = models.ForeignKey(Product)
+    shop = models.ForeignKey(Shop)
+
+    # The price in effect when the row was last refreshed, and the
+    # 'since' of the earliest price scheduled after it, if any.
+    price = models.ForeignKey(Price, null=True, blank=True)
+    valid_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+
+        unique_together = [('product', 'shop')]
+
+    def __unicode__(self):
+
+        return "%s at %s: %s" % (self.product, self.shop, self.price)
+
+    def is_valid_at(self, day):
+
+        return self.valid_until is None or day < self.valid_until
+
+    @classmethod
+    def lookup(cls, product, shop):
+
+        now = timezone.now()
+
+        current = list(
+            cls.objects.select_related('price').filter(
+                product=product, shop=shop))
+
+        if current and current[0].is_valid_at(now):
+
+            price = current[0].price
+
+            if price is not None:
+
+                price.valid_until = current[0].valid_until
+
+            return price
+
+        return cls.refresh(product, shop, now)
+
+    @classmethod
+    def refresh(cls, product, shop, now=None):
+
+        if now is None:
+
+            now = timezone.now()
+
+        prices, = Price.objects.in_effect([(product, shop, now)])
+
+        if prices:
+
+            price = prices[0]
+            valid_until = price.valid_until
+
+        else:
+
+            price = None
+            valid_until = Price.objects.filter(
+                product=product,
+                shop=shop,
+                since__gt=now).aggregate(Min('since'))['since__min']
+
+        rows = cls.objects.filter(product=product, shop=shop)
+
+        if price is None and valid_until is None:
+
+            rows.delete()
+
+            return None
+
+        if not rows.update(price=price, valid_until=valid_until):
+
+            try:
+
+                with transaction.atomic():
+
+                    cls.objects.create(
+                        product_id=_id_of(product),
+                        shop_id=_id_of(shop),
+                        price=price,
+                        valid_until=valid_until)
+
+            except IntegrityError:
+
+                # Somebody else has just created the row.
+                rows.update(price=price, valid_until=valid_until)
+
+        return price
+
+
+    @classmethod
+    def refresh_many(cls, pairs, now=None):
+        """Refreshes the rows of many (product, shop) pairs at once.
+
+        Rows are replaced with the prices in effect, resolved in chunks.
+        Pairs without one are left to be filled in by lookup().
+        """
+
+        if now is None:
+
+            now = timezone.now()
+
+        pairs = list(set((_id_of(product), _id_of(shop))
+                         for product, shop in pairs))
+
+        chunk_size = Price.objects.TRIPLES_PER_QUERY
+
+        for start in range(0, len(pairs), chunk_size):
+
+            chunk = pairs[start:start + chunk_size]
+
+            resolved = Price.objects.in_effect(
+                (product, shop, now) for product, shop in chunk)
+
+            wanted = set(chunk)
+            stale = [
+                current_id for current_id, product, shop in
+                cls.objects.filter(
+                    product__in=set(product for product, shop in chunk),
+                    shop__in=set(shop for product, shop in chunk)).
+                values_list('id', 'product', 'shop')
+                if (product, shop) in wanted]
+
+            rows = [
+                cls(product_id=product, shop_id=shop,
+                    price=prices[0], valid_until=prices[0].valid_until)
+                for (product, shop), prices in zip(chunk, resolved)
+                if prices]
+
+            try:
+
+                with transaction.atomic():
+
+                    cls.objects.filter(id__in=stale).delete()
+                    cls.objects.bulk_create(rows)
+
+            except IntegrityError:
+
+                # Some rows were created by concurrent lookups meanwhile.
+                for product, shop in chunk:
+
+                    cls.refresh(product, shop, now)
+
+
+@receiver(post_save, sender=Price)
+def refresh_current_price(instance, raw=False, **kwargs):
+
+    # Fixtures may be loaded before the rows they refer to exist. Missing
+    # current prices are filled in lazily by CurrentPrice.lookup.
+    if not raw:
+
+        CurrentPrice.refresh(instance.product_id, instance.shop_id)
+
+
+@receiver(post_save, sender=Price)
+@receiver(post_delete, sender=Price)
+def invalidate_cached_prices(instance, **kwargs):
+
+    price_cache.invalidate(instance.product_id, instance.shop_id)
+
+
+@receiver(post_save, sender=ExchangeRate)
+@receiver(post_delete, sender=ExchangeRate)
+def invalidate_exchange_rates(**kwargs):
+
+    exchange_rates.invalidate()
+
+
+@receiver(prices_appended, sender=Price)
+def refresh_current_prices(pairs, **kwargs):
+
+    CurrentPrice.refresh_many(pairs)
+
+    for product, shop in pairs:
+
+        price_cache.invalidate(product, shop)
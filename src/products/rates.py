@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import time
+import datetime
+import threading
+from bisect import bisect_right
+from decimal import Decimal
+
+from django.conf import settings
+
+
+def _id_of(obj):
+
+    return getattr(obj, 'id', obj)
+
+
+def _day_number(day):
+
+    if isinstance(day, datetime.datetime):
+
+        day = day.date()
+
+    return day.toordinal()
+
+
+class MissingRate(LookupError):
+
+    pass
+
+
+class RateTable(object):
+    """In-memory history of exchange rates.
+
+    Built from (source id, target id, day, rate) rows, where one unit of
+    the source currency was worth `rate` units of the target from `day`
+    on. A lookup takes the latest rate on or before the day asked for,
+    found by bisection, of the pair quoted either way round, or else
+    through any single currency both sides are quoted against.
+    """
+
+    def __init__(self, rows):
+
+        self.quotes = {}
+
+        for source, target, day, rate in sorted(
+                rows, key=lambda row: row[2]):
+
+            days, rates = self.quotes.setdefault((source, target), ([], []))
+
+            days.append(_day_number(day))
+            rates.append(Decimal(rate))
+
+        self.pivots = {}
+
+        for source, target in self.quotes:
+
+            self.pivots.setdefault(source, set()).add(target)
+            self.pivots.setdefault(target, set()).add(source)
+
+    def _quote(self, source, target, day):
+
+        for pair, inverse in [((source, target), False),
+                              ((target, source), True)]:
+
+            if pair not in self.quotes:
+
+                continue
+
+            days, rates = self.quotes[pair]
+            index = bisect_right(days, day)
+
+            if index:
+
+                rate = rates[index - 1]
+
+                return 1 / rate if inverse else rate
+
+        return None
+
+    def rate(self, source, target, day):
+        """Returns what one unit of source was worth in target on the day.
+
+        Raises MissingRate when no rate was known by then.
+        """
+
+        source = _id_of(source)
+        target = _id_of(target)
+
+        if source == target:
+
+            return Decimal(1)
+
+        number = _day_number(day)
+        rate = self._quote(source, target, number)
+
+        if rate is not None:
+
+            return rate
+
+        for pivot in sorted(self.pivots.get(source, set()) &
+                            self.pivots.get(target, set())):
+
+            first = self._quote(source, pivot, number)
+            second = self._quote(pivot, target, number)
+
+            if first is not None and second is not None:
+
+                return first * second
+
+        raise MissingRate(
+            "No rate from currency %s to %s on %s" % (source, target, day))
+
+    def convert(self, value, source, target, day):
+
+        return value * self.rate(source, target, day)
+
+
+class RateCache(object):
+    """Process-local copy of the rate table, loaded on first use.
+
+    Writes to the exchange rates drop it in the process making them.
+    Other processes load it anew once it is older than
+    settings.EXCHANGE_RATE_CACHE_SECONDS, so they lag behind by at most
+    that long.
+    """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.table = None
+        self.loaded = None
+
+    @property
+    def max_age(self):
+
+        return getattr(settings, 'EXCHANGE_RATE_CACHE_SECONDS', 300)
+
+    def get(self, load):
+
+        with self.lock:
+
+            now = time.time()
+
+            if self.table is None or now - self.loaded >= self.max_age:
+
+                self.table = load()
+                self.loaded = now
+
+            return self.table
+
+    def invalidate(self):
+
+        with self.lock:
+
+            self.table = None
+
+
+exchange_rates = RateCache()
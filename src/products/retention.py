@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from products.models import Product, Price, CurrentPrice
+
+
+PRODUCTS_PER_BATCH = 100
+
+GRANULARITIES = ('day', 'week', 'month')
+
+
+def parse_policy(text):
+    """Parses a policy like "30:day,365:month" into retention steps."""
+
+    policy = []
+    for step in text.split(','):
+
+        days, granularity = step.split(':')
+
+        policy.append((int(days), granularity.strip()))
+
+    return _checked(policy)
+
+
+def _checked(policy):
+
+    for days, granularity in policy:
+
+        if granularity not in GRANULARITIES:
+
+            raise ValueError("Unknown granularity: %s" % granularity)
+
+    return sorted(policy)
+
+
+class PriceCompaction(object):
+    """Removes prices which tell nothing new from the price history.
+
+    A price is redundant when it repeats the value, currency and
+    availability of the previous price of its product and shop, or when
+    the retention policy keeps only the last price of its period. Prices
+    referred to by other rows, but for current prices, are never
+    removed. History is read a batch of products at a time.
+    """
+
+    def __init__(self, policy=None, now=None, dry_run=False,
+                 batch_size=PRODUCTS_PER_BATCH):
+
+        if policy is None:
+
+            policy = settings.PRICE_HISTORY_RETENTION
+
+        self.policy = _checked(policy)
+        self.now = now or timezone.now()
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+
+        # Any foreign key to prices keeps them, current prices are only
+        # derived from the history and get refreshed instead.
+        self.references = [
+            related.field for related in
+            Price._meta.get_all_related_objects()
+            if related.model is not CurrentPrice]
+
+        self.examined = 0
+        self.merged = 0
+        self.downsampled = 0
+
+    def run(self):
+
+        last_id = 0
+        while True:
+
+            products = list(
+                Product.objects.
+                filter(id__gt=last_id).
+                order_by('id').
+                values_list('id', flat=True)[:self.batch_size])
+
+            if not products:
+
+                break
+
+            with transaction.atomic():
+
+                self.compact(products)
+
+            last_id = products[-1]
+
+        return self
+
+    def compact(self, products):
+
+        referenced = set()
+        for field in self.references:
+
+            referenced.update(
+                field.model.objects.
+                filter(**{field.name + '__product__in': products}).
+                values_list(field.name, flat=True).
+                distinct())
+
+        history = {}
+        for row in (Price.objects.
+                filter(product__in=products).
+                order_by('since', 'id').
+                values_list('id', 'product', 'shop', 'since',
+                            'value', 'currency', 'available')):
+
+            history.setdefault(row[1:3], []).append(row)
+
+        redundant = []
+        pairs = set()
+        for pair, prices in history.items():
+
+            self.examined += len(prices)
+
+            merged, downsampled = self.redundant(prices, referenced)
+
+            self.merged += len(merged)
+            self.downsampled += len(downsampled)
+
+            if merged or downsampled:
+
+                redundant.extend(merged + downsampled)
+                pairs.add(pair)
+
+        if redundant and not self.dry_run:
+
+            # Rows referred to meanwhile are left alone rather than
+            # deleted along with whatever refers to them.
+            unreferenced = dict(
+                (field.related_query_name() + '__isnull', True)
+                for field in self.references)
+
+            Price.objects.filter(id__in=redundant, **unreferenced).delete()
+
+            CurrentPrice.refresh_many(pairs, self.now)
+
+    def redundant(self, prices, referenced):
+        """Splits the redundant prices of a product at a shop, ordered by
+        since, into merged and downsampled ids."""
+
+        downsampled = []
+        kept = []
+        for price, following in zip(prices, prices[1:] + [None]):
+
+            period = self.period_of(price[3])
+
+            if (period is not None and following is not None and
+                    self.period_of(following[3]) == period and
+                    price[0] not in referenced):
+
+                downsampled.append(price[0])
+
+            else:
+
+                kept.append(price)
+
+        merged = []
+        previous = None
+        for price in kept:
+
+            if (previous is not None and
+                    price[4:] == previous[4:] and
+                    price[0] not in referenced):
+
+                merged.append(price[0])
+
+            else:
+
+                previous = price
+
+        return merged, downsampled
+
+    def period_of(self, since):
+        """The period of a price under the policy, None to keep it."""
+
+        age = self.now - since
+        granularity = None
+
+        for days, step in self.policy:
+
+            if age >= datetime.timedelta(days=days):
+
+                granularity = step
+
+        if granularity is None:
+
+            return None
+
+        # Periods follow the days of the current time zone, not of UTC.
+        day = timezone.localtime(since).date()
+
+        if granularity == 'week':
+
+            return (granularity, day - datetime.timedelta(days=day.weekday()))
+
+        elif granularity == 'month':
+
+            return (granularity, day.replace(day=1))
+
+        return (granularity, day)
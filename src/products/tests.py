@@ -1,13 +1,32 @@
 # -*- coding: utf-8 -*-
 
+import os.path
+import json
+import random
 import datetime
+from array import array
 from decimal import Decimal
 
+from StringIO import StringIO
+
 from django.test import TestCase
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.db import connection
 from django.utils import timezone
-from django.core.exceptions import ValidationError
-
-from products.models import Shop, Section, Currency, Price, Product
+from django.utils.tzinfo import FixedOffset
+from django.core.exceptions import ValidationError, ImproperlyConfigured
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.contrib.auth.models import User
+
+from products.models import (
+    Shop, Section, Currency, Price, Product, CurrentPrice, ExchangeRate)
+from products.cache import price_cache
+from products.rates import RateTable, MissingRate, exchange_rates
+from products.imports import PriceImport
+from products import basket
+from products.retention import PriceCompaction, parse_policy
+from purchases.models import Purchase
 
 
 def get_id(obj):
@@ -134,6 +153,135 @@ class ProductModelPriceAtTest(OurCase):
             oranges.price_at(shop, now).product)
 
 
+@override_settings(PRICE_CACHE_SIZE=10, PRICE_CACHE_BUCKET=3600)
+class ProductModelPriceAtCacheTest(OurCase):
+
+    def setUp(self):
+
+        price_cache.clear()
+
+        self.section = Section.objects.create(name="Drinks")
+        self.euro = Currency.objects.create(
+            name="Test euro", code="XEU", symbol="e")
+        self.shop = Shop.objects.create(name="Corner shop", description="")
+        self.product = Product.objects.create(
+            name="Juice", description="", section=self.section)
+
+        # Instants within one cache bucket.
+        self.hour = timezone.now().replace(
+            minute=0, second=0, microsecond=0) - datetime.timedelta(days=1)
+
+    def tearDown(self):
+
+        price_cache.clear()
+
+    def at(self, minutes):
+
+        return self.hour + datetime.timedelta(minutes=minutes)
+
+    def create_price(self, value, minutes):
+
+        return Price.objects.create(
+            value=Decimal(value), currency=self.euro,
+            shop=self.shop, product=self.product,
+            since=self.at(minutes))
+
+    def test_repeated_lookup_is_a_hit(self):
+
+        price = self.create_price("1.0", -60)
+
+        self.assertEqual(
+            self.product.price_at(self.shop, self.at(10)).id, price.id)
+
+        with self.assertNumQueries(0):
+
+            self.assertEqual(
+                self.product.price_at(self.shop, self.at(20)).id, price.id)
+
+        self.assertEqual(price_cache.hits, 1)
+        self.assertEqual(price_cache.misses, 1)
+
+    def test_price_write_invalidates_entries(self):
+
+        self.create_price("1.0", -60)
+
+        self.product.price_at(self.shop, self.at(30))
+
+        newer = self.create_price("2.0", 15)
+
+        self.assertEqual(
+            self.product.price_at(self.shop, self.at(30)).id, newer.id)
+
+    def test_entry_does_not_answer_outside_its_validity(self):
+
+        old = self.create_price("1.0", -60)
+        new = self.create_price("2.0", 30)
+
+        self.assertEqual(
+            self.product.price_at(self.shop, self.at(40)).id, new.id)
+        self.assertEqual(
+            self.product.price_at(self.shop, self.at(10)).id, old.id)
+        self.assertEqual(
+            self.product.price_at(self.shop, self.at(40)).id, new.id)
+
+    def test_deletion_invalidates_entries(self):
+
+        old = self.create_price("1.0", -60)
+        new = self.create_price("2.0", 5)
+
+        self.product.price_at(self.shop, self.at(10))
+
+        new.delete()
+
+        self.assertEqual(
+            self.product.price_at(self.shop, self.at(10)).id, old.id)
+
+    @override_settings(PRICE_CACHE_SIZE=2)
+    def test_least_recently_used_entry_is_evicted(self):
+
+        self.create_price("1.0", -60 * 24)
+
+        for hours in range(3):
+
+            self.product.price_at(
+                self.shop, self.at(60 * hours))
+
+        self.assertEqual(price_cache.stats()['size'], 2)
+
+        self.product.price_at(self.shop, self.at(0))
+
+        self.assertEqual(price_cache.misses, 4)
+
+    def test_current_price_goes_through_cache(self):
+
+        self.product.change_current_price(
+            self.shop, Decimal("1.0"), self.euro)
+
+        self.product.current_price(self.shop)
+
+        with self.assertNumQueries(0):
+
+            self.assertEqual(
+                self.product.current_price(self.shop).value,
+                Decimal("1.0"))
+
+        self.product.change_current_price(
+            self.shop, Decimal("2.0"), self.euro)
+
+        self.assertEqual(
+            self.product.current_price(self.shop).value, Decimal("2.0"))
+
+    @override_settings(PRICE_CACHE_SIZE=0)
+    def test_is_disabled_by_default(self):
+
+        self.create_price("1.0", -60)
+
+        self.product.price_at(self.shop, self.at(10))
+        self.product.price_at(self.shop, self.at(10))
+
+        self.assertEqual(price_cache.stats()['size'], 0)
+
+
 class ProductModelMinPriceAtTest(OurCase):
     
     def test_for_product_without_price(self):
@@ -510,3 +658,739 @@ class ProductModelChangeCurrentPriceTest(OurCase):
         self.assertRaisesMessage(
             ValidationError, "{'value': [u'The value must be positive']}",
             product.change_current_price, shop, bad_price_value, euro)
+
+
+class PriceManagerInEffectTest(OurCase):
+
+    def setUp(self):
+
+        self.section = Section.objects.create(name="Drinks")
+        self.euro = Currency.objects.create(
+            name="Test euro", code="XEU", symbol="e")
+        self.shops = [
+            Shop.objects.create(name="Shop %d" % i, description="")
+            for i in range(3)]
+        self.product = Product.objects.create(
+            name="Juice", description="", section=self.section)
+
+    def test_resolves_many_triples_with_one_query(self):
+
+        now = timezone.now()
+        yesterday = now - datetime.timedelta(days=1)
+
+        expected = []
+        for i, shop in enumerate(self.shops):
+
+            Price.objects.create(
+                value=Decimal(i + 2), currency=self.euro,
+                shop=shop, product=self.product,
+                since=now - datetime.timedelta(days=3))
+
+            expected.append(
+                Price.objects.create(
+                    value=Decimal(i + 1), currency=self.euro,
+                    shop=shop, product=self.product,
+                    since=yesterday))
+
+        triples = [(self.product, shop, now) for shop in self.shops]
+
+        with self.assertNumQueries(1):
+
+            resolved = Price.objects.in_effect(triples)
+
+        self.assertEqual(
+            [[price.id for price in prices] for prices in resolved],
+            [[price.id] for price in expected])
+
+    def test_ties_on_since_resolve_to_newest_row(self):
+
+        now = timezone.now()
+        since = now - datetime.timedelta(days=1)
+
+        Price.objects.create(
+            value=Decimal("1.0"), currency=self.euro,
+            shop=self.shops[0], product=self.product, since=since)
+
+        newest = Price.objects.create(
+            value=Decimal("2.0"), currency=self.euro,
+            shop=self.shops[0], product=self.product, since=since)
+
+        self.assertEqual(
+            self.product.price_at(self.shops[0], now).id, newest.id)
+
+    def test_min_price_at_uses_one_query_for_any_number_of_shops(self):
+
+        now = timezone.now()
+
+        for i, shop in enumerate(self.shops):
+
+            Price.objects.create(
+                value=Decimal(i + 1), currency=self.euro,
+                shop=shop, product=self.product,
+                since=now - datetime.timedelta(days=1))
+
+        with self.assertNumQueries(1):
+
+            prices = self.product.min_price_at(now)
+
+        self.assertEqual(
+            [price.shop_id for price in prices], [self.shops[0].id])
+
+    def test_future_prices_are_not_in_effect(self):
+
+        now = timezone.now()
+
+        Price.objects.create(
+            value=Decimal("1.0"), currency=self.euro,
+            shop=self.shops[0], product=self.product,
+            since=now + datetime.timedelta(days=1))
+
+        self.assertEqual(
+            Price.objects.in_effect([(self.product, None, now)]), [[]])
+
+
+class CurrentPriceTest(OurCase):
+
+    def setUp(self):
+
+        self.section = Section.objects.create(name="Drinks")
+        self.euro = Currency.objects.create(
+            name="Test euro", code="XEU", symbol="e")
+        self.shop = Shop.objects.create(name="Corner shop", description="")
+        self.product = Product.objects.create(
+            name="Juice", description="", section=self.section)
+
+    def test_is_kept_in_sync_with_price_changes(self):
+
+        self.product.change_current_price(
+            self.shop, Decimal("1.0"), self.euro)
+        self.product.change_current_price(
+            self.shop, Decimal("2.0"), self.euro)
+
+        current = CurrentPrice.objects.get(
+            product=self.product, shop=self.shop)
+
+        self.assertEqual(current.price.value, Decimal("2.0"))
+
+        self.product.mark_unavailable(self.shop)
+
+        current = CurrentPrice.objects.get(
+            product=self.product, shop=self.shop)
+
+        self.assertFalse(current.price.available)
+
+    def test_current_price_is_read_with_one_query(self):
+
+        self.product.change_current_price(
+            self.shop, Decimal("1.0"), self.euro)
+
+        with self.assertNumQueries(1):
+
+            price = self.product.current_price(self.shop)
+
+        self.assertEqual(price.value, Decimal("1.0"))
+
+    def test_future_price_is_picked_up_once_in_effect(self):
+
+        now = timezone.now()
+
+        Price.objects.create(
+            value=Decimal("1.0"), currency=self.euro,
+            shop=self.shop, product=self.product,
+            since=now - datetime.timedelta(days=1))
+
+        future = Price.objects.create(
+            value=Decimal("2.0"), currency=self.euro,
+            shop=self.shop, product=self.product,
+            since=now + datetime.timedelta(days=1))
+
+        current = CurrentPrice.objects.get(
+            product=self.product, shop=self.shop)
+
+        self.assertEqual(current.price.value, Decimal("1.0"))
+        self.assertEqual(current.valid_until, future.since)
+
+        # Pretend the scheduled price has come into effect.
+        Price.objects.filter(id=future.id).update(
+            since=now - datetime.timedelta(hours=1))
+        CurrentPrice.objects.filter(id=current.id).update(
+            valid_until=now - datetime.timedelta(hours=1))
+
+        self.assertEqual(
+            self.product.current_price(self.shop).id, future.id)
+
+    def test_checker_finds_and_fixes_drift(self):
+
+        old = Price.objects.create(
+            value=Decimal("1.0"), currency=self.euro,
+            shop=self.shop, product=self.product,
+            since=timezone.now() - datetime.timedelta(days=1))
+
+        self.product.change_current_price(
+            self.shop, Decimal("2.0"), self.euro)
+
+        CurrentPrice.objects.filter(
+            product=self.product, shop=self.shop).update(price=old)
+
+        output = StringIO()
+        call_command('check_current_prices', fix=True, stdout=output)
+
+        self.assertIn(
+            "Wrong current price for product %d at shop %d" % (
+                self.product.id, self.shop.id),
+            output.getvalue())
+
+        self.assertEqual(
+            self.product.current_price(self.shop).value, Decimal("2.0"))
+
+        output = StringIO()
+        call_command('check_current_prices', stdout=output)
+
+        self.assertNotIn("Wrong", output.getvalue())
+
+
+class PriceImportTest(OurCase):
+
+    def setUp(self):
+
+        section = Section.objects.create(name="Flyer section")
+        self.euro = Currency.objects.create(
+            name="Test euro", code="XEU", symbol="e")
+        self.shop = Shop.objects.create(name="Flyer shop", description="")
+        self.products = [
+            Product.objects.create(
+                name="Flyer product %d" % i, description="",
+                section=section)
+            for i in range(5)]
+
+        self.products[0].change_current_price(
+            self.shop, Decimal("1.50"), self.euro)
+
+    def lines(self, *rows):
+
+        return StringIO("product,shop,currency,value\n" + "".join(
+            "%s,Flyer shop,XEU,%s\n" % row for row in rows))
+
+    def test_imports_changed_prices_only(self):
+
+        result = PriceImport(batch_size=2).run(self.lines(
+            ("Flyer product 0", "1.50"),
+            ("Flyer product 1", "2.00"),
+            ("Flyer product 2", '"3,25"'),
+            ("Flyer product 3", "-1"),
+            ("No such product", "1.00"),
+            ("Flyer product 4", "4.00")))
+
+        self.assertEqual(
+            (result.read, result.imported, result.skipped),
+            (6, 3, 1))
+        self.assertEqual(
+            [number for number, error in result.errors], [5, 6])
+
+        self.assertEqual(
+            self.products[2].current_price(self.shop).value, Decimal("3.25"))
+        self.assertEqual(
+            CurrentPrice.objects.get(
+                product=self.products[4], shop=self.shop).price.value,
+            Decimal("4.00"))
+        self.assertEqual(
+            Price.objects.filter(product=self.products[0]).count(), 1)
+
+    def test_batches_take_a_constant_number_of_queries(self):
+
+        counts = []
+        for rows in (10, 100):
+
+            importer = PriceImport(batch_size=100)
+
+            with CaptureQueriesContext(connection) as queries:
+
+                importer.run(self.lines(
+                    *[("Flyer product %d" % (i % 5), "%d.00" % (i + rows))
+                      for i in range(rows)]))
+
+            counts.append(len(queries))
+
+        self.assertEqual(importer.imported, 5)
+        self.assertEqual(counts[0], counts[1])
+
+    def test_command_and_view(self):
+
+        output = StringIO()
+        call_command(
+            'import_prices', os.path.join(
+                os.path.dirname(__file__), 'fixtures', 'test_prices.csv'),
+            shop="Flyer shop", stdout=output)
+
+        self.assertIn("Imported 2 of 2 rows", output.getvalue())
+
+        upload = self.lines(("Flyer product 1", "9.99"))
+        upload.name = "flyer.csv"
+
+        response = self.client.post(
+            reverse('products.views.import_prices'), {'prices': upload})
+
+        self.assertContains(response, "Imported 1 of 1 rows")
+        self.assertEqual(
+            self.products[1].current_price(self.shop).value, Decimal("9.99"))
+
+
+class PriceCompactionTest(OurCase):
+
+    def setUp(self):
+
+        section = Section.objects.create(name="Drinks")
+        self.euro = Currency.objects.create(
+            name="Test euro", code="XEU", symbol="e")
+        self.shop = Shop.objects.create(name="Corner shop", description="")
+        self.product = Product.objects.create(
+            name="Juice", description="", section=section)
+
+    def create_prices(self, *history):
+
+        return [Price.objects.create(
+                    value=Decimal(value), currency=self.euro,
+                    shop=self.shop, product=self.product, since=since)
+                for since, value in history]
+
+    def test_merges_repeated_prices_but_referenced_ones(self):
+
+        now = timezone.now()
+        days = lambda count: now - datetime.timedelta(days=count)
+
+        prices = self.create_prices(
+            (days(10), "1.00"), (days(9), "1.00"), (days(8), "2.00"),
+            (days(7), "2.00"), (days(6), "2.00"), (days(5), "1.00"),
+            (days(4), "1.00"))
+
+        user = User.objects.create(username="buyer")
+        Purchase.objects.create(product_price=prices[3], payer=user)
+
+        compaction = PriceCompaction(policy=()).run()
+
+        self.assertEqual(compaction.merged, 3)
+        self.assertPricesetEqual(
+            Price.objects.filter(product=self.product),
+            [prices[0], prices[2], prices[3], prices[5]])
+
+        for day in range(4, 11):
+
+            self.assertEqual(
+                self.product.price_at(self.shop, days(day) +
+                                      datetime.timedelta(hours=1)).value,
+                prices[10 - day].value)
+
+        self.assertEqual(self.product.current_price(self.shop), prices[5])
+        self.assertEqual(
+            CurrentPrice.objects.get(
+                product=self.product, shop=self.shop).price, prices[5])
+
+    def test_keeps_last_price_of_old_periods(self):
+
+        at = lambda *date: datetime.datetime(*date, tzinfo=timezone.utc)
+
+        prices = self.create_prices(
+            (at(2013, 1, 5), "1.00"), (at(2013, 1, 20), "2.00"),
+            (at(2013, 2, 3), "3.00"), (at(2013, 6, 10), "4.00"),
+            (at(2013, 6, 12), "5.00"))
+
+        compaction = PriceCompaction(
+            policy=parse_policy("30:month"), now=at(2013, 6, 15)).run()
+
+        self.assertEqual(
+            (compaction.merged, compaction.downsampled), (0, 1))
+        self.assertPricesetEqual(
+            Price.objects.filter(product=self.product), prices[1:])
+
+    def test_periods_are_local_days(self):
+
+        at = lambda *date: datetime.datetime(*date, tzinfo=timezone.utc)
+
+        # Half past eleven UTC is already the next day an hour east.
+        with timezone.override(FixedOffset(60)):
+
+            prices = self.create_prices(
+                (at(2013, 1, 4, 22), "1.00"), (at(2013, 1, 4, 23, 30), "2.00"),
+                (at(2013, 1, 5, 12), "3.00"))
+
+            compaction = PriceCompaction(
+                policy=parse_policy("1:day"), now=at(2013, 2, 1)).run()
+
+        self.assertEqual(
+            (compaction.merged, compaction.downsampled), (0, 1))
+        self.assertPricesetEqual(
+            Price.objects.filter(product=self.product),
+            [prices[0], prices[2]])
+
+    def test_command_reports_removed_rows_and_bytes(self):
+
+        now = timezone.now()
+        self.create_prices(
+            *[(now - datetime.timedelta(hours=hours), "1.00")
+              for hours in range(50, 0, -1)])
+
+        output = StringIO()
+        call_command('compact_prices', dry_run=True, stdout=output)
+
+        self.assertIn("Would remove 49 of", output.getvalue())
+        self.assertEqual(
+            Price.objects.filter(product=self.product).count(), 50)
+
+        output = StringIO()
+        call_command('compact_prices', policy="1:day", stdout=output)
+
+        self.assertIn("Removed 49 of", output.getvalue())
+        self.assertIn("Freed", output.getvalue())
+        self.assertEqual(
+            Price.objects.filter(product=self.product).count(), 1)
+
+
+class ApiTest(OurCase):
+
+    def setUp(self):
+
+        section = Section.objects.create(name="Drinks")
+        self.euro = Currency.objects.create(
+            name="Test euro", code="XEU", symbol="e")
+        self.shops = [
+            Shop.objects.create(name="Shop %d" % i, description="")
+            for i in range(2)]
+        self.products = [
+            Product.objects.create(
+                name="Juice %d" % i, description="", section=section)
+            for i in range(3)]
+
+        for product in self.products:
+
+            for shop in self.shops:
+
+                product.change_current_price(shop, Decimal("1.50"), self.euro)
+
+    def test_prices_of_many_products_in_one_query(self):
+
+        with self.assertNumQueries(2):
+
+            response = self.client.get(
+                reverse('products.api.prices'),
+                {'products': ",".join(
+                    str(product.id) for product in self.products),
+                 'shop': self.shops[1].id})
+
+        prices = json.loads(response.content)['results']
+
+        self.assertEqual(
+            [(price['product'], price['shop'], price['currency'])
+             for price in prices],
+            [(product.id, self.shops[1].id, "XEU")
+             for product in self.products])
+
+    def test_prices_at_every_shop(self):
+
+        response = self.client.get(
+            reverse('products.api.prices'),
+            {'products': str(self.products[0].id)})
+
+        self.assertEqual(len(json.loads(response.content)['results']), 2)
+
+        response = self.client.get(
+            reverse('products.api.prices'), {'products': 'juice'})
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_field_selection_and_conditional_get(self):
+
+        url = reverse('products.api.shops')
+        response = self.client.get(url, {'fields': 'name'})
+
+        self.assertIn(
+            {'name': "Shop 0"}, json.loads(response.content)['results'])
+
+        response = self.client.get(
+            url, {'fields': 'name'}, HTTP_IF_NONE_MATCH=response['ETag'])
+
+        self.assertEqual(response.status_code, 304)
+
+
+class BasketTest(OurCase):
+
+    def setUp(self):
+
+        section = Section.objects.create(name="Groceries")
+        self.euro = Currency.objects.create(
+            name="Test euro", code="XEU", symbol="e")
+        self.other = Currency.objects.create(
+            name="Test pound", code="XPD", symbol="p")
+
+        self.shops = [
+            Shop.objects.create(name="Shop %d" % i, description="")
+            for i in range(3)]
+        self.products = [
+            Product.objects.create(
+                name="Item %d" % i, description="", section=section)
+            for i in range(4)]
+
+        # Shop 0 is cheap for bread, shop 1 for milk and shop 2 for
+        # everything on average, the last product is only sold in pounds.
+        for shop, values in zip(self.shops, [("1.00", "3.00", "2.00"),
+                                             ("3.00", "1.00", "2.00"),
+                                             ("1.50", "1.50", "1.50")]):
+
+            for product, value in zip(self.products, values):
+
+                product.change_current_price(shop, Decimal(value), self.euro)
+
+        self.products[3].change_current_price(
+            self.shops[0], Decimal("1.00"), self.other)
+
+    def items(self):
+
+        return [(product, 2) for product in self.products]
+
+    def test_buys_everything_where_cheapest_without_a_cap(self):
+
+        plan = basket.plan(self.items(), self.euro)
+
+        self.assertTrue(plan.exact)
+        self.assertEqual(plan.total, Decimal("7.00"))
+        self.assertEqual(plan.missing, [self.products[3].id])
+        self.assertEqual(
+            sorted(plan.shops), [shop.id for shop in self.shops])
+
+    def test_visits_at_most_the_given_number_of_shops(self):
+
+        plan = basket.plan(self.items(), self.euro, max_shops=1)
+
+        self.assertEqual(list(plan.shops), [self.shops[2].id])
+        self.assertEqual(plan.total, Decimal("9.00"))
+
+        plan = basket.plan(self.items(), self.euro, max_shops=2)
+
+        self.assertEqual(plan.total, Decimal("8.00"))
+
+    def test_costs_hold_unavailable_items_exactly(self):
+
+        matrix = basket.PriceMatrix(self.items(), self.other)
+
+        self.assertEqual(
+            list(matrix.costs[0]), [basket.UNAVAILABLE] * 3 + [200])
+        self.assertEqual(
+            basket._total(matrix.costs, [0]), 3 * basket.UNAVAILABLE + 200)
+
+    def test_heuristic_is_close_to_exact(self):
+
+        rng = random.Random(0)
+        costs = [array(basket.COST_TYPECODE,
+                       [rng.randint(50, 500) for item in range(30)])
+                 for shop in range(8)]
+
+        exact, optimal = basket.choose_shops(costs, 3)
+
+        limit = basket.EXACT_COMBINATIONS
+        basket.EXACT_COMBINATIONS = 0
+
+        try:
+
+            heuristic, heuristic_optimal = basket.choose_shops(costs, 3)
+
+        finally:
+
+            basket.EXACT_COMBINATIONS = limit
+
+        self.assertTrue(optimal)
+        self.assertFalse(heuristic_optimal)
+        self.assertEqual(len(heuristic), 3)
+        self.assertTrue(
+            basket._total(costs, heuristic) <=
+            basket._total(costs, exact) * 1.05)
+
+    def test_api(self):
+
+        response = self.client.get(
+            reverse('products.api.basket'),
+            {'items': ",".join("%d:2" % product.id
+                               for product in self.products),
+             'currency': "XEU",
+             'shops': 1})
+
+        plan = json.loads(response.content)
+
+        self.assertEqual(plan['total'], "9.00")
+        self.assertEqual(
+            [shop['shop'] for shop in plan['shops']], [self.shops[2].id])
+
+
+class ExchangeRateTest(OurCase):
+
+    def setUp(self):
+
+        self.euro = Currency.objects.create(
+            name="Test euro", code="XEU", symbol="e")
+        self.zloty = Currency.objects.create(
+            name="Test zloty", code="XZL", symbol="z")
+        self.pound = Currency.objects.create(
+            name="Test pound", code="XPD", symbol="p")
+
+        self.day = datetime.date(2014, 3, 1)
+
+        ExchangeRate.objects.create(
+            source=self.euro, target=self.zloty, rate=Decimal("4"),
+            day=self.day)
+        ExchangeRate.objects.create(
+            source=self.euro, target=self.zloty, rate=Decimal("5"),
+            day=self.day + datetime.timedelta(days=10))
+        ExchangeRate.objects.create(
+            source=self.pound, target=self.euro, rate=Decimal("1.25"),
+            day=self.day)
+
+    def tearDown(self):
+
+        # Rows rolled back at the end of a test send no signals.
+        exchange_rates.invalidate()
+
+    def test_latest_rate_on_or_before_the_day(self):
+
+        table = ExchangeRate.table()
+        later = self.day + datetime.timedelta(days=10)
+
+        self.assertEqual(
+            table.rate(self.euro, self.zloty, self.day), Decimal("4"))
+        self.assertEqual(
+            table.rate(self.euro, self.zloty, later - datetime.timedelta(1)),
+            Decimal("4"))
+        self.assertEqual(
+            table.rate(self.euro, self.zloty, later), Decimal("5"))
+        self.assertEqual(
+            table.rate(self.euro, self.euro, self.day), Decimal("1"))
+
+        with self.assertRaises(MissingRate):
+
+            table.rate(self.euro, self.zloty, self.day - datetime.timedelta(1))
+
+    def test_inverse_and_cross_rates(self):
+
+        table = ExchangeRate.table()
+
+        self.assertEqual(
+            table.convert(Decimal("8"), self.zloty, self.euro, self.day),
+            Decimal("2"))
+        self.assertEqual(
+            table.convert(Decimal("2"), self.pound, self.zloty, self.day),
+            Decimal("10"))
+
+        with self.assertRaises(MissingRate):
+
+            RateTable([]).rate(self.pound, self.zloty, self.day)
+
+    def test_table_is_loaded_once_and_dropped_on_changes(self):
+
+        ExchangeRate.table()
+
+        with self.assertNumQueries(0):
+
+            table = ExchangeRate.table()
+
+        ExchangeRate.objects.create(
+            source=self.euro, target=self.pound, rate=Decimal("0.5"),
+            day=self.day)
+
+        self.assertIsNot(ExchangeRate.table(), table)
+        self.assertEqual(
+            ExchangeRate.table().rate(self.euro, self.pound, self.day),
+            Decimal("0.5"))
+
+    def test_min_price_compares_converted_values(self):
+
+        section = Section.objects.create(name="Groceries")
+        product = Product.objects.create(
+            name="Cheese", description="", section=section)
+        shops = [Shop.objects.create(name="Shop %d" % i, description="")
+                 for i in range(3)]
+
+        when = timezone.make_aware(
+            datetime.datetime(2014, 3, 5, 12), timezone.utc)
+
+        prices = [
+            Price.objects.create(
+                value=Decimal(value), currency=currency, shop=shop,
+                product=product, since=when)
+            for shop, value, currency in [
+                (shops[0], "3.00", self.euro),
+                (shops[1], "12.00", self.zloty),
+                (shops[2], "2.00", self.pound)]]
+
+        ExchangeRate.table()
+
+        with self.assertNumQueries(1):
+
+            cheapest = product.min_price_at(when, self.euro)
+
+        self.assertEqual(cheapest, [prices[2]])
+        self.assertEqual(cheapest[0].compared_value, Decimal("2.50"))
+
+        self.assertEqual(
+            product.min_price_at(
+                when + datetime.timedelta(days=10), self.euro),
+            [prices[1]])
+
+        self.assertEqual(
+            product.min_price_at(when, self.zloty)[0].compared_value,
+            Decimal("10.00"))
+
+    def test_prices_without_a_rate_are_left_out(self):
+
+        section = Section.objects.create(name="Groceries")
+        product = Product.objects.create(
+            name="Cheese", description="", section=section)
+        dollar = Currency.objects.create(
+            name="Test dollar", code="XDL", symbol="d")
+
+        product.change_current_price(
+            Shop.objects.create(name="Here", description=""),
+            Decimal("5.00"), self.euro)
+        product.change_current_price(
+            Shop.objects.create(name="There", description=""),
+            Decimal("1.00"), dollar)
+
+        cheapest = product.min_current_price(self.euro)
+
+        self.assertEqual(
+            [price.value for price in cheapest], [Decimal("5.00")])
+
+    def test_table_expires_for_changes_made_elsewhere(self):
+
+        table = ExchangeRate.table()
+
+        # An update sends no signals, like a save in another process.
+        ExchangeRate.objects.filter(target=self.zloty).update(
+            rate=Decimal("3"))
+
+        self.assertIs(ExchangeRate.table(), table)
+
+        with override_settings(EXCHANGE_RATE_CACHE_SECONDS=0):
+
+            self.assertEqual(
+                ExchangeRate.table().rate(self.euro, self.zloty, self.day),
+                Decimal("3"))
+
+    def test_mixed_prices_need_a_known_base_currency(self):
+
+        section = Section.objects.create(name="Groceries")
+        product = Product.objects.create(
+            name="Cheese", description="", section=section)
+
+        for name, currency in [("Here", self.euro), ("There", self.zloty)]:
+
+            product.change_current_price(
+                Shop.objects.create(name=name, description=""),
+                Decimal("5.00"), currency)
+
+        with override_settings(BASE_CURRENCY='XXX'):
+
+            self.assertRaises(
+                ImproperlyConfigured, product.min_current_price)
+
+        with override_settings(BASE_CURRENCY='XEU'):
+
+            self.assertEqual(
+                [price.currency_id for price in product.min_current_price()],
+                [self.zloty.id])
@@ -13,4 +13,12 @@ urlpatterns = patterns(
     url(r'^product/add/(\d+)/$', 'add_product'),
     url(r'^product/show/(\d+)/$', 'show_product'),
 
-    url(r'^change_price/$', 'change_price'))
+    url(r'^change_price/$', 'change_price'),
+    url(r'^import_prices/$', 'import_prices'))
+
+urlpatterns += patterns(
+    'products.api',
+    url(r'^api/shops/$', 'shops'),
+    url(r'^api/products/$', 'products'),
+    url(r'^api/prices/$', 'prices'),
+    url(r'^api/basket/$', 'basket'))
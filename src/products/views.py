@@ -3,9 +3,11 @@
 from decimal import Decimal
 
 from django.core.context_processors import csrf
+from django.db import transaction
 from django.shortcuts import render_to_response
 
 from products.models import Shop, Currency, Product, Section
+from products.imports import PriceImport
 
 
 def add_shop(request):
@@ -167,3 +169,42 @@ def handle_change_price_form(request):
     return render_to_response(
         'products/price_changed.html',
         {'price': price})
+
+
+def import_prices(request):
+
+    if request.method == "GET":
+
+        return display_import_prices_form(request)
+
+    elif request.method == "POST":
+
+        return handle_import_prices_form(request)
+
+
+def display_import_prices_form(request):
+
+    ctx = csrf(request)
+    ctx['shops'] = Shop.objects.order_by('name')
+
+    return render_to_response(
+        'products/import_prices_form.html',
+        ctx)
+
+
+def handle_import_prices_form(request):
+
+    shop = None
+
+    if request.POST.get('shop_id'):
+
+        shop = Shop.objects.get(id=request.POST['shop_id'])
+
+    # The upload is read line by line rather than all at once.
+    with transaction.atomic():
+
+        result = PriceImport(shop).run(request.FILES['prices'])
+
+    return render_to_response(
+        'products/prices_imported.html',
+        {'result': result})
@@ -2,9 +2,10 @@
 
 from django.contrib import admin
 
-from purchases.models import Purchase, Benefit, Balance
+from purchases.models import Purchase, Benefit, Balance, ShoppingList
 
 
 admin.site.register(Purchase)
 admin.site.register(Benefit)
 admin.site.register(Balance)
+admin.site.register(ShoppingList)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+import json
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.views.decorators.csrf import csrf_exempt
+from django.utils.dateparse import parse_date
+
+from shiny_ninja.api import (
+    json_response, json_error, api_login_required, page_size)
+from products.models import Product, Shop, Currency
+from purchases.models import Purchase
+from purchases import exports
+
+
+def _listing(request, kind):
+    """A page of the user's rows of an export, see purchases.exports.
+
+    Pages are resumed with the 'after' id the previous page gives as
+    'next', and may be limited to dates with 'from' and 'to'.
+    """
+
+    try:
+
+        start = parse_date(request.GET.get('from', ''))
+        end = parse_date(request.GET.get('to', ''))
+
+    except ValueError:
+
+        return json_error(request, "Dates must be YYYY-MM-DD")
+
+    after = request.GET.get('after', '')
+    limit = page_size(request)
+
+    names, fields = zip(*exports.COLUMNS[kind])
+
+    rows = exports.rows(
+        exports.exported(kind, request.user, start, end), fields,
+        int(after) if after.isdigit() else 0, per_query=limit)
+
+    results = [dict(zip(names, row)) for row in islice(rows, limit)]
+
+    return json_response(
+        request,
+        {'results': results,
+         'next': results[-1]['id'] if len(results) == limit else None})
+
+
+# Clients authenticate with the session cookie but have no form to take
+# a CSRF token from. Only JSON bodies are accepted instead, which browsers
+# do not send across sites without a CORS preflight.
+@csrf_exempt
+@api_login_required
+def purchases(request):
+
+    if request.method == 'POST':
+
+        if request.META.get('CONTENT_TYPE', '').split(';')[0] != (
+                'application/json'):
+
+            return json_error(request, "Purchases must be sent as JSON", 415)
+
+        return _create_purchase(request)
+
+    return _listing(request, 'purchases')
+
+
+@api_login_required
+def benefits(request):
+
+    return _listing(request, 'benefits')
+
+
+@api_login_required
+def balances(request):
+
+    return _listing(request, 'balances')
+
+
+def _create_purchase(request):
+    """Creates a purchase and all its benefits from one JSON object.
+
+    The object names the product, shop, currency and price value as the
+    purchase form does, and optionally the amount, the date and the
+    beneficiaries as a list of {"user": id, "share": "1.5"}.
+    """
+
+    try:
+
+        data = json.loads(request.body)
+
+        product = Product.objects.get(id=data['product'])
+        shop = Shop.objects.get(id=data['shop'])
+        currency = Currency.objects.get(id=data['currency'])
+        value = Decimal(str(data['value']))
+        amount = Decimal(str(data.get('amount', 1)))
+
+        shares = [(int(beneficiary['user']),
+                   Decimal(str(beneficiary.get('share', 1))))
+                  for beneficiary in data.get('beneficiaries', [])]
+
+        date = None
+
+        if 'date' in data:
+
+            date = parse_date(data['date'])
+
+            if date is None:
+
+                raise ValueError("Dates must be YYYY-MM-DD")
+
+    except (ValueError, KeyError, TypeError, InvalidOperation,
+            Product.DoesNotExist, Shop.DoesNotExist, Currency.DoesNotExist):
+
+        return json_error(request, "Malformed purchase")
+
+    # Every share being positive also keeps the debts from being split
+    # by a zero sum.
+    if amount <= 0 or any(share <= 0 for user, share in shares):
+
+        return json_error(request, "Amounts and shares must be positive")
+
+    users = set(user for user, share in shares)
+
+    if User.objects.filter(id__in=users).count() != len(users):
+
+        return json_error(request, "Unknown beneficiary")
+
+    try:
+
+        with transaction.atomic():
+
+            price = product.current_price(shop)
+
+            if ((not price) or price.currency_id != currency.id or
+                    price.value != value):
+
+                product.change_current_price(shop, value, currency)
+
+                price = product.current_price(shop)
+
+            purchase = Purchase(
+                product_price=price, payer=request.user, amount=amount)
+
+            if date is not None:
+
+                purchase.date = date
+
+            purchase.save()
+            purchase.add_benefits(shares)
+
+    except ValidationError as error:
+
+        return json_error(request, u'; '.join(error.messages))
+
+    return json_response(
+        request,
+        {'id': purchase.id,
+         'price': price.id,
+         'amount': purchase.amount,
+         'date': purchase.date,
+         'benefits': list(
+             purchase.benefit_set.order_by('id').values(
+                 'id', 'beneficiary', 'share', 'debt'))},
+        status=201)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+import datetime
+from decimal import Decimal
+
+from django.db.models import Q
+
+from purchases.models import Purchase, Benefit, Balance, CENT
+
+
+ROWS_PER_QUERY = 1000
+
+# The columns of every export, each read from the given field. Every
+# export starts with the id, which is what resuming after a row needs.
+COLUMNS = {
+    'purchases': (
+        ('id', 'id'),
+        ('date', 'date'),
+        ('product', 'product_price__product__name'),
+        ('shop', 'product_price__shop__name'),
+        ('amount', 'amount'),
+        ('price', 'product_price__value'),
+        ('currency', 'product_price__currency__code')),
+    'benefits': (
+        ('id', 'id'),
+        ('purchase', 'purchase'),
+        ('date', 'purchase__date'),
+        ('payer', 'purchase__payer__username'),
+        ('beneficiary', 'beneficiary__username'),
+        ('share', 'share'),
+        ('debt', 'debt'),
+        ('currency', 'purchase__product_price__currency__code'),
+        ('paid_off', 'paid_off')),
+    'balances': (
+        ('id', 'id'),
+        ('first_user', 'first_user__username'),
+        ('second_user', 'second_user__username'),
+        ('currency', 'currency__code'),
+        ('first_owes_second', 'first_owes_second'),
+        ('second_owes_first', 'second_owes_first')),
+}
+
+FORMATS = ('csv', 'json')
+
+
+def exported(kind, user, start=None, end=None):
+    """Returns the queryset of what the user may export.
+
+    Purchases are those the user paid for, benefits those of the user
+    and of their purchases, balances those the user is part of. Only
+    purchases and benefits have a date to limit them by.
+    """
+
+    if kind == 'purchases':
+
+        rows = Purchase.objects.filter(payer=user)
+        date = 'date'
+
+    elif kind == 'benefits':
+
+        rows = Benefit.objects.filter(
+            Q(beneficiary=user) | Q(purchase__payer=user))
+        date = 'purchase__date'
+
+    elif kind == 'balances':
+
+        return Balance.objects.filter(
+            Q(first_user=user) | Q(second_user=user))
+
+    else:
+
+        raise ValueError("Unknown export: %s" % kind)
+
+    if start is not None:
+
+        rows = rows.filter(**{date + '__gte': start})
+
+    if end is not None:
+
+        rows = rows.filter(**{date + '__lte': end})
+
+    return rows
+
+
+def rows(queryset, fields, after=0, per_query=ROWS_PER_QUERY):
+    """Yields the values of fields of every row with id above after.
+
+    The rows are read by id in chunks of per_query, each chunk starting
+    after the last id of the previous one, so that only one chunk is
+    ever held in memory. The first field must be the id.
+    """
+
+    while True:
+
+        read = 0
+        for row in (queryset.
+                filter(id__gt=after).
+                order_by('id').
+                values_list(*fields)[:per_query].
+                iterator()):
+
+            read += 1
+            after = row[0]
+
+            yield row
+
+        if read < per_query:
+
+            break
+
+
+def as_csv(names, rows):
+
+    line = _Line()
+    writer = csv.writer(line)
+
+    writer.writerow(names)
+    yield line.pop()
+
+    for row in rows:
+
+        writer.writerow([_text(value).encode('utf-8') for value in row])
+        yield line.pop()
+
+
+def as_json(names, rows):
+
+    yield '['
+
+    separator = '\n'
+    for row in rows:
+
+        yield separator + json.dumps(
+            dict(zip(names, [value if isinstance(value, (bool, int, long))
+                             else _text(value) for value in row])))
+        separator = ',\n'
+
+    yield '\n]\n'
+
+
+def _text(value):
+
+    if isinstance(value, datetime.date):
+
+        return value.isoformat()
+
+    # Every amount has two decimal places, which SQLite does not keep.
+    if isinstance(value, Decimal):
+
+        return unicode(value.quantize(CENT))
+
+    return unicode(value)
+
+
+class _Line(object):
+    """A file for the csv writer, remembering only the last line."""
+
+    def __init__(self):
+
+        self.written = []
+
+    def write(self, text):
+
+        self.written.append(text)
+
+    def pop(self):
+
+        line, self.written = ''.join(self.written), []
+
+        return line
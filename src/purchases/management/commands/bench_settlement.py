@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import random
+from decimal import Decimal
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.contrib.auth.models import User
+
+from products.models import Currency
+from purchases.models import Balance
+from purchases import settlement
+from shiny_ninja.benchmark import scratch_database, timings, percentile
+
+
+class Command(NoArgsCommand):
+
+    help = ("Measures settlement planning for groups of users. Runs "
+            "against a scratch test database.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option(
+            '--sizes', default='10,100,1000',
+            help="Comma separated group sizes."),
+        make_option(
+            '--counterparties', type='int', default=10,
+            help="Number of balances every user has with others."),
+        make_option(
+            '--repeat', type='int', default=20,
+            help="Number of timed runs per group size."),
+        make_option(
+            '--seed', type='int', default=0,
+            help="Seed for the balance generator."))
+
+    def handle_noargs(self, **options):
+
+        rng = random.Random(options['seed'])
+
+        with scratch_database():
+
+            self.stdout.write("%8s %10s %12s %12s %12s" % (
+                "users", "balances", "transfers", "median ms", "exact ms"))
+
+            sizes = [int(size) for size in options['sizes'].split(',')]
+
+            for index, size in enumerate(sizes):
+
+                currency = self.make_group(
+                    index, size, options['counterparties'], rng)
+
+                def greedy():
+
+                    return settlement.plan(
+                        settlement.net_positions(currency))
+
+                transfers = greedy()
+                results = timings(greedy, [()] * options['repeat'])
+
+                exact = '-'
+                if size <= settlement.EXACT_LIMIT:
+
+                    exact = "%12.2f" % (percentile(timings(
+                        lambda: settlement.plan(
+                            settlement.net_positions(currency), exact=True),
+                        [()] * options['repeat']), 0.5) * 1e3)
+
+                self.stdout.write("%8d %10d %12d %12.2f %12s" % (
+                    size,
+                    Balance.objects.filter(currency=currency).count(),
+                    len(transfers),
+                    percentile(results, 0.5) * 1e3,
+                    exact))
+
+    def make_group(self, index, size, counterparties, rng):
+
+        currency = Currency.objects.create(
+            name="Group of %d" % size, code="G%02d" % index, symbol="G")
+
+        User.objects.bulk_create(
+            User(username="bench-%d-%d" % (index, i)) for i in range(size))
+        users = list(
+            User.objects.filter(
+                username__startswith="bench-%d-" % index).
+            values_list('id', flat=True))
+
+        pairs = set()
+        for user in users:
+
+            for other in rng.sample(users, min(counterparties, size)):
+
+                if user != other:
+
+                    pairs.add((min(user, other), max(user, other)))
+
+        Balance.objects.bulk_create(
+            Balance(currency=currency, first_user_id=first,
+                    second_user_id=second,
+                    first_owes_second=Decimal(rng.randint(0, 9999)) / 100,
+                    second_owes_first=Decimal(rng.randint(0, 9999)) / 100)
+            for first, second in pairs)
+
+        return currency
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db.models import F
+from django.test.client import RequestFactory
+
+from products.models import Price
+from purchases.models import Purchase, Benefit, Balance
+from purchases.synthetic import SyntheticData
+from purchases import views
+from shiny_ninja.benchmark import scratch_database, measure, regressions
+
+
+class Command(NoArgsCommand):
+
+    help = ("Times the main paths through prices, purchases and balances "
+            "on a seeded synthetic data set and writes the results as "
+            "JSON. Runs against a scratch test database.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option(
+            '--users', type='int', default=50,
+            help="Number of users."),
+        make_option(
+            '--shops', type='int', default=10,
+            help="Number of shops."),
+        make_option(
+            '--products', type='int', default=100,
+            help="Number of products, each sold at every shop."),
+        make_option(
+            '--history', type='int', default=20,
+            help="Number of prices of every product at every shop."),
+        make_option(
+            '--purchases', type='int', default=10000,
+            help="Number of purchases."),
+        make_option(
+            '--beneficiaries', type='int', default=5,
+            help="Most beneficiaries of a purchase."),
+        make_option(
+            '--days', type='int', default=365,
+            help="Number of days the prices and purchases are spread over."),
+        make_option(
+            '--calls', type='int', default=200,
+            help="Number of timed calls of every path. add_benefit and "
+                 "settle_debts change the data they are timed on, so only "
+                 "runs with the same number of calls compare."),
+        make_option(
+            '--seed', type='int', default=0,
+            help="Seed for the data and call generators."),
+        make_option(
+            '--output', default='-',
+            help="File to write the JSON results to, - for stdout."),
+        make_option(
+            '--baseline',
+            help="Results of an earlier run to check for regressions."),
+        make_option(
+            '--tolerance', type='float', default=0.25,
+            help="How much slower than the baseline a median may get."))
+
+    def handle_noargs(self, **options):
+
+        baseline = None
+
+        if options['baseline']:
+
+            with open(options['baseline']) as baseline_file:
+
+                baseline = json.load(baseline_file)
+
+        data = SyntheticData(
+            users=options['users'], shops=options['shops'],
+            products=options['products'], history=options['history'],
+            purchases=options['purchases'],
+            beneficiaries=options['beneficiaries'], days=options['days'],
+            seed=options['seed'])
+
+        with scratch_database():
+
+            start = time.time()
+            data.create()
+            setup_seconds = time.time() - start
+
+            rows = dict(
+                (model._meta.db_table, model.objects.count())
+                for model in [Price, Purchase, Benefit, Balance])
+
+            results = self.run(data, options['calls'])
+
+        report = {'seed': options['seed'],
+                  'sizes': data.sizes,
+                  'rows': rows,
+                  'setup_seconds': setup_seconds,
+                  'results': results}
+
+        text = json.dumps(report, indent=2, sort_keys=True)
+
+        if options['output'] == '-':
+
+            self.stdout.write(text)
+
+        else:
+
+            with open(options['output'], 'w') as output:
+
+                output.write(text + "\n")
+
+        if baseline is not None:
+
+            found = regressions(
+                results, baseline['results'], options['tolerance'])
+
+            if found:
+
+                raise CommandError(
+                    "Slower than the baseline:\n%s" % "\n".join(found))
+
+    def run(self, data, calls):
+
+        rng = data.rng
+        factory = RequestFactory()
+
+        def request(view, user):
+
+            request = factory.get(reverse(view))
+            request.user = user
+
+            return request
+
+        def pick(choices):
+
+            return [rng.choice(choices) for i in range(calls)]
+
+        results = {}
+
+        results['price_at'] = measure(
+            lambda product, shop, day: product.price_at(shop, day),
+            [(rng.choice(data.products), rng.choice(data.shops),
+              data.random_instant()) for i in range(calls)])
+
+        results['min_price_at'] = measure(
+            lambda product, day: product.min_price_at(day),
+            [(rng.choice(data.products), data.random_instant())
+             for i in range(calls)])
+
+        results['show_balances'] = measure(
+            views.show_balances,
+            [(request(views.show_balances, user),)
+             for user in pick(data.users)])
+
+        results['list_purchases'] = measure(
+            views.list_purchases,
+            [(request(views.list_purchases, user),)
+             for user in pick(data.users)])
+
+        ids = sorted(rng.sample(
+            list(Purchase.objects.order_by('id').values_list('id', flat=True)),
+            min(calls, data.sizes['purchases'])))
+        purchases = Purchase.objects.in_bulk(ids)
+
+        results['add_benefit'] = measure(
+            lambda purchase, user: purchase.add_benefit(user, 1),
+            [(purchases[purchase], rng.choice(data.users))
+             for purchase in ids])
+
+        # Every call settles the debts between another payer and
+        # beneficiary, so none of them finds nothing left to settle.
+        pairs = sorted(
+            Benefit.objects.filter(paid_off=False).
+            exclude(beneficiary=F('purchase__payer')).
+            values_list('purchase__payer', 'beneficiary').distinct())
+
+        results['settle_debts'] = measure(
+            lambda payer, beneficiary: Purchase.settle_debts(
+                Benefit.objects.filter(
+                    purchase__payer=payer, beneficiary=beneficiary)),
+            rng.sample(pairs, min(calls, len(pairs))))
+
+        return results
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from django.db.models import Max
+
+from purchases.models import Balance, BalanceEntry, BalanceSnapshot
+
+
+class Command(NoArgsCommand):
+
+    help = ("Folds the balance ledger into snapshots, so that balances can "
+            "be read from a snapshot and the few entries after it.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option(
+            '--batch-size', type='int', default=500,
+            help="Number of balances compacted per transaction."),)
+
+    def handle_noargs(self, **options):
+
+        batch_size = options['batch_size']
+
+        # Entries appended while compacting are left for the next run.
+        up_to = BalanceEntry.objects.aggregate(last=Max('id'))['last'] or 0
+
+        last_id = 0
+        compacted = 0
+        while True:
+
+            ids = list(
+                Balance.objects.
+                filter(id__gt=last_id).
+                order_by('id').
+                values_list('id', flat=True)[:batch_size])
+
+            if not ids:
+
+                break
+
+            with transaction.atomic():
+
+                compacted += self.compact(ids, up_to)
+
+            last_id = ids[-1]
+
+        self.stdout.write(
+            "Took %d balances up to ledger entry %d." % (compacted, up_to))
+
+    def compact(self, ids, up_to):
+
+        snapshotted = dict(
+            BalanceSnapshot.objects.
+            filter(balance__in=ids).
+            values_list('balance').
+            annotate(last=Max('last_entry')))
+
+        snapshots = [
+            BalanceSnapshot(
+                balance_id=balance_id,
+                last_entry=last,
+                first_owes_second=first_owes_second,
+                second_owes_first=second_owes_first)
+            for balance_id, (first_owes_second, second_owes_first, last)
+            in BalanceEntry.totals(ids, up_to=up_to).items()
+            if last > snapshotted.get(balance_id, 0)]
+
+        if not snapshots:
+
+            return 0
+
+        BalanceSnapshot.objects.bulk_create(snapshots)
+
+        # Only the latest snapshot of a balance is ever read.
+        table = connection.ops.quote_name(BalanceSnapshot._meta.db_table)
+        (BalanceSnapshot.objects.
+            filter(balance__in=[snapshot.balance_id for snapshot in snapshots]).
+            extra(where=[
+                "%s.last_entry < (SELECT MAX(latest.last_entry) FROM %s latest "
+                "WHERE latest.balance_id = %s.balance_id)" % (
+                    table, table, table)]).
+            delete())
+
+        return len(snapshots)
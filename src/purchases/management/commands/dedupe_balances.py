@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction, DatabaseError
+from django.db.models import Count
+
+from purchases.models import Balance, BalanceEntry
+
+
+class Command(NoArgsCommand):
+
+    help = ("Merges duplicate balances and adds the unique constraint on "
+            "(first_user, second_user, currency) to databases created "
+            "before it was declared.")
+
+    def handle_noargs(self, **options):
+
+        with transaction.atomic():
+
+            merged = self.merge_duplicates()
+
+        qn = connection.ops.quote_name
+
+        try:
+
+            with transaction.atomic():
+
+                connection.cursor().execute(
+                    "CREATE UNIQUE INDEX %s ON %s (%s, %s, %s)" % (
+                        qn('purchases_balance_pair_currency_uniq'),
+                        qn(Balance._meta.db_table),
+                        qn('first_user_id'),
+                        qn('second_user_id'),
+                        qn('currency_id')))
+
+        except DatabaseError:
+
+            # The constraint is already there.
+            pass
+
+        self.stdout.write("Merged %d duplicate balances." % merged)
+
+    def merge_duplicates(self):
+
+        duplicated = (Balance.objects.
+            values('first_user', 'second_user', 'currency').
+            annotate(count=Count('id')).
+            filter(count__gt=1))
+
+        merged = 0
+        for pair in duplicated:
+
+            balances = list(
+                Balance.objects.filter(
+                    first_user=pair['first_user'],
+                    second_user=pair['second_user'],
+                    currency=pair['currency']).order_by('id'))
+
+            kept = balances[0]
+
+            for duplicate in balances[1:]:
+
+                kept.first_owes_second += duplicate.first_owes_second
+                kept.second_owes_first += duplicate.second_owes_first
+
+            kept.save()
+
+            # The ledgers of the duplicates go away with them.
+            BalanceEntry.record([(
+                kept,
+                sum(duplicate.first_owes_second
+                    for duplicate in balances[1:]),
+                sum(duplicate.second_owes_first
+                    for duplicate in balances[1:]))])
+
+            Balance.objects.filter(
+                id__in=[balance.id for balance in balances[1:]]).delete()
+
+            merged += len(balances) - 1
+
+        return merged
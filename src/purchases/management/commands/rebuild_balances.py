@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+from array import array
+from itertools import islice
+from decimal import Decimal
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from products.models import Price
+from purchases.models import (
+    Purchase, Benefit, Balance, BalanceEntry, bulk_update, to_cents)
+
+
+class Command(NoArgsCommand):
+
+    help = ("Recomputes every balance from the unpaid benefits and "
+            "rewrites the balances which drifted.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option(
+            '--chunk-size', type='int', default=10000,
+            help="Number of rows fetched and written at a time."),
+        make_option(
+            '--dry-run', action='store_true', default=False,
+            help="Only list the balances which would change."),)
+
+    def handle_noargs(self, **options):
+
+        chunk_size = options['chunk_size']
+
+        with transaction.atomic():
+
+            slots, owed = self.accumulate(chunk_size)
+            changed, missing = self.compare(slots, owed)
+
+            for balance_id, key, old, new in changed:
+
+                self.stdout.write(
+                    "Balance %d (%d and %d in currency %d): "
+                    "%.2f / %.2f -> %.2f / %.2f" % (
+                        (balance_id,) + key +
+                        tuple(_amount(cents) for cents in old + new)))
+
+            for key, new in missing:
+
+                self.stdout.write(
+                    "Missing balance (%d and %d in currency %d): "
+                    "%.2f / %.2f" % (
+                        key + tuple(_amount(cents) for cents in new)))
+
+            if not options['dry_run']:
+
+                self.rewrite(changed, missing, chunk_size)
+
+        self.stdout.write(
+            "%s %d balances and %d missing ones." % (
+                "Would fix" if options['dry_run'] else "Fixed",
+                len(changed), len(missing)))
+
+    def accumulate(self, chunk_size):
+        """Sums the unpaid debts up per balance, in cents.
+
+        Returns the slots of the balances, keyed by (first user, second
+        user, currency), in an array holding the first_owes_second and
+        second_owes_first of every balance one after another.
+        """
+
+        qn = connection.ops.quote_name
+
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT purchase.payer_id, benefit.beneficiary_id, "
+            "price.currency_id, CAST(ROUND(benefit.debt * 100) AS BIGINT) "
+            "FROM %s benefit "
+            "JOIN %s purchase ON purchase.id = benefit.purchase_id "
+            "JOIN %s price ON price.id = purchase.product_price_id "
+            "WHERE benefit.paid_off = %%s" % (
+                qn(Benefit._meta.db_table),
+                qn(Purchase._meta.db_table),
+                qn(Price._meta.db_table)),
+            [False])
+
+        slots = {}
+        owed = array('l')
+
+        while True:
+
+            rows = cursor.fetchmany(chunk_size)
+
+            if not rows:
+
+                break
+
+            # Debts are summed up in cents, as plain integers.
+            for payer, beneficiary, currency, debt in rows:
+
+                key = (min(payer, beneficiary), max(payer, beneficiary),
+                       currency)
+
+                slot = slots.get(key)
+
+                if slot is None:
+
+                    slot = slots[key] = len(owed)
+                    owed.extend((0, 0))
+
+                # The beneficiary owes the payer, see Balance.column_of.
+                if beneficiary == key[0]:
+
+                    owed[slot] += debt
+
+                else:
+
+                    owed[slot + 1] += debt
+
+        return slots, owed
+
+    def compare(self, slots, owed):
+        """Returns the balances which differ from the debts, and the
+        balances missing altogether.
+
+        Changed balances are (id, key, old, new) and missing ones
+        (key, new), with old and new amounts as pairs of cents.
+        """
+
+        changed = []
+        seen = set()
+
+        balances = (Balance.objects.
+            order_by('id').
+            values_list(
+                'id', 'first_user', 'second_user', 'currency',
+                'first_owes_second', 'second_owes_first'))
+
+        for balance in balances.iterator():
+
+            key = balance[1:4]
+            old = (to_cents(balance[4]), to_cents(balance[5]))
+
+            # Duplicates from before the unique constraint get nothing.
+            if key in slots and key not in seen:
+
+                new = (owed[slots[key]], owed[slots[key] + 1])
+
+            else:
+
+                new = (0, 0)
+
+            seen.add(key)
+
+            if old != new:
+
+                changed.append((balance[0], key, old, new))
+
+        missing = [
+            (key, (owed[slot], owed[slot + 1]))
+            for key, slot in slots.items()
+            if key not in seen and (owed[slot] or owed[slot + 1])]
+
+        return changed, missing
+
+    def rewrite(self, changed, missing, chunk_size):
+
+        for column, index in (('first_owes_second', 0),
+                              ('second_owes_first', 1)):
+
+            bulk_update(
+                Balance, column,
+                dict((balance_id, _amount(new[index]))
+                     for balance_id, key, old, new in changed
+                     if old[index] != new[index]))
+
+        last_id = max([0] + list(
+            Balance.objects.order_by('-id').values_list('id', flat=True)[:1]))
+
+        _insert(
+            Balance,
+            ('first_user', 'second_user', 'currency',
+             'first_owes_second', 'second_owes_first'),
+            (key + (_text(new[0]), _text(new[1])) for key, new in missing),
+            chunk_size)
+
+        # The ledger is brought to the new amounts. Created balances are
+        # read back for their ids and have no ledger yet.
+        created = dict(
+            (key, balance_id) for balance_id, key in
+            ((row[0], row[1:]) for row in
+             Balance.objects.
+             filter(id__gt=last_id).
+             values_list('id', 'first_user', 'second_user', 'currency').
+             iterator()))
+
+        entries = [(created[key], new) for key, new in missing]
+
+        for start in range(0, len(changed), chunk_size):
+
+            chunk = changed[start:start + chunk_size]
+            totals = BalanceEntry.totals(
+                balance_id for balance_id, key, old, new in chunk)
+
+            entries.extend(
+                (balance_id,
+                 (new[0] - to_cents(totals[balance_id][0]),
+                  new[1] - to_cents(totals[balance_id][1])))
+                for balance_id, key, old, new in chunk)
+
+        now = connection.ops.value_to_db_datetime(timezone.now())
+
+        _insert(
+            BalanceEntry,
+            ('balance', 'first_owes_second', 'second_owes_first', 'created'),
+            ((balance_id, _text(delta[0]), _text(delta[1]), now)
+             for balance_id, delta in entries if delta != (0, 0)),
+            chunk_size)
+
+
+def _insert(model, fields, rows, chunk_size):
+
+    # Amounts are already formatted, so that going through Decimal for
+    # every one of possibly millions of values is avoided.
+    qn = connection.ops.quote_name
+    columns = [model._meta.get_field(field).column for field in fields]
+
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table),
+        ", ".join(qn(column) for column in columns),
+        ", ".join(["%s"] * len(columns)))
+
+    cursor = connection.cursor()
+    rows = iter(rows)
+
+    while True:
+
+        chunk = list(islice(rows, chunk_size))
+
+        if not chunk:
+
+            break
+
+        cursor.executemany(sql, chunk)
+
+
+def _text(cents):
+
+    return '%s%d.%02d' % (
+        '-' if cents < 0 else '', abs(cents) // 100, abs(cents) % 100)
+
+
+def _amount(cents):
+
+    return Decimal(cents).scaleb(-2)
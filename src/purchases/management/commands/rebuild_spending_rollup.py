@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from purchases.models import Purchase, Benefit, DailySpending
+
+
+class Command(NoArgsCommand):
+
+    help = "Rebuilds the daily spending rollup from all purchases."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option(
+            '--chunk-size', type='int', default=1000,
+            help="Number of purchases read per query."),)
+
+    def handle_noargs(self, **options):
+
+        chunk_size = options['chunk_size']
+        totals = {}
+
+        last_id = 0
+        read = 0
+        while True:
+
+            # Keyset pagination keeps every chunk as cheap as the first.
+            purchases = list(
+                Purchase.objects.
+                filter(id__gt=last_id).
+                select_related('product_price__product').
+                order_by('id')[:chunk_size])
+
+            if not purchases:
+
+                break
+
+            debts = {}
+            for purchase_id, beneficiary, debt in (Benefit.objects.
+                    filter(purchase__in=purchases).
+                    values_list('purchase', 'beneficiary', 'debt')):
+
+                of_purchase = debts.setdefault(purchase_id, {})
+                of_purchase[beneficiary] = (
+                    of_purchase.get(beneficiary, 0) + debt)
+
+            for purchase in purchases:
+
+                spending = purchase.spending(debts.get(purchase.id, {}))
+
+                for key, (paid, consumed) in spending.items():
+
+                    old_paid, old_consumed = totals.get(key, (0, 0))
+                    totals[key] = (old_paid + paid, old_consumed + consumed)
+
+            last_id = purchases[-1].id
+            read += len(purchases)
+
+        with transaction.atomic():
+
+            DailySpending.objects.all().delete()
+
+            rows = [
+                DailySpending(
+                    user_id=user, currency_id=currency, day=day,
+                    section_id=section, paid=paid, consumed=consumed)
+                for (user, currency, day, section), (paid, consumed)
+                in totals.items()]
+
+            for start in range(0, len(rows), chunk_size):
+
+                DailySpending.objects.bulk_create(
+                    rows[start:start + chunk_size])
+
+        self.stdout.write(
+            "Rolled %d purchases up into %d daily rows." % (
+                read, len(totals)))
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import transaction
+
+from purchases.models import Balance, BalanceEntry
+
+
+class Command(NoArgsCommand):
+
+    help = "Checks every balance against the sum of its ledger."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option(
+            '--batch-size', type='int', default=500,
+            help="Number of balances checked per query."),
+        make_option(
+            '--repair', action='store_true', default=False,
+            help="Append ledger entries making up for the differences, "
+                 "e.g. the opening entries of balances older than the "
+                 "ledger."),)
+
+    def handle_noargs(self, **options):
+
+        batch_size = options['batch_size']
+
+        last_id = 0
+        checked = 0
+        wrong = 0
+        while True:
+
+            # Each batch is read in one transaction, so that the balances
+            # and their ledger are seen at the same moment.
+            with transaction.atomic():
+
+                balances = list(
+                    Balance.objects.
+                    filter(id__gt=last_id).
+                    order_by('id').
+                    values_list(
+                        'id', 'first_owes_second', 'second_owes_first')[
+                            :batch_size])
+
+                if not balances:
+
+                    break
+
+                totals = BalanceEntry.totals(
+                    balance_id for balance_id, _, _ in balances)
+
+                corrections = []
+                for balance_id, first_owes_second, second_owes_first in \
+                        balances:
+
+                    in_ledger = totals[balance_id]
+
+                    if (first_owes_second, second_owes_first) == \
+                            in_ledger[:2]:
+
+                        continue
+
+                    self.stdout.write(
+                        "Balance %d is %.2f / %.2f, its ledger %.2f / %.2f." % (
+                            balance_id,
+                            first_owes_second, second_owes_first,
+                            in_ledger[0], in_ledger[1]))
+
+                    corrections.append((
+                        balance_id,
+                        first_owes_second - in_ledger[0],
+                        second_owes_first - in_ledger[1]))
+
+                if options['repair']:
+
+                    BalanceEntry.record(corrections)
+
+            checked += len(balances)
+            wrong += len(corrections)
+            last_id = balances[-1][0]
+
+        if wrong and not options['repair']:
+
+            raise CommandError(
+                "%d of %d balances disagree with the ledger." % (
+                    wrong, checked))
+
+        self.stdout.write(
+            "Checked %d balances, %d %s." % (
+                checked, wrong,
+                "repaired" if options['repair'] else "disagreed"))
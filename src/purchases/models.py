@@ -1,14 +1,133 @@
 # -*- coding: utf-8 -*-
+import datetime
+import threading
 from decimal import Decimal
+from collections import OrderedDict
+from contextlib import contextmanager
 
-from django.db import models
-from django.db.models.aggregates import Sum
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import Q
 from django.utils import timezone
 from django.contrib.auth.models import User
-from django.db.models.signals import pre_delete
+from django.db.models.signals import (
+    pre_delete, pre_save, post_save, post_delete)
 from django.dispatch import receiver
 
-from products.models import Price, Currency
+from products.models import (
+    Price, CurrentPrice, Currency, Section, Shop, Product, ExchangeRate,
+    prices_appended)
+from products.rates import MissingRate
+
+
+CENT = Decimal('0.01')
+
+# Each row updated by bulk_update costs three query parameters, which
+# must stay under SQLite's limit of 999.
+ROWS_PER_UPDATE = 300
+
+
+def _id_of(obj):
+
+    return getattr(obj, 'id', obj)
+
+
+def _to_decimal(value):
+
+    # SQLite hands decimal arithmetic back as floats.
+    if isinstance(value, Decimal):
+
+        return value
+
+    return Decimal(repr(value))
+
+
+def to_cents(value):
+
+    return int((Decimal(str(value)) * 100).to_integral_value())
+
+
+_memo = threading.local()
+
+
+@contextmanager
+def balance_memo():
+    """Remembers every balance looked up within the enclosed block.
+
+    Nested blocks share the outermost memo.
+    """
+
+    outermost = getattr(_memo, 'balances', None) is None
+
+    if outermost:
+
+        _memo.balances = {}
+
+    try:
+
+        yield
+
+    finally:
+
+        if outermost:
+
+            _memo.balances = None
+
+
+def _memoized_balances():
+
+    return getattr(_memo, 'balances', None)
+
+
+def bulk_update(model, field_name, values, increment=False):
+    """Sets, or increments, one column of many rows by primary key.
+
+    values maps primary keys to new values (or increments), and every
+    chunk of rows is written with a single CASE based UPDATE.
+    """
+
+    qn = connection.ops.quote_name
+
+    field = model._meta.get_field(field_name)
+    column = qn(field.column)
+    pk = qn(model._meta.pk.column)
+
+    values = list(values.items())
+
+    for start in range(0, len(values), ROWS_PER_UPDATE):
+
+        chunk = values[start:start + ROWS_PER_UPDATE]
+
+        params = []
+        for key, value in chunk:
+
+            params.extend([key, field.get_db_prep_save(value, connection)])
+
+        params.extend(key for key, value in chunk)
+
+        new_value = "CASE %s %s END" % (
+            pk, " ".join(
+                ["WHEN %%s THEN CAST(%%s AS %s)" % field.db_type(connection)]
+                * len(chunk)))
+
+        if increment:
+
+            new_value = "%s + %s" % (column, new_value)
+
+        connection.cursor().execute(
+            "UPDATE %s SET %s = %s WHERE %s IN (%s)" % (
+                qn(model._meta.db_table), column, new_value,
+                pk, ", ".join(["%s"] * len(chunk))),
+            params)
+
+
+def _update_in_chunks(model, ids, **values):
+
+    ids = list(ids)
+
+    for start in range(0, len(ids), ROWS_PER_UPDATE):
+
+        model.objects.filter(
+            id__in=ids[start:start + ROWS_PER_UPDATE]).update(**values)
 
 
 class Purchase(models.Model):
@@ -38,83 +157,194 @@ class Purchase(models.Model):
         return Benefit.objects.filter(
             purchase=self)
 
+    def debts(self):
+
+        debts = {}
+        for beneficiary, debt in self.benefit_set.values_list(
+                'beneficiary', 'debt'):
+
+            debts[beneficiary] = debts.get(beneficiary, 0) + debt
+
+        return debts
+
+    def spending(self, debts):
+        """Returns what this purchase adds to the daily spending rollup.
+
+        The payer paid the whole cost, which the beneficiaries consumed
+        according to their debts. Without any beneficiaries the payer
+        consumed it all.
+        """
+
+        price = self.product_price
+        cost = self.amount * price.value
+
+        day = Purchase._meta.get_field('date').to_python(self.date)
+        section = price.product.section_id
+
+        def key(user):
+
+            return (user, price.currency_id, day, section)
+
+        spending = {key(self.payer_id): (cost, 0)}
+
+        for user, debt in (debts.items() or [(self.payer_id, cost)]):
+
+            paid, consumed = spending.get(key(user), (0, 0))
+            spending[key(user)] = (paid, consumed + debt)
+
+        return spending
+
     def add_benefit(self, who, how_much):
 
-        if self.no_debt_paid_off:
+        self.add_benefits([(who, how_much)])
 
-            cost = self.amount * self.product_price.value
+    @transaction.atomic
+    def add_benefits(self, shares):
+        """Adds a benefit for every (who, how_much) pair at once.
 
-            for benefit in self.benefit_set.all():
+        Debts are split anew between all the benefits of the purchase,
+        and the balances are charged the differences.
+        """
 
-                balance = Balance.balance_between(
-                    self.payer, benefit.beneficiary, self.product_price.currency)
+        shares = list(shares)
 
-                balance.charge(
-                    benefit.beneficiary, -benefit.debt)
+        if self.no_debt_paid_off and shares:
 
-            Benefit.objects.create(
-                beneficiary=who,
-                purchase=self,
-                share=how_much)
+            # spending() needs the product's section too.
+            price = self.product_price = Price.objects.select_related(
+                'product').get(id=self.product_price_id)
+            cost = self.amount * price.value
 
-            share_sum = self.benefit_set.aggregate(Sum('share'))['share__sum']
-            biggest_share_benefit = self.benefit_set.order_by('-share')[0]
+            benefits = list(self.benefit_set.all())
 
-            for benefit in self.benefit_set.order_by('share'):
+            old_debts = {}
+            for benefit in benefits:
 
+                old_debts[benefit.beneficiary_id] = (
+                    old_debts.get(benefit.beneficiary_id, 0) + benefit.debt)
 
-                benefit.debt = cost * benefit.share / share_sum
+            share_field = Benefit._meta.get_field('share')
 
-                benefit.save()
+            added = [
+                Benefit(beneficiary_id=_id_of(who),
+                        purchase=self,
+                        share=share_field.to_python(how_much))
+                for who, how_much in shares]
 
+            benefits.extend(added)
 
-            debt_sum = Benefit.objects.filter(purchase=self).aggregate(Sum('debt'))['debt__sum']
+            share_sum = sum(benefit.share for benefit in benefits)
 
-            rest = cost - debt_sum
+            for benefit in benefits:
 
-            biggest_share_benefit.debt = models.F('debt') + rest
-            biggest_share_benefit.save()
+                benefit.debt = (
+                    cost * benefit.share / share_sum).quantize(CENT)
 
-            for benefit in self.benefit_set.all():
+            # Whatever got lost to rounding is charged to the biggest
+            # share.
+            biggest_share_benefit = max(
+                benefits, key=lambda benefit: benefit.share)
+            biggest_share_benefit.debt += cost - sum(
+                benefit.debt for benefit in benefits)
 
-                balance = Balance.balance_between(
-                    self.payer,
-                    benefit.beneficiary,
-                    self.product_price.currency)
+            bulk_update(
+                Benefit, 'debt',
+                dict((benefit.id, benefit.debt)
+                     for benefit in benefits if benefit.id is not None))
 
-                balance.charge(benefit.beneficiary, benefit.debt)
+            # New benefits are inserted with their debts already split.
+            Benefit.objects.bulk_create(added)
+
+            new_debts = {}
+            for benefit in benefits:
+
+                new_debts[benefit.beneficiary_id] = (
+                    new_debts.get(benefit.beneficiary_id, 0) + benefit.debt)
+
+            balances = Balance.balances_with(
+                self.payer_id, new_debts.keys(), price.currency_id)
+
+            Balance.charge_many(
+                (balances[user], user, debt - old_debts.get(user, 0))
+                for user, debt in new_debts.items())
+
+            DailySpending.add(
+                self.spending(new_debts), self.spending(old_debts))
 
     def settle_debt(self, benefit):
 
         if not benefit.paid_off:
 
-            balance = Balance.balance_between(
-                self.payer, benefit.beneficiary, benefit.purchase.product_price.currency)
+            Purchase.settle_debts(Benefit.objects.filter(id=benefit.id))
+
+            benefit.paid_off = True
+            self.no_debt_paid_off = False
+
+    @classmethod
+    @transaction.atomic
+    def settle_debts(cls, benefits):
+        """Settles every unpaid debt among the given benefits.
 
-            share_sum = Benefit.objects.filter(
-                purchase=self).aggregate(models.Sum('share'))['share__sum']
+        Debts are netted per payer, beneficiary and currency, so each
+        balance is charged once, and the benefits and their purchases are
+        flagged with one bulk update each. The unpaid benefits are locked
+        while they are read, so concurrent settlements of the same debts
+        wait for each other and only the first one charges them.
+        """
 
-            balance.charge(benefit.beneficiary, -benefit.debt)
+        benefits = list(
+            benefits.filter(paid_off=False).select_for_update().
+            select_related('purchase__product_price'))
 
-            benefit.paid_off = True
-            benefit.save()
+        groups = {}
+        for benefit in benefits:
 
-            self.no_debt_paid_off = False
-            self.save()
+            purchase = benefit.purchase
+            key = (purchase.payer_id, purchase.product_price.currency_id)
+            debts = groups.setdefault(key, {})
+
+            debts[benefit.beneficiary_id] = (
+                debts.get(benefit.beneficiary_id, 0) + benefit.debt)
+
+        charges = []
+        for (payer, currency), debts in groups.items():
+
+            balances = Balance.balances_with(payer, debts.keys(), currency)
+
+            charges.extend(
+                (balances[user], user, -debt) for user, debt in debts.items())
+
+        Balance.charge_many(charges)
+
+        _update_in_chunks(
+            Benefit, [benefit.id for benefit in benefits], paid_off=True)
+
+        _update_in_chunks(
+            cls, set(benefit.purchase_id for benefit in benefits),
+            no_debt_paid_off=False)
 
 @receiver(pre_delete, sender=Purchase)
 def fix_balance_on_deletion(instance, **kwargs):
 
     purchase = instance
-    benefits = purchase.benefit_set.all()
 
-    for benefit in benefits:
+    affected = Balance.affected_by(purchase)
 
-        balance = Balance.balance_between(purchase.payer,
-                                          benefit.beneficiary,
-                                          purchase.product_price.currency)
-        balance.charge(benefit.beneficiary, -benefit.debt)
-        benefit.delete()
+    # Debts that were paid off have already been taken off the balances.
+    Balance.charge_many(
+        (balance, benefit.beneficiary_id, -benefit.debt)
+        for balance, benefit in affected
+        if not benefit.paid_off)
+
+    debts = {}
+    for balance, benefit in affected:
+
+        debts[benefit.beneficiary_id] = (
+            debts.get(benefit.beneficiary_id, 0) + benefit.debt)
+
+    DailySpending.add({}, purchase.spending(debts))
+
+    purchase.benefit_set.all().delete()
 
 
 class Benefit(models.Model):
@@ -157,6 +387,15 @@ class Balance(models.Model):
     second_owes_first = models.DecimalField(
         default=0, max_digits=5, decimal_places=2)
 
+    class Meta:
+
+        unique_together = [('first_user', 'second_user', 'currency')]
+
+    # Orderings of balances_of, by counterparty or by what they owe.
+    ORDERS = {'counterparty': ('counterparty_name', 'currency__code'),
+              'net': ('net', 'counterparty_name', 'currency__code'),
+              '-net': ('-net', 'counterparty_name', 'currency__code')}
+
     def balance_of_first(self):
 
         return self.second_owes_first - self.first_owes_second
@@ -190,65 +429,968 @@ class Balance(models.Model):
 
     def charge(self, who, how_much):
 
-        if not (self.first_user == who or self.first_user.id == who or
-                self.second_user == who or self.second_user.id == who):
+        column = self.column_of(who)
+
+        # A single UPDATE of the one column, so concurrent charges of the
+        # same balance add up instead of overwriting each other.
+        type(self).objects.filter(id=self.id).update(
+            **{column: models.F(column) + how_much})
 
-            raise ValueError(
-                "The user must be one linked to this balance")
+        BalanceEntry.objects.create(balance_id=self.id, **{column: how_much})
 
-        if self.first_user == who or self.first_user.id == who:
+        setattr(self, column, getattr(self, column) + how_much)
 
-            self.first_owes_second += how_much
+    @classmethod
+    def affected_by(cls, purchase):
 
-        elif self.second_user == who or self.second_user.id == who:
+        benefits = list(Benefit.objects.filter(purchase=purchase))
 
-            self.second_owes_first += how_much
+        balances = cls.balances_with(
+            purchase.payer_id,
+            [benefit.beneficiary_id for benefit in benefits],
+            purchase.product_price.currency_id)
 
-        self.save()
+        return [(balances[benefit.beneficiary_id], benefit)
+                for benefit in benefits]
 
     @classmethod
-    def affected_by(cls, purchase):
+    def balances_with(cls, user, others, currency):
+        """Returns the balances between user and others, keyed by user id.
+
+        Missing balances are created, all in a constant number of queries.
+        """
+
+        user = _id_of(user)
+        others = set(_id_of(other) for other in others)
+        currency = _id_of(currency)
+
+        def key(other):
+
+            return (min(user, other), max(user, other), currency)
+
+        def fetch(others):
+
+            found = {}
+            for balance in cls.objects.filter(currency=currency).filter(
+                    Q(first_user=user, second_user__in=others) |
+                    Q(second_user=user, first_user__in=others)).order_by('id'):
+
+                other = (balance.second_user_id
+                         if balance.first_user_id == user
+                         else balance.first_user_id)
 
-        affected = []
+                found.setdefault(other, balance)
 
-        for benefit in Benefit.objects.filter(purchase=purchase):
+            return found
 
-            affected.append(
-                (Balance.balance_between(
-                    benefit.beneficiary,
-                    purchase.payer,
-                    purchase.product_price.currency),
-                 benefit))
+        memo = _memoized_balances()
 
-        return affected
+        if memo is None:
 
+            memo = {}
+
+        balances = dict(
+            (other, memo[key(other)]) for other in others if key(other) in memo)
+
+        missing = others.difference(balances)
+
+        if missing:
+
+            balances.update(fetch(missing))
+            missing = others.difference(balances)
+
+        if missing:
+
+            try:
+
+                with transaction.atomic():
+
+                    cls.objects.bulk_create(
+                        cls(first_user_id=min(user, other),
+                            second_user_id=max(user, other),
+                            currency_id=currency)
+                        for other in missing)
+
+                balances.update(fetch(missing))
+
+            except IntegrityError:
+
+                # Some were created concurrently, fall back to creating
+                # the rest one by one.
+                for other in missing:
+
+                    balances[other] = cls.balance_between(
+                        user, other, currency)
+
+        for other, balance in balances.items():
+
+            memo[key(other)] = balance
+
+        return balances
 
     @classmethod
-    def balances_of(cls, user):
+    def charge_many(cls, charges):
+        """Applies many (balance, who, how_much) charges at once.
+
+        Charges are netted per balance and written with at most one
+        UPDATE per column and one INSERT into the ledger. The balances
+        in memory are updated too.
+        """
+
+        columns = {'first_owes_second': {}, 'second_owes_first': {}}
+
+        for balance, who, how_much in charges:
+
+            column = balance.column_of(who)
+
+            columns[column][balance.id] = (
+                columns[column].get(balance.id, 0) + how_much)
 
-        return (cls.objects.filter(
-            first_user=user) +
-                cls.objetcs.filter(
-                    second_user=user.exclude(first_user=user)))
+            setattr(balance, column, getattr(balance, column) + how_much)
+
+        for column, deltas in columns.items():
+
+            bulk_update(
+                cls, column,
+                dict((key, delta) for key, delta in deltas.items() if delta),
+                increment=True)
+
+        BalanceEntry.record(
+            (balance_id,
+             columns['first_owes_second'].get(balance_id, 0),
+             columns['second_owes_first'].get(balance_id, 0))
+            for balance_id in set(columns['first_owes_second']).union(
+                columns['second_owes_first']))
+
+    @classmethod
+    def net_of(cls, user, currency, day=None):
+        """Returns what others owe the user, net across currencies.
+
+        Balances in every currency are converted into the given one at
+        the rates of the day, today by default. Returns (user, amount)
+        pairs ordered by username, and the currencies of the balances
+        left out for want of a rate.
+        """
+
+        user = _id_of(user)
+        day = day or datetime.date.today()
+        table = ExchangeRate.table()
+
+        others = {}
+        net = {}
+        unconverted = set()
+        for balance in (cls.objects.
+                filter(Q(first_user=user) | Q(second_user=user)).
+                exclude(first_user=models.F('second_user')).
+                select_related('first_user', 'second_user', 'currency')):
+
+            if balance.first_user_id == user:
+
+                other, amount = balance.second_user, balance.balance_of_first()
+
+            else:
+
+                other, amount = balance.first_user, balance.balance_of_second()
+
+            try:
+
+                amount = table.convert(
+                    _to_decimal(amount), balance.currency_id, currency, day)
+
+            except MissingRate:
+
+                unconverted.add(balance.currency)
+                continue
+
+            others[other.id] = other
+            net[other.id] = net.get(other.id, 0) + amount
+
+        return ([(others[other], net[other].quantize(CENT))
+                 for other in sorted(
+                     others, key=lambda other: others[other].username)],
+                sorted(unconverted, key=lambda currency: currency.code))
+
+    def column_of(self, who):
+
+        who = _id_of(who)
+
+        if self.first_user_id == who:
+
+            return 'first_owes_second'
+
+        elif self.second_user_id == who:
+
+            return 'second_owes_first'
+
+        raise ValueError(
+            "The user must be one linked to this balance")
+
+    @classmethod
+    def balances_of(cls, user, order='counterparty'):
+        """Returns the balances between the user and everybody else.
+
+        The orientation of every balance is normalized in SQL, which adds
+        counterparty_id and counterparty_name, what the user owes them
+        (owed_by_user), what they owe the user (owed_to_user), and the
+        difference, net. So pages can be ordered by any of ORDERS in the
+        database, and come with their currencies in a single query.
+        """
+
+        user = _id_of(user)
+        qn = connection.ops.quote_name
+
+        def column(name):
+
+            return "%s.%s" % (qn(cls._meta.db_table), qn(name))
+
+        def oriented(mine, theirs):
+
+            return "CASE WHEN %s = %%s THEN %s ELSE %s END" % (
+                column('first_user_id'), mine, theirs)
+
+        first = column('first_user_id')
+        second = column('second_user_id')
+        first_owes = column('first_owes_second')
+        second_owes = column('second_owes_first')
+        counterparty = oriented(second, first)
+        users = qn(User._meta.db_table)
+
+        select = OrderedDict([
+            ('counterparty_id', counterparty),
+            ('counterparty_name', "%s.%s" % (users, qn('username'))),
+            ('owed_by_user', oriented(first_owes, second_owes)),
+            ('owed_to_user', oriented(second_owes, first_owes)),
+            ('net', oriented("%s - %s" % (second_owes, first_owes),
+                             "%s - %s" % (first_owes, second_owes)))])
+
+        # The counterparty is joined rather than looked up per row, so
+        # ordering by name can use the index on usernames.
+        return (cls.objects.
+            filter(Q(first_user=user) | Q(second_user=user)).
+            exclude(first_user=models.F('second_user')).
+            select_related('currency').
+            extra(select=select,
+                  select_params=[user] * (len(select) - 1),
+                  tables=[User._meta.db_table],
+                  where=["%s.%s = %s" % (users, qn('id'), counterparty)],
+                  params=[user]).
+            order_by(*cls.ORDERS[order]))
+
+    @classmethod
+    def unpaid_debts(cls, creditor, obligor):
+        """Returns what the obligor owes the creditor in every currency.
+
+        Balances keep the sum of the unpaid debts of either user, so
+        nothing is added up. Returns (currency, amount) pairs ordered by
+        currency code, leaving out currencies nothing is owed in.
+        """
+
+        creditor, obligor = _id_of(creditor), _id_of(obligor)
+
+        balances = (cls.objects.
+            filter(first_user=min(creditor, obligor),
+                   second_user=max(creditor, obligor)).
+            select_related('currency').
+            order_by('currency__code'))
+
+        debts = []
+        for balance in balances:
+
+            amount = getattr(balance, balance.column_of(obligor))
+
+            if amount:
+
+                debts.append(
+                    (balance.currency, _to_decimal(amount).quantize(CENT)))
+
+        return debts
 
     @classmethod
     def balance_between(cls, one, another, currency):
 
-        if one.id > another.id:
+        one, another, currency = (
+            _id_of(one), _id_of(another), _id_of(currency))
+
+        if one > another:
 
             one, another = another, one
 
-        if cls.objects.filter(
-                first_user=one,
-                second_user=another,
-                currency=currency).count() == 1:
+        memo = _memoized_balances()
+        key = (one, another, currency)
+
+        if memo is not None and key in memo:
+
+            return memo[key]
+
+        balance = cls._get_or_create(one, another, currency)
+
+        if memo is not None:
+
+            memo[key] = balance
+
+        return balance
+
+    @classmethod
+    def _get_or_create(cls, first_user, second_user, currency):
+
+        # Ordering and slicing rather than get() keeps databases with
+        # duplicates from before the unique constraint working.
+        existing = cls.objects.filter(
+            first_user=first_user,
+            second_user=second_user,
+            currency=currency).order_by('id')
+
+        for balance in existing[:1]:
+
+            return balance
+
+        try:
+
+            with transaction.atomic():
+
+                return cls.objects.create(
+                    first_user_id=first_user,
+                    second_user_id=second_user,
+                    currency_id=currency)
+
+        except IntegrityError:
+
+            # Another worker has just created it.
+            return existing[0]
+
+
+class BalanceEntry(models.Model):
+    """A change of a balance. The ledger is only ever appended to."""
+
+    balance = models.ForeignKey(Balance)
+
+    first_owes_second = models.DecimalField(
+        default=0, max_digits=12, decimal_places=2)
+
+    second_owes_first = models.DecimalField(
+        default=0, max_digits=12, decimal_places=2)
+
+    created = models.DateTimeField(default=timezone.now)
+
+    def __unicode__(self):
+
+        return '%+.2f / %+.2f on balance %d' % (
+            self.first_owes_second, self.second_owes_first, self.balance_id)
+
+    @classmethod
+    def record(cls, changes):
+        """Appends (balance, first_owes_second, second_owes_first) changes.
+
+        Changes of nothing are skipped, the rest go in a single INSERT.
+        """
+
+        entries = [
+            cls(balance_id=_id_of(balance),
+                first_owes_second=first_owes_second,
+                second_owes_first=second_owes_first)
+            for balance, first_owes_second, second_owes_first in changes
+            if first_owes_second or second_owes_first]
+
+        if entries:
+
+            cls.objects.bulk_create(entries)
+
+    @classmethod
+    def totals(cls, balances, up_to=None):
+        """Sums up the ledger of the balances, keyed by balance id.
+
+        Each total is a (first_owes_second, second_owes_first, last_entry)
+        triple read from the latest snapshot and the entries after it,
+        up to the entry with id up_to if given. Takes two queries however
+        many balances there are.
+        """
+
+        ids = [_id_of(balance) for balance in balances]
+        totals = dict((balance_id, (0, 0, 0)) for balance_id in ids)
+
+        if not ids:
+
+            return totals
+
+        qn = connection.ops.quote_name
+        entries = qn(cls._meta.db_table)
+        snapshots = qn(BalanceSnapshot._meta.db_table)
+        placeholders = ', '.join(['%s'] * len(ids))
+
+        def latest(alias):
+
+            return ("(SELECT MAX(latest.last_entry) FROM %s latest "
+                    "WHERE latest.balance_id = %s.balance_id)" % (
+                        snapshots, alias))
+
+        cursor = connection.cursor()
+
+        cursor.execute(
+            "SELECT snapshot.balance_id, snapshot.first_owes_second, "
+            "snapshot.second_owes_first, snapshot.last_entry "
+            "FROM %s snapshot "
+            "WHERE snapshot.balance_id IN (%s) "
+            "AND snapshot.last_entry = %s" % (
+                snapshots, placeholders, latest('snapshot')),
+            ids)
+
+        for balance_id, first_owes_second, second_owes_first, last in cursor:
+
+            totals[balance_id] = (
+                _to_decimal(first_owes_second),
+                _to_decimal(second_owes_first),
+                last)
+
+        cursor.execute(
+            "SELECT entry.balance_id, SUM(entry.first_owes_second), "
+            "SUM(entry.second_owes_first), MAX(entry.id) "
+            "FROM %s entry "
+            "WHERE entry.balance_id IN (%s) "
+            "AND entry.id > COALESCE(%s, 0) %s"
+            "GROUP BY entry.balance_id" % (
+                entries, placeholders, latest('entry'),
+                "AND entry.id <= %s " if up_to is not None else ""),
+            ids + ([up_to] if up_to is not None else []))
+
+        for balance_id, first_owes_second, second_owes_first, last in cursor:
+
+            total = totals[balance_id]
+            totals[balance_id] = (
+                (total[0] + _to_decimal(first_owes_second)).quantize(CENT),
+                (total[1] + _to_decimal(second_owes_first)).quantize(CENT),
+                last)
+
+        return totals
+
+
+class BalanceSnapshot(models.Model):
+    """The sum of the ledger of a balance up to and including last_entry."""
+
+    balance = models.ForeignKey(Balance)
+
+    last_entry = models.PositiveIntegerField()
+
+    first_owes_second = models.DecimalField(
+        default=0, max_digits=12, decimal_places=2)
+
+    second_owes_first = models.DecimalField(
+        default=0, max_digits=12, decimal_places=2)
+
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+
+        index_together = [['balance', 'last_entry']]
+
+    def __unicode__(self):
+
+        return 'Balance %d up to entry %d' % (
+            self.balance_id, self.last_entry)
+
+
+class DailySpending(models.Model):
+
+    user = models.ForeignKey(User)
+    currency = models.ForeignKey(Currency)
+    day = models.DateField()
+    section = models.ForeignKey(Section)
+
+    # What the user paid for as a payer, and what they consumed as a
+    # beneficiary (or as a payer sharing with nobody).
+    paid = models.DecimalField(
+        default=0, max_digits=12, decimal_places=2)
+    consumed = models.DecimalField(
+        default=0, max_digits=12, decimal_places=2)
+
+    class Meta:
+
+        unique_together = [('user', 'currency', 'day', 'section')]
+
+    def __unicode__(self):
+
+        return "%s paid %s and consumed %s %s of %s on %s" % (
+            self.user, self.paid, self.consumed, self.currency,
+            self.section, self.day)
+
+    @classmethod
+    def add(cls, new, old=None):
+        """Moves the rollup from old spending to new spending.
+
+        Both map (user id, currency id, day, section id) to (paid,
+        consumed), as returned by Purchase.spending.
+        """
+
+        deltas = {}
+        for spending, sign in [(new, 1), (old or {}, -1)]:
+
+            for key, (paid, consumed) in spending.items():
+
+                old_paid, old_consumed = deltas.get(key, (0, 0))
+                deltas[key] = (old_paid + sign * paid,
+                               old_consumed + sign * consumed)
+
+        deltas = dict(
+            (key, delta) for key, delta in deltas.items() if any(delta))
+
+        if not deltas:
+
+            return
+
+        def fetch():
+
+            return dict(
+                ((row.user_id, row.currency_id, row.day, row.section_id),
+                 row)
+                for row in cls.objects.filter(
+                    user__in=set(key[0] for key in deltas),
+                    currency__in=set(key[1] for key in deltas),
+                    day__in=set(key[2] for key in deltas),
+                    section__in=set(key[3] for key in deltas)))
+
+        rows = fetch()
+        missing = [key for key in deltas if key not in rows]
+
+        try:
+
+            if missing:
+
+                with transaction.atomic():
+
+                    cls.objects.bulk_create(
+                        cls(user_id=user, currency_id=currency, day=day,
+                            section_id=section, paid=deltas[key][0],
+                            consumed=deltas[key][1])
+                        for key in missing
+                        for user, currency, day, section in [key])
+
+        except IntegrityError:
+
+            # Some rows were created concurrently; increment them all.
+            for user, currency, day, section in missing:
+
+                cls.objects.get_or_create(
+                    user_id=user, currency_id=currency, day=day,
+                    section_id=section)
+
+            rows = fetch()
+            missing = []
+
+        for index, column in enumerate(['paid', 'consumed']):
+
+            bulk_update(
+                cls, column,
+                dict((row.id, deltas[key][index])
+                     for key, row in rows.items()
+                     if key in deltas and key not in missing and
+                     deltas[key][index]),
+                increment=True)
+
+
+@receiver(pre_save, sender=Purchase)
+def remember_spending(instance, raw=False, **kwargs):
+
+    if raw or instance.pk is None:
+
+        return
+
+    for old in Purchase.objects.filter(pk=instance.pk):
+
+        instance._old_spending = old.spending(old.debts())
+
+
+@receiver(post_save, sender=Purchase)
+def track_spending(instance, raw=False, **kwargs):
+
+    # Fixtures are left to rebuild_spending_rollup.
+    if raw:
+
+        return
+
+    DailySpending.add(
+        instance.spending(instance.debts()),
+        instance.__dict__.pop('_old_spending', None))
+
+
+class ShoppingList(models.Model):
+
+    owner = models.ForeignKey(User)
+    name = models.CharField(max_length=50)
+
+    # When the totals were last brought up to date. Prices coming into
+    # effect later than that were scheduled in advance and are only
+    # accounted for by rebuilding the totals.
+    priced_at = models.DateTimeField(default=timezone.now)
+
+    def __unicode__(self):
+
+        return self.name
+
+    def current_totals(self):
+        """Returns the cost of the list at every shop selling any of it.
+
+        Totals are kept up to date as prices and items change, and are
+        only rebuilt once a price scheduled in advance comes into effect.
+        """
+
+        now = timezone.now()
+
+        if ShoppingList.stale([self.id], now):
+
+            ShoppingList.rebuild_totals([self.id], now=now)
+
+        return (self.totals.
+            select_related('shop', 'currency').
+            order_by('-items', 'total'))
+
+    @classmethod
+    def stale(cls, lists, now, ignore=None):
+        """Returns the ids of the lists some price came into effect for.
+
+        Those are prices of listed products that became effective after
+        the list was last priced, other than the price to ignore.
+        """
+
+        prices = Price.objects.filter(
+            product__shoppinglistitem__shopping_list__in=lists,
+            since__gt=models.F(
+                'product__shoppinglistitem__shopping_list__priced_at'),
+            since__lte=now)
+
+        if ignore is not None:
+
+            prices = prices.exclude(id=ignore)
+
+        return set(prices.values_list(
+            'product__shoppinglistitem__shopping_list', flat=True))
+
+    @classmethod
+    @transaction.atomic
+    def rebuild_totals(cls, lists, now=None):
+        """Computes the totals of the lists anew."""
+
+        now = now or timezone.now()
+        lists = [_id_of(shopping_list) for shopping_list in lists]
+
+        ShoppingListTotal.objects.filter(shopping_list__in=lists).delete()
+
+        items = ShoppingListItem.objects.filter(
+            shopping_list__in=lists).values_list(
+                'shopping_list', 'product', 'quantity')
+
+        ShoppingListTotal.objects.bulk_create(
+            ShoppingListTotal(
+                shopping_list_id=shopping_list, shop_id=shop,
+                currency_id=currency, total=total, items=count)
+            for (shopping_list, shop, currency), (total, count) in
+            ShoppingListTotal.contributions(items, now).items())
+
+        cls.objects.filter(id__in=lists).update(priced_at=now)
+
+    @transaction.atomic
+    def buy(self, shop, payer, date=None):
+        """Buys every item of the list sold at the shop.
+
+        The purchases are inserted in bulk, and the spending rollup is
+        updated for them all at once. Returns the number of purchases
+        and the products the shop does not sell.
+        """
+
+        now = timezone.now()
+        items = list(self.items.select_related('product'))
+
+        resolved = Price.objects.in_effect(
+            (item.product_id, shop, now) for item in items)
+
+        purchases = []
+        missing = []
+        for item, prices in zip(items, resolved):
+
+            if not prices or not prices[0].available:
+
+                missing.append(item.product)
+                continue
+
+            price = prices[0]
+            price.product = item.product
+
+            purchase = Purchase(
+                product_price=price, payer=payer, amount=item.quantity)
+
+            if date is not None:
+
+                purchase.date = date
+
+            purchases.append(purchase)
+
+        Purchase.objects.bulk_create(purchases)
+
+        # bulk_create sends no post_save, so track_spending is not run.
+        spending = {}
+        for purchase in purchases:
+
+            for key, (paid, consumed) in purchase.spending({}).items():
+
+                old_paid, old_consumed = spending.get(key, (0, 0))
+                spending[key] = (old_paid + paid, old_consumed + consumed)
+
+        DailySpending.add(spending)
+
+        return len(purchases), missing
+
+
+class ShoppingListItem(models.Model):
+
+    shopping_list = models.ForeignKey(ShoppingList, related_name='items')
+    product = models.ForeignKey(Product)
+    quantity = models.DecimalField(
+        default=1, max_digits=5, decimal_places=2)
+
+    class Meta:
+
+        unique_together = [('shopping_list', 'product')]
+
+    def __unicode__(self):
+
+        return "%s %s" % (self.quantity, self.product)
+
+
+class ShoppingListTotal(models.Model):
+    """The cost of the items of a list a shop sells in a currency."""
+
+    shopping_list = models.ForeignKey(ShoppingList, related_name='totals')
+    shop = models.ForeignKey(Shop)
+    currency = models.ForeignKey(Currency)
+
+    total = models.DecimalField(
+        default=0, max_digits=12, decimal_places=2)
+    items = models.PositiveIntegerField(default=0)
+
+    class Meta:
+
+        unique_together = [('shopping_list', 'shop', 'currency')]
+
+    def __unicode__(self):
+
+        return "%s at %s: %s %s for %d items" % (
+            self.shopping_list, self.shop, self.total, self.currency,
+            self.items)
+
+    @classmethod
+    def contributions(cls, items, now=None):
+        """Returns what (list, product, quantity) items add to the totals.
+
+        The result maps (list id, shop id, currency id) to (total, number
+        of items), priced with the prices in effect at every shop.
+        """
+
+        items = list(items)
+        now = now or timezone.now()
+
+        resolved = Price.objects.in_effect(
+            (product, None, now) for shopping_list, product, quantity in items)
+
+        contributions = {}
+        for (shopping_list, product, quantity), prices in zip(
+                items, resolved):
+
+            for price in prices:
+
+                if not price.available:
+
+                    continue
+
+                key = (shopping_list, price.shop_id, price.currency_id)
+                total, count = contributions.get(key, (0, 0))
+                contributions[key] = (
+                    total + (price.value * quantity).quantize(CENT),
+                    count + 1)
+
+        return contributions
+
+    @classmethod
+    def add(cls, new, old=None):
+        """Moves the totals from old contributions to new ones."""
+
+        deltas = {}
+        for contributions, sign in [(new, 1), (old or {}, -1)]:
+
+            for key, (total, count) in contributions.items():
+
+                old_total, old_count = deltas.get(key, (0, 0))
+                deltas[key] = (old_total + sign * total,
+                               old_count + sign * count)
+
+        deltas = dict(
+            (key, delta) for key, delta in deltas.items() if any(delta))
+
+        if not deltas:
+
+            return
+
+        def fetch():
+
+            return dict(
+                ((row.shopping_list_id, row.shop_id, row.currency_id), row)
+                for row in cls.objects.filter(
+                    shopping_list__in=set(key[0] for key in deltas),
+                    shop__in=set(key[1] for key in deltas),
+                    currency__in=set(key[2] for key in deltas)))
+
+        rows = fetch()
+        missing = [key for key in deltas if key not in rows]
+
+        try:
+
+            if missing:
+
+                with transaction.atomic():
+
+                    cls.objects.bulk_create(
+                        cls(shopping_list_id=shopping_list, shop_id=shop,
+                            currency_id=currency, total=deltas[key][0],
+                            items=deltas[key][1])
+                        for key in missing
+                        for shopping_list, shop, currency in [key])
+
+        except IntegrityError:
+
+            # Some rows were created concurrently; increment them all.
+            for shopping_list, shop, currency in missing:
+
+                cls.objects.get_or_create(
+                    shopping_list_id=shopping_list, shop_id=shop,
+                    currency_id=currency)
+
+            rows = fetch()
+            missing = []
+
+        for index, column in enumerate(['total', 'items']):
+
+            bulk_update(
+                cls, column,
+                dict((row.id, deltas[key][index])
+                     for key, row in rows.items()
+                     if key in deltas and key not in missing and
+                     deltas[key][index]),
+                increment=True)
+
+        # Rows of shops no longer selling anything on the list go away.
+        cls.objects.filter(
+            id__in=[row.id for key, row in rows.items()
+                    if key in deltas and key not in missing],
+            items=0).delete()
+
+
+@receiver(pre_save, sender=ShoppingListItem)
+def remember_contribution(instance, raw=False, **kwargs):
+
+    if raw or instance.pk is None:
+
+        return
+
+    instance._old_contributions = ShoppingListTotal.contributions(
+        ShoppingListItem.objects.filter(pk=instance.pk).values_list(
+            'shopping_list', 'product', 'quantity'))
+
+
+@receiver(post_save, sender=ShoppingListItem)
+def track_contribution(instance, raw=False, **kwargs):
+
+    if raw:
+
+        return
+
+    ShoppingListTotal.add(
+        ShoppingListTotal.contributions(
+            [(instance.shopping_list_id, instance.product_id,
+              instance.quantity)]),
+        instance.__dict__.pop('_old_contributions', None))
+
+
+@receiver(post_delete, sender=ShoppingListItem)
+def drop_contribution(instance, **kwargs):
+
+    ShoppingListTotal.add(
+        {},
+        ShoppingListTotal.contributions(
+            [(instance.shopping_list_id, instance.product_id,
+              instance.quantity)]))
+
+
+@receiver(post_save, sender=Price)
+def reprice_shopping_lists(instance, created=False, raw=False, **kwargs):
+
+    if raw:
+
+        return
+
+    items = list(
+        ShoppingListItem.objects.filter(product=instance.product_id).
+        values_list('shopping_list', 'quantity'))
+
+    if not items:
+
+        return
+
+    now = timezone.now()
+    current = CurrentPrice.lookup(instance.product_id, instance.shop_id)
+
+    # Prices scheduled in advance are picked up by current_totals.
+    if created and (current is None or current.id != instance.id):
+
+        return
+
+    lists = set(shopping_list for shopping_list, quantity in items)
+
+    # Lists with other prices to catch up on, or edited history, are
+    # priced anew; the rest only move from the previous price to this one.
+    stale = lists if not created else ShoppingList.stale(
+        lists, now, ignore=instance.id)
+
+    if stale:
+
+        ShoppingList.rebuild_totals(stale, now=now)
+
+    lists -= stale
+    items = [(shopping_list, quantity) for shopping_list, quantity in items
+             if shopping_list in lists]
+
+    if not items:
+
+        return
+
+    previous = (Price.objects.
+        filter(product=instance.product_id, shop=instance.shop_id,
+               since__lte=instance.since).
+        exclude(id=instance.id).
+        order_by('-since', '-id')[:1])
+
+    def contributions(price):
+
+        if price is None or not price.available:
+
+            return {}
+
+        return dict(
+            ((shopping_list, price.shop_id, price.currency_id),
+             ((price.value * quantity).quantize(CENT), 1))
+            for shopping_list, quantity in items)
+
+    ShoppingListTotal.add(
+        contributions(instance),
+        contributions(previous[0] if previous else None))
+
+    ShoppingList.objects.filter(id__in=lists).update(priced_at=now)
+
+
+@receiver(prices_appended, sender=Price)
+def reprice_shopping_lists_in_bulk(pairs, **kwargs):
+
+    lists = set(
+        ShoppingListItem.objects.filter(
+            product__in=set(product for product, shop in pairs)).
+        values_list('shopping_list', flat=True))
 
-            return cls.objects.get(
-                first_user=one,
-                second_user=another,
-                currency=currency)
+    if lists:
 
-        return cls.objects.create(
-            first_user=one,
-            second_user=another,
-            currency=currency)
+        ShoppingList.rebuild_totals(lists)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from django.db import connection
+from django.utils.dateparse import parse_date
+
+from django.db.models import Sum
+
+from products.models import (
+    Price, Product, Section, Shop, Currency, ExchangeRate)
+from purchases.models import Purchase, DailySpending, CENT, _to_decimal
+
+
+PERIODS = ('day', 'week', 'month')
+
+# Totals are always split by currency, since adding up amounts in
+# different currencies means nothing, unless converted into one.
+BREAKDOWNS = ('currency', 'section', 'shop')
+
+# What the user paid for, or what they consumed of their own and other
+# people's purchases.
+MEASURES = ('paid', 'consumed')
+
+
+def period_start(day, period):
+
+    if period == 'week':
+
+        return day - datetime.timedelta(days=day.weekday())
+
+    elif period == 'month':
+
+        return day.replace(day=1)
+
+    return day
+
+
+def spending(user, start, end, period='month', by=(), measure='paid',
+             currency=None):
+    """Sums up the user's spending between start and end, inclusive.
+
+    Returns a list of dicts, ordered by period, with the first day of
+    the period, the currency code, the section and shop names if asked
+    for in `by`, and the total. Totals come from one aggregate query
+    over the daily spending rollup, or over the purchases themselves
+    when split by shop, which the rollup does not track. Days are then
+    folded into longer periods.
+
+    Given a currency, daily totals are first converted into it at the
+    rates of their day, so every row is in that currency. Raises
+    MissingRate when some rate is not known.
+    """
+
+    if period not in PERIODS:
+
+        raise ValueError("Unknown period: %s" % period)
+
+    if measure not in MEASURES:
+
+        raise ValueError("Unknown measure: %s" % measure)
+
+    by = [breakdown for breakdown in BREAKDOWNS
+          if breakdown == 'currency' or breakdown in by]
+
+    if 'shop' in by:
+
+        if measure != 'paid':
+
+            raise ValueError(
+                "Only what was paid can be split by shop")
+
+        rows = _daily_from_purchases(user, start, end, by)
+
+    else:
+
+        rows = _daily_from_rollup(user, start, end, by, measure)
+
+    if currency is not None:
+
+        table = ExchangeRate.table()
+        codes = dict(Currency.objects.values_list('code', 'id'))
+
+    totals = {}
+    for row in rows:
+
+        day = row[0]
+
+        if not isinstance(day, datetime.date):
+
+            day = parse_date(day)
+
+        amount = _to_decimal(row[-1])
+
+        if currency is not None:
+
+            amount = table.convert(amount, codes[row[1]], currency, day)
+            row = (day, currency.code) + tuple(row[2:])
+
+        key = (period_start(day, period),) + tuple(row[1:-1])
+
+        totals[key] = totals.get(key, 0) + amount
+
+    return [dict(zip(('period',) + tuple(by) + ('total',),
+                     key + (total.quantize(CENT),)))
+            for key, total in sorted(totals.items())]
+
+
+def _daily_from_rollup(user, start, end, by, measure):
+
+    fields = {'currency': 'currency__code', 'section': 'section__name'}
+
+    return (DailySpending.objects.
+        filter(user=user, day__gte=start, day__lte=end).
+        values_list('day', *[fields[breakdown] for breakdown in by]).
+        annotate(Sum(measure)).
+        order_by())
+
+
+def _daily_from_purchases(user, start, end, by):
+
+    qn = connection.ops.quote_name
+
+    columns = {'currency': 'currency.code',
+               'section': 'section.name',
+               'shop': 'shop.name'}
+    grouped = ", ".join(["purchase.date"] + [columns[b] for b in by])
+
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT %(grouped)s, SUM(purchase.amount * price.value) "
+        "FROM %(purchases)s purchase "
+        "INNER JOIN %(prices)s price ON price.id = purchase.product_price_id "
+        "INNER JOIN %(currencies)s currency ON currency.id = price.currency_id "
+        "INNER JOIN %(products)s product ON product.id = price.product_id "
+        "INNER JOIN %(sections)s section ON section.id = product.section_id "
+        "INNER JOIN %(shops)s shop ON shop.id = price.shop_id "
+        "WHERE purchase.payer_id = %%s "
+        "AND purchase.date >= %%s AND purchase.date <= %%s "
+        "GROUP BY %(grouped)s" % {
+            'grouped': grouped,
+            'purchases': qn(Purchase._meta.db_table),
+            'prices': qn(Price._meta.db_table),
+            'currencies': qn(Currency._meta.db_table),
+            'products': qn(Product._meta.db_table),
+            'sections': qn(Section._meta.db_table),
+            'shops': qn(Shop._meta.db_table)},
+        [user.id,
+         connection.ops.value_to_db_date(start),
+         connection.ops.value_to_db_date(end)])
+
+    return cursor.fetchall()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+from decimal import Decimal
+
+from django.db import connection
+
+from purchases.models import Balance, to_cents
+
+
+# Groups up to this size can be settled with the fewest possible
+# transfers; the exact solver is exponential in the group size.
+EXACT_LIMIT = 12
+
+
+def net_positions(currency):
+    """Returns how much each user is owed in total, in cents.
+
+    Positive positions are owed money, negative ones owe it. Every
+    balance in the currency is summed up per user by a single query.
+    """
+
+    qn = connection.ops.quote_name
+    table = qn(Balance._meta.db_table)
+
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT user_id, SUM(net) FROM ("
+        "SELECT first_user_id AS user_id, "
+        "second_owes_first - first_owes_second AS net "
+        "FROM %(table)s WHERE currency_id = %%s "
+        "AND first_user_id <> second_user_id "
+        "UNION ALL "
+        "SELECT second_user_id AS user_id, "
+        "first_owes_second - second_owes_first AS net "
+        "FROM %(table)s WHERE currency_id = %%s "
+        "AND first_user_id <> second_user_id) positions "
+        "GROUP BY user_id" % {'table': table},
+        [currency.id, currency.id])
+
+    positions = dict(
+        (user, to_cents(net)) for user, net in cursor.fetchall())
+
+    return dict((user, net) for user, net in positions.items() if net)
+
+
+def plan(positions, exact=False):
+    """Plans transfers settling every position.
+
+    Returns a list of (debtor, creditor, amount) with amounts as
+    Decimals. The greedy plan always pays the biggest creditor from the
+    biggest debtor and needs at most one transfer fewer than there are
+    users. With exact=True groups of up to EXACT_LIMIT users are split
+    into as many independent, self-settling subgroups as possible
+    first, which gives the minimal number of transfers.
+    """
+
+    positions = dict((user, net) for user, net in positions.items() if net)
+
+    if sum(positions.values()) != 0:
+
+        raise ValueError("Positions must add up to zero")
+
+    if exact and len(positions) <= EXACT_LIMIT:
+
+        groups = _zero_sum_groups(positions)
+
+    else:
+
+        groups = [positions]
+
+    transfers = []
+    for group in groups:
+
+        transfers.extend(_greedy(group))
+
+    return [(debtor, creditor, Decimal(cents).scaleb(-2))
+            for debtor, creditor, cents in transfers]
+
+
+def _greedy(positions):
+
+    creditors = [(-net, user) for user, net in positions.items() if net > 0]
+    debtors = [(net, user) for user, net in positions.items() if net < 0]
+
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+
+        owed, creditor = heapq.heappop(creditors)
+        owing, debtor = heapq.heappop(debtors)
+
+        amount = min(-owed, -owing)
+        transfers.append((debtor, creditor, amount))
+
+        if -owed > amount:
+
+            heapq.heappush(creditors, (owed + amount, creditor))
+
+        if -owing > amount:
+
+            heapq.heappush(debtors, (owing + amount, debtor))
+
+    return transfers
+
+
+def _zero_sum_groups(positions):
+
+    # A group of k users can always be settled with k - 1 transfers, so
+    # the fewest transfers come from the most zero-sum groups. best[mask]
+    # is the most zero-sum groups the users in mask can be split into.
+    users = sorted(positions)
+    values = [positions[user] for user in users]
+    size = 1 << len(users)
+
+    sums = [0] * size
+    best = [0] * size
+
+    for mask in range(1, size):
+
+        lowest = mask & -mask
+        sums[mask] = sums[mask ^ lowest] + values[lowest.bit_length() - 1]
+
+        best[mask] = max(
+            best[mask ^ (1 << i)] for i in range(len(users)) if mask >> i & 1)
+
+        if sums[mask] == 0:
+
+            best[mask] += 1
+
+    # Peel users off in an order along which the running sum returns to
+    # zero at every group boundary.
+    order = []
+    mask = size - 1
+    while mask:
+
+        bonus = 1 if sums[mask] == 0 else 0
+
+        for i in range(len(users)):
+
+            if mask >> i & 1 and best[mask ^ (1 << i)] + bonus == best[mask]:
+
+                order.append(i)
+                mask ^= 1 << i
+
+                break
+
+    groups = []
+    group = {}
+    running = 0
+    for i in reversed(order):
+
+        group[users[i]] = values[i]
+        running += values[i]
+
+        if running == 0:
+
+            groups.append(group)
+            group = {}
+
+    return groups
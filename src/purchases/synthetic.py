@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import random
+import datetime
+from decimal import Decimal
+from StringIO import StringIO
+
+from django.db import transaction
+from django.utils import timezone
+from django.contrib.auth.models import User
+from django.core.management import call_command
+
+from products.models import (
+    Section, Product, Shop, Currency, Price, CurrentPrice)
+from purchases.models import Purchase, Benefit, CENT
+
+
+# Rows handed to a single bulk_create.
+BATCH_SIZE = 5000
+
+# Synthetic histories start here rather than now, so a seed always gives
+# the very same rows.
+EPOCH = datetime.datetime(2013, 1, 1, tzinfo=timezone.utc)
+
+
+class SyntheticData(object):
+    """A reproducible data set of the given size, made with bulk_create.
+
+    Every product is sold at every shop, with `history` prices spread
+    evenly over `days`. Purchases are made at random prices while they
+    were in effect, shared by up to `beneficiaries` users each. Balances
+    and the spending rollup are then derived from the purchases by the
+    rebuild_balances and rebuild_spending_rollup commands.
+    """
+
+    def __init__(self, users=50, shops=10, products=100, history=20,
+                 purchases=10000, beneficiaries=5, days=365, seed=0):
+
+        self.sizes = {'users': users,
+                      'shops': shops,
+                      'products': products,
+                      'history': history,
+                      'purchases': purchases,
+                      'beneficiaries': beneficiaries,
+                      'days': days}
+        self.rng = random.Random(seed)
+
+        self.start = EPOCH
+        self.end = EPOCH + datetime.timedelta(days=days)
+
+    @transaction.atomic
+    def create(self):
+
+        sizes = self.sizes
+        prefix = "synthetic-%d-" % User.objects.count()
+
+        self.currency = Currency.objects.create(
+            name="Synthetic", code="S%02d" % (Currency.objects.count() % 100),
+            symbol="S")
+        section = Section.objects.create(name="Synthetic")
+
+        User.objects.bulk_create(
+            User(username="%s%d" % (prefix, i))
+            for i in range(sizes['users']))
+        Shop.objects.bulk_create(
+            Shop(name="%s%d" % (prefix, i)) for i in range(sizes['shops']))
+        Product.objects.bulk_create(
+            Product(name="%s%d" % (prefix, i), section=section)
+            for i in range(sizes['products']))
+
+        self.users = list(
+            User.objects.filter(username__startswith=prefix).order_by('id'))
+        self.shops = list(
+            Shop.objects.filter(name__startswith=prefix).order_by('id'))
+        self.products = list(
+            Product.objects.filter(section=section).order_by('id'))
+
+        self.create_prices()
+        self.create_purchases()
+
+        call_command('rebuild_balances', stdout=StringIO())
+        call_command('rebuild_spending_rollup', stdout=StringIO())
+
+        return self
+
+    def create_prices(self):
+
+        step = (self.end - self.start) // self.sizes['history']
+
+        def prices():
+
+            for index in range(self.sizes['history']):
+
+                since = self.start + step * index
+
+                for product in self.products:
+
+                    for shop in self.shops:
+
+                        yield Price(
+                            value=Decimal(self.rng.randint(50, 5000)) / 100,
+                            currency=self.currency, shop=shop,
+                            product=product, since=since)
+
+        _insert(Price, prices())
+
+        self.prices = list(
+            Price.objects.filter(currency=self.currency).
+            values_list('id', 'value', 'since').order_by('id'))
+        self.step = step
+
+        CurrentPrice.refresh_many(
+            (product.id, shop.id)
+            for product in self.products for shop in self.shops)
+
+    def create_purchases(self):
+
+        users = [user.id for user in self.users]
+        shares = []
+
+        def purchases():
+
+            for i in range(self.sizes['purchases']):
+
+                price_id, value, since = self.rng.choice(self.prices)
+                amount = Decimal(self.rng.randint(1, 3))
+                date = (since + datetime.timedelta(
+                    seconds=self.rng.randint(
+                        0, int(self.step.total_seconds()) - 1))).date()
+
+                beneficiaries = self.rng.sample(
+                    users, self.rng.randint(
+                        1, min(self.sizes['beneficiaries'], len(users))))
+
+                shares.append((amount * value, beneficiaries))
+
+                yield Purchase(
+                    product_price_id=price_id, amount=amount,
+                    payer_id=self.rng.choice(users), date=date)
+
+        _insert(Purchase, purchases())
+
+        # Purchases were inserted in order, so their ids come in order too.
+        ids = (Purchase.objects.filter(product_price__currency=self.currency).
+            order_by('id').values_list('id', flat=True))
+
+        def benefits():
+
+            for purchase_id, (cost, beneficiaries) in zip(ids, shares):
+
+                debt = (cost / len(beneficiaries)).quantize(CENT)
+
+                # Whatever got lost to rounding is charged to the first
+                # beneficiary, as Purchase.add_benefits does.
+                first = cost - debt * (len(beneficiaries) - 1)
+
+                for index, user in enumerate(beneficiaries):
+
+                    yield Benefit(
+                        purchase_id=purchase_id, beneficiary_id=user,
+                        debt=first if index == 0 else debt)
+
+        _insert(Benefit, benefits())
+
+    def random_instant(self):
+
+        return self.start + datetime.timedelta(
+            seconds=self.rng.randint(
+                0, int((self.end - self.start).total_seconds())))
+
+
+def _insert(model, rows):
+
+    batch = []
+    for row in rows:
+
+        batch.append(row)
+
+        if len(batch) == BATCH_SIZE:
+
+            model.objects.bulk_create(batch)
+            batch = []
+
+    model.objects.bulk_create(batch)
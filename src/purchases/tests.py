@@ -5,7 +5,34 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import json
+import datetime
+from decimal import Decimal
+from StringIO import StringIO
+
 from django.test import TestCase
+from django.test.client import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.db import connection, models, IntegrityError
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.core.urlresolvers import reverse
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from django.utils import timezone
+
+from products.models import (
+    Section, Shop, Currency, Product, Price, CurrentPrice, ExchangeRate)
+from products.rates import MissingRate, exchange_rates
+from purchases.models import (
+    Purchase, Benefit, Balance, BalanceEntry, BalanceSnapshot, DailySpending,
+    ShoppingList, ShoppingListItem, balance_memo, _to_decimal)
+from purchases.views import (
+    PURCHASES_PER_PAGE, BALANCES_PER_PAGE, DEBTS_PER_PAGE, memoizing_balances)
+from purchases import reports, settlement, exports
+from purchases.synthetic import SyntheticData
+from shiny_ninja import profiling, benchmark
 
 
 class SimpleTest(TestCase):
@@ -14,3 +41,1496 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class PurchasesCase(TestCase):
+
+    def setUp(self):
+
+        section = Section.objects.create(name="Drinks")
+        shop = Shop.objects.create(name="Corner shop", description="")
+        product = Product.objects.create(
+            name="Juice", description="", section=section)
+
+        self.currency = Currency.objects.create(
+            name="Test euro", code="XEU", symbol="e")
+        self.price = Price.objects.create(
+            value=Decimal("10.00"), currency=self.currency,
+            shop=shop, product=product)
+
+        self.payer = User.objects.create_user("payer", password="secret")
+
+    def create_user(self, username):
+
+        return User.objects.create(username=username)
+
+    def create_purchase(self, amount=1):
+
+        return Purchase.objects.create(
+            product_price=self.price,
+            payer=self.payer,
+            amount=Decimal(amount))
+
+    def owed_to_payer(self, user):
+
+        balance = Balance.balance_between(self.payer, user, self.currency)
+
+        return (balance.first_owes_second
+                if balance.first_user == user
+                else balance.second_owes_first)
+
+
+class PurchaseAddBenefitTest(PurchasesCase):
+
+    def test_splits_cost_by_shares(self):
+
+        purchase = self.create_purchase()
+        users = [self.create_user("user%d" % i) for i in range(3)]
+
+        for user in users:
+
+            purchase.add_benefit(user, "1.0")
+
+        debts = sorted(benefit.debt for benefit in purchase.benefits())
+
+        self.assertEqual(
+            debts, [Decimal("3.33"), Decimal("3.33"), Decimal("3.34")])
+
+        self.assertEqual(
+            sum(self.owed_to_payer(user) for user in users),
+            Decimal("10.00"))
+
+    def test_payer_charges_themselves(self):
+
+        purchase = self.create_purchase()
+        other = self.create_user("other")
+
+        purchase.add_benefit(self.payer, 3)
+        purchase.add_benefit(other, 1)
+
+        self.assertEqual(self.owed_to_payer(self.payer), Decimal("7.50"))
+        self.assertEqual(self.owed_to_payer(other), Decimal("2.50"))
+
+    def test_costs_constant_number_of_queries(self):
+
+        purchase = self.create_purchase()
+        users = [self.create_user("user%d" % i) for i in range(30)]
+
+        counts = []
+        for user in users:
+
+            purchase = Purchase.objects.get(id=purchase.id)
+
+            with CaptureQueriesContext(connection) as queries:
+
+                purchase.add_benefit(user, 1)
+
+            counts.append(len(queries))
+
+        self.assertEqual(counts[2], counts[-1])
+        self.assertTrue(counts[-1] <= 18)
+        self.assertEqual(
+            sum(self.owed_to_payer(user) for user in users),
+            Decimal("10.00"))
+
+
+class BalanceBalanceBetweenTest(PurchasesCase):
+
+    def test_existing_balance_costs_one_query(self):
+
+        other = self.create_user("other")
+
+        created = Balance.balance_between(self.payer, other, self.currency)
+
+        with self.assertNumQueries(1):
+
+            found = Balance.balance_between(other, self.payer, self.currency)
+
+        self.assertEqual(found.id, created.id)
+
+    def test_memo_avoids_repeated_queries(self):
+
+        other = self.create_user("other")
+
+        with balance_memo():
+
+            created = Balance.balance_between(
+                self.payer, other, self.currency)
+
+            with self.assertNumQueries(0):
+
+                found = Balance.balance_between(
+                    other, self.payer, self.currency)
+
+        self.assertTrue(found is created)
+
+    def test_memoizing_views_look_balances_up_once(self):
+
+        other = self.create_user("other")
+        Balance.balance_between(self.payer, other, self.currency)
+        found = []
+
+        @memoizing_balances
+        def view(request):
+
+            for i in range(3):
+
+                found.append(Balance.balance_between(
+                    self.payer, other, self.currency))
+
+        with self.assertNumQueries(1):
+
+            view(None)
+
+        self.assertTrue(found[0] is found[1] is found[2])
+
+        with self.assertNumQueries(1):
+
+            Balance.balance_between(self.payer, other, self.currency)
+
+    def test_duplicates_are_rejected(self):
+
+        other = self.create_user("other")
+
+        Balance.balance_between(self.payer, other, self.currency)
+
+        self.assertRaises(
+            IntegrityError, Balance.objects.create,
+            first_user=self.payer, second_user=other,
+            currency=self.currency)
+
+
+class BalanceChargeTest(PurchasesCase):
+
+    def test_concurrent_charges_add_up(self):
+
+        other = self.create_user("other")
+
+        balance = Balance.balance_between(self.payer, other, self.currency)
+        stale = Balance.objects.get(id=balance.id)
+
+        with self.assertNumQueries(2):
+
+            balance.charge(other, Decimal("1.50"))
+
+        stale.charge(other, Decimal("2.00"))
+
+        self.assertEqual(self.owed_to_payer(other), Decimal("3.50"))
+
+    def test_charge_rejects_strangers(self):
+
+        other = self.create_user("other")
+        stranger = self.create_user("stranger")
+
+        balance = Balance.balance_between(self.payer, other, self.currency)
+
+        self.assertRaises(ValueError, balance.charge, stranger, 1)
+
+    def test_charge_many_nets_charges_per_balance(self):
+
+        users = [self.create_user("user%d" % i) for i in range(5)]
+        balances = Balance.balances_with(self.payer, users, self.currency)
+
+        charges = []
+        for user in users:
+
+            charges.append((balances[user.id], user, Decimal("2.00")))
+            charges.append((balances[user.id], user, Decimal("-0.50")))
+
+        with self.assertNumQueries(2):
+
+            Balance.charge_many(charges)
+
+        for user in users:
+
+            self.assertEqual(self.owed_to_payer(user), Decimal("1.50"))
+
+    def test_deleting_purchase_takes_unpaid_debts_back(self):
+
+        purchase = self.create_purchase()
+        users = [self.create_user("user%d" % i) for i in range(3)]
+
+        for user in users:
+
+            purchase.add_benefit(user, 1)
+
+        paid = purchase.benefits().get(beneficiary=users[0])
+        purchase.settle_debt(paid)
+
+        purchase_id = purchase.id
+        purchase.delete()
+
+        for user in users:
+
+            self.assertEqual(self.owed_to_payer(user), Decimal("0.00"))
+
+        self.assertFalse(
+            Benefit.objects.filter(purchase_id=purchase_id).exists())
+
+
+class BalanceLedgerTest(PurchasesCase):
+
+    def setUp(self):
+
+        super(BalanceLedgerTest, self).setUp()
+
+        self.users = [self.create_user("user%d" % i) for i in range(3)]
+
+        for i in range(2):
+
+            purchase = self.create_purchase()
+
+            for user in self.users:
+
+                purchase.add_benefit(user, 1)
+
+        purchase.settle_debt(purchase.benefits().get(beneficiary=self.users[0]))
+        self.create_purchase().delete()
+
+        self.balances = list(
+            Balance.objects.filter(currency=self.currency).order_by('id'))
+
+    def assertLedgerMatches(self):
+
+        totals = BalanceEntry.totals(self.balances)
+
+        for balance in Balance.objects.filter(currency=self.currency):
+
+            self.assertEqual(
+                totals[balance.id][:2],
+                (balance.first_owes_second, balance.second_owes_first))
+
+    def test_ledger_follows_balances(self):
+
+        self.assertLedgerMatches()
+
+    def test_totals_take_two_queries(self):
+
+        with self.assertNumQueries(2):
+
+            BalanceEntry.totals(self.balances)
+
+    def test_compaction_keeps_totals(self):
+
+        call_command(
+            'compact_balance_ledger', batch_size=2, stdout=StringIO())
+
+        self.assertEqual(
+            BalanceSnapshot.objects.filter(balance__in=self.balances).count(),
+            len(self.balances))
+
+        purchase = self.create_purchase()
+        purchase.add_benefit(self.users[1], 1)
+
+        call_command(
+            'compact_balance_ledger', batch_size=2, stdout=StringIO())
+
+        self.assertEqual(
+            BalanceSnapshot.objects.filter(balance__in=self.balances).count(),
+            len(self.balances))
+        self.assertLedgerMatches()
+
+    def test_verification_finds_and_repairs_differences(self):
+
+        # Opens the ledgers of the balances loaded from fixtures.
+        call_command('verify_balance_ledger', repair=True, stdout=StringIO())
+        call_command('verify_balance_ledger', stdout=StringIO())
+
+        Balance.objects.filter(id=self.balances[0].id).update(
+            first_owes_second=models.F('first_owes_second') + 1)
+
+        self.assertRaises(
+            CommandError, call_command,
+            'verify_balance_ledger', batch_size=2, stdout=StringIO())
+
+        call_command(
+            'verify_balance_ledger', batch_size=2, repair=True,
+            stdout=StringIO())
+
+        self.assertLedgerMatches()
+
+
+class BalanceBalancesOfTest(PurchasesCase):
+
+    def setUp(self):
+
+        super(BalanceBalancesOfTest, self).setUp()
+
+        self.dollar = Currency.objects.create(
+            name="Test dollar", code="XDL", symbol="d")
+
+        # The payer comes first in one balance and second in the others.
+        self.anna = User.objects.create_user("anna")
+        self.zoe = User.objects.create_user("zoe")
+
+        Balance.balance_between(self.payer, self.anna, self.currency).charge(
+            self.anna, Decimal("4.00"))
+        Balance.balance_between(self.payer, self.zoe, self.currency).charge(
+            self.payer, Decimal("2.50"))
+        Balance.balance_between(self.payer, self.zoe, self.dollar).charge(
+            self.zoe, Decimal("1.00"))
+        Balance.balance_between(self.payer, self.payer, self.currency).charge(
+            self.payer, Decimal("7.00"))
+
+    def rows(self, order='counterparty'):
+
+        return [(balance.counterparty_id, balance.counterparty_name,
+                 _to_decimal(balance.owed_by_user),
+                 _to_decimal(balance.owed_to_user),
+                 _to_decimal(balance.net), balance.currency.code)
+                for balance in Balance.balances_of(self.payer, order)]
+
+    def test_balances_are_oriented_towards_the_user(self):
+
+        with self.assertNumQueries(1):
+
+            rows = self.rows()
+
+        self.assertEqual(rows, [
+            (self.anna.id, "anna", Decimal("0"), Decimal("4"),
+             Decimal("4"), "XEU"),
+            (self.zoe.id, "zoe", Decimal("0"), Decimal("1"),
+             Decimal("1"), "XDL"),
+            (self.zoe.id, "zoe", Decimal("2.5"), Decimal("0"),
+             Decimal("-2.5"), "XEU")])
+
+    def test_ordered_by_amount(self):
+
+        self.assertEqual(
+            [(row[1], row[-1]) for row in self.rows('-net')],
+            [("anna", "XEU"), ("zoe", "XDL"), ("zoe", "XEU")])
+        self.assertEqual(
+            [(row[1], row[-1]) for row in self.rows('net')],
+            [("zoe", "XEU"), ("zoe", "XDL"), ("anna", "XEU")])
+
+    def test_links_keep_the_chosen_currency(self):
+
+        self.client.login(username="payer", password="secret")
+
+        response = self.client.get(
+            reverse('purchases.views.show_balances'),
+            {'currency': 'XDL', 'order': 'net'})
+
+        self.assertContains(response, '?order=-net&amp;currency=XDL"')
+        self.assertContains(
+            response, '<input name="order" value="net" type="hidden" />')
+
+    def test_view_queries_do_not_grow_with_counterparties(self):
+
+        self.client.login(username="payer", password="secret")
+        url = reverse('purchases.views.show_balances')
+
+        def queries():
+
+            with CaptureQueriesContext(connection) as context:
+
+                response = self.client.get(url, {'currency': 'XDL'})
+
+            self.assertEqual(response.status_code, 200)
+
+            return len(context)
+
+        # The first request loads the exchange rates too.
+        queries()
+        few = queries()
+
+        for i in range(BALANCES_PER_PAGE + 5):
+
+            Balance.balance_between(
+                self.payer, self.create_user("friend%d" % i),
+                self.currency).charge(self.payer, Decimal("1.00"))
+
+        self.assertEqual(queries(), few)
+
+        response = self.client.get(url, {'order': '-net', 'page': 2})
+
+        self.assertContains(response, "Page 2 of 2")
+        self.assertContains(response, "friend")
+        self.assertNotContains(response, "anna")
+
+
+class RebuildBalancesTest(PurchasesCase):
+
+    def setUp(self):
+
+        super(RebuildBalancesTest, self).setUp()
+
+        self.users = [self.create_user("user%d" % i) for i in range(3)]
+
+        for i in range(3):
+
+            purchase = self.create_purchase()
+
+            for user in [self.payer] + self.users:
+
+                purchase.add_benefit(user, 1)
+
+        purchase.settle_debt(purchase.benefits().get(beneficiary=self.users[0]))
+
+        self.expected = dict(
+            (user.id, self.owed_to_payer(user)) for user in self.users)
+
+        Balance.objects.filter(
+            Q(first_user=self.users[0]) | Q(second_user=self.users[0])).update(
+                first_owes_second=0, second_owes_first=0)
+        Balance.objects.filter(
+            Q(first_user=self.users[1]) | Q(second_user=self.users[1])).delete()
+
+    def test_dry_run_changes_nothing(self):
+
+        output = StringIO()
+        call_command('rebuild_balances', dry_run=True, stdout=output)
+
+        self.assertIn("Missing balance", output.getvalue())
+        self.assertEqual(self.owed_to_payer(self.users[0]), Decimal("0.00"))
+        self.assertFalse(
+            Balance.objects.filter(
+                Q(first_user=self.users[1]) |
+                Q(second_user=self.users[1])).exists())
+
+    def test_rebuilds_drifted_and_missing_balances(self):
+
+        call_command('rebuild_balances', chunk_size=2, stdout=StringIO())
+
+        for user in self.users:
+
+            self.assertEqual(self.owed_to_payer(user), self.expected[user.id])
+
+        output = StringIO()
+        call_command('rebuild_balances', dry_run=True, stdout=output)
+
+        self.assertIn("Would fix 0 balances and 0 missing", output.getvalue())
+
+        # The ledger is told about the corrections.
+        balances = Balance.objects.filter(currency=self.currency)
+        totals = BalanceEntry.totals(balances)
+
+        for balance in balances:
+
+            self.assertEqual(
+                totals[balance.id][:2],
+                (balance.first_owes_second, balance.second_owes_first))
+
+
+class PurchaseSettleDebtsTest(PurchasesCase):
+
+    def create_debts(self, purchases, users):
+
+        for i in range(purchases):
+
+            purchase = self.create_purchase()
+
+            for user in users:
+
+                purchase.add_benefit(user, 1)
+
+        return Benefit.objects.filter(beneficiary__in=users)
+
+    def test_settles_balances_and_flags(self):
+
+        users = [self.create_user("user%d" % i) for i in range(2)]
+        benefits = self.create_debts(3, users)
+
+        Purchase.settle_debts(benefits.filter(beneficiary=users[0]))
+
+        self.assertEqual(self.owed_to_payer(users[0]), Decimal("0.00"))
+        self.assertEqual(self.owed_to_payer(users[1]), Decimal("15.00"))
+
+        self.assertFalse(
+            benefits.filter(beneficiary=users[0], paid_off=False).exists())
+        self.assertFalse(
+            Purchase.objects.filter(
+                payer=self.payer, no_debt_paid_off=True).exists())
+
+    def test_paid_debts_are_not_settled_twice(self):
+
+        users = [self.create_user("user%d" % i) for i in range(2)]
+        benefits = self.create_debts(1, users)
+
+        Purchase.settle_debts(benefits.filter(beneficiary=users[0]))
+        Purchase.settle_debts(benefits)
+
+        for user in users:
+
+            self.assertEqual(self.owed_to_payer(user), Decimal("0.00"))
+
+    def test_costs_constant_number_of_queries(self):
+
+        users = [self.create_user("user%d" % i) for i in range(3)]
+
+        few = self.create_debts(2, users[:1])
+
+        with CaptureQueriesContext(connection) as few_queries:
+
+            Purchase.settle_debts(few)
+
+        many = self.create_debts(30, users[1:])
+
+        with CaptureQueriesContext(connection) as many_queries:
+
+            Purchase.settle_debts(many)
+
+        self.assertEqual(len(few_queries), len(many_queries))
+
+
+class DebtsViewTest(PurchasesCase):
+
+    def setUp(self):
+
+        super(DebtsViewTest, self).setUp()
+
+        self.obligor = self.create_user("obligor")
+        self.client.login(username="payer", password="secret")
+
+    def create_debts(self, count):
+
+        for i in range(count):
+
+            self.create_purchase().add_benefits(
+                [(self.obligor, 1), (self.payer, 1)])
+
+    def get(self, **params):
+
+        return self.client.get(
+            reverse('purchases.views.debts', args=(self.obligor.id,)),
+            params)
+
+    def test_unpaid_debts_come_from_the_balances(self):
+
+        self.create_debts(3)
+
+        with self.assertNumQueries(1):
+
+            debts = Balance.unpaid_debts(self.payer, self.obligor)
+
+        self.assertEqual(debts, [(self.currency, Decimal("15.00"))])
+        self.assertEqual(Balance.unpaid_debts(self.obligor, self.payer), [])
+
+    def test_queries_do_not_grow_with_debts(self):
+
+        self.create_debts(2)
+
+        with CaptureQueriesContext(connection) as few:
+
+            response = self.get()
+
+        self.assertContains(response, "10,00 XEU")
+
+        self.create_debts(DEBTS_PER_PAGE + 3)
+
+        with CaptureQueriesContext(connection) as many:
+
+            response = self.get()
+
+        self.assertEqual(len(few), len(many))
+        self.assertContains(response, "Page 1 of 2")
+
+        response = self.get(page=2)
+
+        self.assertEqual(response.content.count('name="settled"'), 5)
+
+    def test_unknown_obligor(self):
+
+        response = self.client.get(
+            reverse('purchases.views.debts', args=(12345,)))
+
+        self.assertEqual(response.status_code, 404)
+
+
+class ListPurchasesViewTest(PurchasesCase):
+
+    def setUp(self):
+
+        super(ListPurchasesViewTest, self).setUp()
+
+        self.client.login(username="payer", password="secret")
+
+    def create_purchases(self, count):
+
+        for i in range(count):
+
+            Purchase.objects.create(
+                product_price=self.price,
+                payer=self.payer,
+                date=datetime.date(2013, 11, 1) + datetime.timedelta(i % 7))
+
+    def test_query_count_does_not_depend_on_history_length(self):
+
+        self.create_purchases(1)
+
+        with self.assertNumQueries(3):
+
+            self.client.get(reverse('purchases.views.list_purchases'))
+
+        self.create_purchases(PURCHASES_PER_PAGE * 2)
+
+        with self.assertNumQueries(3):
+
+            response = self.client.get(
+                reverse('purchases.views.list_purchases'))
+
+        self.assertEqual(
+            len(response.context['purchases']), PURCHASES_PER_PAGE)
+
+    def test_pages_cover_whole_history_once(self):
+
+        self.create_purchases(PURCHASES_PER_PAGE * 2 + 3)
+
+        seen = []
+        params = {}
+        while True:
+
+            response = self.client.get(
+                reverse('purchases.views.list_purchases'), params)
+
+            seen.extend(purchase.id for purchase in response.context['purchases'])
+
+            last = response.context.get('next_page')
+
+            if last is None:
+
+                break
+
+            params = {'after_date': last.date.isoformat(),
+                      'after_id': last.id}
+
+        expected = Purchase.objects.filter(
+            payer=self.payer).order_by('date', '-id')
+
+        self.assertEqual(seen, [purchase.id for purchase in expected])
+
+
+class ExportTest(PurchasesCase):
+
+    def setUp(self):
+
+        super(ExportTest, self).setUp()
+
+        self.other = self.create_user("other")
+
+        for day in range(1, 6):
+
+            purchase = Purchase.objects.create(
+                product_price=self.price, payer=self.payer,
+                date=datetime.date(2013, 11, day))
+
+            purchase.add_benefit(self.other, 1)
+
+        self.client.login(username="payer", password="secret")
+
+    def export(self, kind, format, **params):
+
+        response = self.client.get(
+            reverse('purchases.views.export', args=(kind, format)), params)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+
+        return ''.join(response.streaming_content)
+
+    def test_purchases_as_csv(self):
+
+        lines = self.export(
+            'purchases', 'csv', **{'from': '2013-11-02', 'to': '2013-11-04'}
+        ).splitlines()
+
+        self.assertEqual(lines[0], "id,date,product,shop,amount,price,currency")
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].split(',')[1] == '2013-11-02')
+
+    def test_benefits_as_json_resume_after_id(self):
+
+        rows = json.loads(self.export('benefits', 'json'))
+
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['beneficiary'], "other")
+        self.assertEqual(rows[0]['debt'], "10.00")
+
+        rest = json.loads(
+            self.export('benefits', 'json', after=rows[1]['id']))
+
+        self.assertEqual(rest, rows[2:])
+
+    def test_rows_are_read_in_chunks(self):
+
+        queryset = exports.exported('purchases', self.payer)
+
+        with self.assertNumQueries(3):
+
+            ids = [row[0] for row in
+                   exports.rows(queryset, ['id'], per_query=2)]
+
+        self.assertEqual(
+            ids, list(queryset.order_by('id').values_list('id', flat=True)))
+
+    def test_balances_and_unknown_exports(self):
+
+        rows = json.loads(self.export('balances', 'json'))
+
+        self.assertEqual(
+            [(row['first_owes_second'], row['second_owes_first'])
+             for row in rows
+             if "other" in (row['first_user'], row['second_user'])],
+            [("0.00", "50.00")])
+
+        response = self.client.get(
+            reverse('purchases.views.export', args=('benefits', 'csv')
+                    ).replace('csv', 'xml'))
+
+        self.assertEqual(response.status_code, 404)
+
+
+class ApiTest(PurchasesCase):
+
+    def setUp(self):
+
+        super(ApiTest, self).setUp()
+
+        self.client.login(username="payer", password="secret")
+
+    def create_through_api(self, beneficiaries, share=1, **fields):
+
+        price = self.price
+
+        data = {
+            'product': price.product_id,
+            'shop': price.shop_id,
+            'currency': price.currency_id,
+            'value': "10.00",
+            'amount': "2",
+            'beneficiaries': [
+                {'user': user.id, 'share': share} for user in beneficiaries]}
+        data.update(fields)
+
+        return self.client.post(
+            reverse('purchases.api.purchases'), json.dumps(data),
+            content_type='application/json')
+
+    def test_creates_purchase_with_beneficiaries(self):
+
+        users = [self.create_user("user%d" % i) for i in range(4)]
+
+        response = self.create_through_api(users)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            [benefit['debt'] for benefit in json.loads(response.content)[
+                'benefits']],
+            ["5.00"] * 4)
+
+        for user in users:
+
+            self.assertEqual(self.owed_to_payer(user), Decimal("5.00"))
+
+    def test_creation_costs_do_not_depend_on_beneficiaries(self):
+
+        # The first purchase of the day also creates its spending rows.
+        counts = []
+        for beneficiaries in (1, 2, 20):
+
+            users = [self.create_user("user%d_%d" % (beneficiaries, i))
+                     for i in range(beneficiaries)]
+
+            with CaptureQueriesContext(connection) as queries:
+
+                self.create_through_api(users)
+
+            counts.append(len(queries))
+
+        self.assertEqual(counts[1], counts[2])
+
+    def test_rejects_malformed_purchases(self):
+
+        response = self.client.post(
+            reverse('purchases.api.purchases'), "{}",
+            content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_non_positive_amounts_and_shares(self):
+
+        user = self.create_user("user")
+
+        for response in [self.create_through_api([user], share="0"),
+                         self.create_through_api([user], share="-1"),
+                         self.create_through_api([user], amount="-2"),
+                         self.create_through_api([user], amount="0"),
+                         self.create_through_api([user], date="yesterday")]:
+
+            self.assertEqual(response.status_code, 400)
+
+        self.assertFalse(Purchase.objects.filter(payer=self.payer).exists())
+
+    def test_posts_need_no_csrf_token_but_must_be_json(self):
+
+        self.client = Client(enforce_csrf_checks=True)
+        self.client.login(username="payer", password="secret")
+
+        self.assertEqual(self.create_through_api([]).status_code, 201)
+
+        response = self.client.post(
+            reverse('purchases.api.purchases'), {'product': 1})
+
+        self.assertEqual(response.status_code, 415)
+
+    def test_lists_pages_with_selected_fields_and_etags(self):
+
+        for i in range(3):
+
+            self.create_purchase()
+
+        url = reverse('purchases.api.purchases')
+        response = self.client.get(url, {'limit': 2, 'fields': 'id,amount'})
+        page = json.loads(response.content)
+
+        self.assertEqual(
+            [sorted(item) for item in page['results']],
+            [['amount', 'id']] * 2)
+
+        rest = json.loads(
+            self.client.get(url, {'after': page['next']}).content)
+
+        self.assertEqual(len(rest['results']), 1)
+
+        again = self.client.get(
+            url, {'limit': 2, 'fields': 'id,amount'},
+            HTTP_IF_NONE_MATCH=response['ETag'])
+
+        self.assertEqual(again.status_code, 304)
+
+    def test_zero_limit_returns_one_item(self):
+
+        self.create_purchase()
+
+        response = self.client.get(
+            reverse('purchases.api.purchases'), {'limit': 0})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['results']), 1)
+
+    def test_requires_login(self):
+
+        self.client.logout()
+
+        response = self.client.get(reverse('purchases.api.balances'))
+
+        self.assertEqual(response.status_code, 401)
+
+
+class ShoppingListTest(PurchasesCase):
+
+    def setUp(self):
+
+        super(ShoppingListTest, self).setUp()
+
+        self.shop = self.price.shop
+        self.product = self.price.product
+        self.other_shop = Shop.objects.create(name="Market", description="")
+        self.product.change_current_price(
+            self.other_shop, Decimal("8.00"), self.currency)
+
+        self.shopping_list = ShoppingList.objects.create(
+            owner=self.payer, name="Weekend")
+        ShoppingListItem.objects.create(
+            shopping_list=self.shopping_list, product=self.product,
+            quantity=2)
+
+    def totals(self):
+
+        return dict(
+            (total.shop_id, (total.total, total.items))
+            for total in self.shopping_list.current_totals())
+
+    def test_totals_follow_items(self):
+
+        self.assertEqual(
+            self.totals(),
+            {self.shop.id: (Decimal("20.00"), 1),
+             self.other_shop.id: (Decimal("16.00"), 1)})
+
+        item = self.shopping_list.items.get()
+        item.quantity = 3
+        item.save()
+
+        self.assertEqual(self.totals()[self.shop.id], (Decimal("30.00"), 1))
+
+        item.delete()
+
+        self.assertEqual(self.totals(), {})
+
+    def test_new_prices_are_applied_incrementally(self):
+
+        self.product.change_current_price(
+            self.shop, Decimal("9.50"), self.currency)
+
+        self.product.mark_unavailable(self.other_shop)
+
+        with self.assertNumQueries(2):
+
+            self.assertEqual(
+                self.totals(), {self.shop.id: (Decimal("19.00"), 1)})
+
+    def test_scheduled_prices_are_picked_up_once_in_effect(self):
+
+        now = timezone.now()
+
+        scheduled = Price.objects.create(
+            value=Decimal("5.00"), currency=self.currency,
+            shop=self.shop, product=self.product,
+            since=now + datetime.timedelta(days=1))
+
+        self.assertEqual(self.totals()[self.shop.id], (Decimal("20.00"), 1))
+
+        Price.objects.filter(id=scheduled.id).update(since=timezone.now())
+        ShoppingList.objects.filter(id=self.shopping_list.id).update(
+            priced_at=now - datetime.timedelta(hours=2))
+        CurrentPrice.objects.all().delete()
+
+        self.shopping_list = ShoppingList.objects.get(id=self.shopping_list.id)
+
+        self.assertEqual(self.totals()[self.shop.id], (Decimal("10.00"), 1))
+
+    def test_prices_appended_in_bulk(self):
+
+        Price.objects.bulk_append([
+            Price(value=Decimal("7.00"), currency=self.currency,
+                  shop=self.other_shop, product=self.product)])
+
+        self.assertEqual(
+            self.totals()[self.other_shop.id], (Decimal("14.00"), 1))
+
+    def test_buying_inserts_purchases_in_bulk(self):
+
+        section = self.product.section
+        products = [
+            Product.objects.create(
+                name="Extra %d" % i, description="", section=section)
+            for i in range(10)]
+
+        for product in products:
+
+            product.change_current_price(
+                self.shop, Decimal("1.00"), self.currency)
+
+        bought, missing = self.shopping_list.buy(self.other_shop, self.payer)
+
+        self.assertEqual((bought, missing), (1, []))
+
+        for product in products:
+
+            ShoppingListItem.objects.create(
+                shopping_list=self.shopping_list, product=product)
+
+        with self.assertNumQueries(8):
+
+            bought, missing = self.shopping_list.buy(self.shop, self.payer)
+
+        self.assertEqual((bought, missing), (11, []))
+
+        today = DailySpending.objects.get(
+            user=self.payer, currency=self.currency, section=section,
+            day=datetime.date.today())
+
+        self.assertEqual(today.paid, Decimal("46.00"))
+        self.assertEqual(today.consumed, Decimal("46.00"))
+
+    def test_views(self):
+
+        self.client.login(username="payer", password="secret")
+
+        response = self.client.get(
+            reverse('purchases.views.show_shopping_list',
+                    args=(self.shopping_list.id,)))
+
+        self.assertContains(response, "Market")
+
+        response = self.client.post(
+            reverse('purchases.views.buy_shopping_list',
+                    args=(self.shopping_list.id,)),
+            {'shop_id': self.other_shop.id})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            Purchase.objects.filter(
+                payer=self.payer, product_price__shop=self.other_shop).count(),
+            1)
+
+    def test_buying_needs_a_post_with_a_known_shop(self):
+
+        self.client.login(username="payer", password="secret")
+        url = reverse('purchases.views.buy_shopping_list',
+                      args=(self.shopping_list.id,))
+
+        self.assertEqual(self.client.get(url).status_code, 405)
+
+        for params in [{}, {'shop_id': 'market'}, {'shop_id': 12345}]:
+
+            self.assertEqual(self.client.post(url, params).status_code, 404)
+
+        self.assertFalse(Purchase.objects.filter(payer=self.payer).exists())
+
+
+class SpendingReportTest(PurchasesCase):
+
+    def setUp(self):
+
+        super(SpendingReportTest, self).setUp()
+
+        other_product = Product.objects.create(
+            name="Bread", description="",
+            section=Section.objects.create(name="Bakery"))
+
+        self.other_price = Price.objects.create(
+            value=Decimal("2.50"), currency=self.currency,
+            shop=self.price.shop, product=other_product)
+
+        for day, price, amount in [(1, self.price, 1),
+                                   (2, self.other_price, 2),
+                                   (8, self.price, 3),
+                                   (30, self.other_price, 1)]:
+
+            Purchase.objects.create(
+                product_price=price, payer=self.payer,
+                amount=Decimal(amount),
+                date=datetime.date(2013, 11, day))
+
+    def test_monthly_totals_use_one_query(self):
+
+        with self.assertNumQueries(1):
+
+            rows = reports.spending(
+                self.payer, datetime.date(2013, 11, 1),
+                datetime.date(2013, 11, 30))
+
+        self.assertEqual(rows, [{'period': datetime.date(2013, 11, 1),
+                                 'currency': "XEU",
+                                 'total': Decimal("47.50")}])
+
+    def test_weekly_totals_by_section(self):
+
+        rows = reports.spending(
+            self.payer, datetime.date(2013, 11, 1),
+            datetime.date(2013, 11, 10), 'week', ['section'])
+
+        self.assertEqual(
+            [(row['period'], row['section'], row['total']) for row in rows],
+            [(datetime.date(2013, 10, 28), "Bakery", Decimal("5.00")),
+             (datetime.date(2013, 10, 28), "Drinks", Decimal("10.00")),
+             (datetime.date(2013, 11, 4), "Drinks", Decimal("30.00"))])
+
+    def test_view_renders(self):
+
+        self.client.login(username="payer", password="secret")
+
+        response = self.client.get(
+            reverse('purchases.views.spending_report'),
+            {'from': '2013-11-01', 'to': '2013-11-30', 'by': 'shop'})
+
+        self.assertContains(response, "47,50")
+
+
+class CurrencyConversionTest(PurchasesCase):
+
+    def setUp(self):
+
+        super(CurrencyConversionTest, self).setUp()
+
+        self.zloty = Currency.objects.create(
+            name="Test zloty", code="XZL", symbol="z")
+        self.zloty_price = Price.objects.create(
+            value=Decimal("8.00"), currency=self.zloty,
+            shop=self.price.shop, product=self.price.product)
+
+        for day, rate in [(1, "4"), (15, "5")]:
+
+            ExchangeRate.objects.create(
+                source=self.currency, target=self.zloty, rate=Decimal(rate),
+                day=datetime.date(2013, 11, day))
+
+        self.friend = User.objects.create_user("friend", password="secret")
+
+    def tearDown(self):
+
+        exchange_rates.invalidate()
+
+    def test_spending_converted_at_the_rates_of_each_day(self):
+
+        for day, price in [(2, self.price), (3, self.zloty_price),
+                           (20, self.zloty_price)]:
+
+            Purchase.objects.create(
+                product_price=price, payer=self.payer, amount=Decimal(1),
+                date=datetime.date(2013, 11, day))
+
+        with self.assertNumQueries(3):
+
+            rows = reports.spending(
+                self.payer, datetime.date(2013, 11, 1),
+                datetime.date(2013, 11, 30), currency=self.currency)
+
+        self.assertEqual(rows, [{'period': datetime.date(2013, 11, 1),
+                                 'currency': "XEU",
+                                 'total': Decimal("13.60")}])
+
+        with self.assertRaises(MissingRate):
+
+            reports.spending(
+                self.payer, datetime.date(2013, 10, 1),
+                datetime.date(2013, 11, 30), 'day',
+                currency=Currency.objects.create(
+                    name="Test dollar", code="XDL", symbol="d"))
+
+    def test_net_balance_across_currencies(self):
+
+        dollar = Currency.objects.create(
+            name="Test dollar", code="XDL", symbol="d")
+
+        for currency, owed in [(self.currency, "5.00"),
+                               (self.zloty, "20.00"),
+                               (dollar, "1.00")]:
+
+            Balance.balance_between(
+                self.payer, self.friend, currency).charge(
+                    self.friend, Decimal(owed))
+
+        Balance.balance_between(
+            self.payer, self.payer, self.currency).charge(
+                self.payer, Decimal("3.00"))
+
+        ExchangeRate.table()
+
+        with self.assertNumQueries(1):
+
+            net, unconverted = Balance.net_of(
+                self.payer, self.currency, datetime.date(2013, 11, 20))
+
+        self.assertEqual(net, [(self.friend, Decimal("9.00"))])
+        self.assertEqual(unconverted, [dollar])
+
+        net, unconverted = Balance.net_of(
+            self.friend, self.zloty, datetime.date(2013, 11, 2))
+
+        self.assertEqual(net, [(self.payer, Decimal("-40.00"))])
+
+        self.client.login(username="payer", password="secret")
+
+        response = self.client.get(
+            reverse('purchases.views.show_balances'), {'currency': 'XZL'})
+
+        self.assertContains(response, "45,00 XZL")
+        self.assertContains(response, "XDL")
+
+
+@override_settings(QUERY_STATS_SAMPLE_RATE=0)
+class QueryStatsTest(PurchasesCase):
+
+    def setUp(self):
+
+        super(QueryStatsTest, self).setUp()
+
+        profiling.query_stats.clear()
+        self.client.login(username="payer", password="secret")
+
+    def tearDown(self):
+
+        profiling.query_stats.clear()
+
+    def test_unsampled_requests_are_left_alone(self):
+
+        with override_settings(QUERY_STATS_SAMPLE_RATE=0):
+
+            response = self.client.get(
+                reverse('purchases.views.list_purchases'))
+
+        self.assertFalse(response.has_header('X-Query-Count'))
+        self.assertEqual(profiling.query_stats.sampled, 0)
+
+    def test_sampled_requests_report_queries_in_headers(self):
+
+        self.create_purchase()
+
+        with override_settings(QUERY_STATS_SAMPLE_RATE=1):
+
+            response = self.client.get(
+                reverse('purchases.views.list_purchases'))
+
+        self.assertGreater(int(response['X-Query-Count']), 0)
+        self.assertGreaterEqual(float(response['X-Query-Template-Time']), 0)
+        self.assertGreaterEqual(
+            float(response['X-Query-Total-Time']),
+            float(response['X-Query-Time']))
+
+        rows = profiling.query_stats.report()
+
+        self.assertEqual(
+            [row['view'] for row in rows],
+            ['purchases.views.list_purchases'])
+        self.assertEqual(
+            rows[0]['queries'], int(response['X-Query-Count']))
+
+    def test_repeated_statements_are_grouped(self):
+
+        queries = [
+            {'sql': 'SELECT * FROM "balance" WHERE "id" = 1', 'time': '0.001'},
+            {'sql': 'SELECT * FROM "balance" WHERE "id" = 1', 'time': '0.001'},
+            {'sql': 'SELECT * FROM "balance" WHERE "id" = 2', 'time': '0.001'},
+            {'sql': 'SELECT * FROM "price" WHERE "id" IN (1, 2)',
+             'time': '0.002'}]
+
+        summary = profiling.summarize(queries)
+
+        self.assertEqual(summary['queries'], 4)
+        self.assertEqual(summary['duplicates'], 1)
+        self.assertAlmostEqual(summary['sql_seconds'], 0.005)
+        self.assertEqual(
+            summary['repeated'],
+            {'SELECT * FROM "balance" WHERE "id" = ?': 3})
+
+    def test_stats_are_only_shown_to_staff(self):
+
+        url = reverse('shiny_ninja.profiling.query_stats_view')
+
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.payer.is_staff = True
+        self.payer.save()
+
+        with override_settings(QUERY_STATS_SAMPLE_RATE=1):
+
+            self.client.get(reverse('purchases.views.list_purchases'))
+
+        data = json.loads(self.client.get(url).content)
+
+        self.assertEqual(data['sampled'], 1)
+        self.assertEqual(
+            [row['view'] for row in data['results']],
+            ['purchases.views.list_purchases'])
+
+
+class SyntheticDataTest(TestCase):
+
+    def create(self, seed=0):
+
+        return SyntheticData(
+            users=4, shops=2, products=3, history=5, purchases=40,
+            beneficiaries=3, seed=seed).create()
+
+    def test_data_is_reproducible(self):
+
+        def values(data):
+
+            purchases = Purchase.objects.filter(
+                product_price__currency=data.currency).order_by('id')
+
+            return ([price[1] for price in data.prices],
+                    [(purchase.amount, purchase.date,
+                      data.users.index(purchase.payer))
+                     for purchase in purchases])
+
+        self.assertEqual(values(self.create()), values(self.create()))
+        self.assertNotEqual(
+            values(self.create()), values(self.create(seed=1)))
+
+    def test_debts_add_up_and_balances_follow(self):
+
+        data = self.create()
+
+        self.assertEqual(len(data.prices), 2 * 3 * 5)
+
+        purchases = Purchase.objects.filter(
+            product_price__currency=data.currency)
+
+        self.assertEqual(purchases.count(), 40)
+
+        for purchase in purchases.select_related('product_price'):
+
+            self.assertEqual(
+                sum(benefit.debt for benefit in purchase.benefit_set.all()),
+                purchase.amount * purchase.product_price.value)
+
+            self.assertTrue(
+                purchase.product_price.since.date() <= purchase.date)
+
+        output = StringIO()
+        call_command('rebuild_balances', dry_run=True, stdout=output)
+
+        self.assertIn("Would fix 0 balances and 0 missing", output.getvalue())
+
+    def test_regressions(self):
+
+        baseline = {'price_at': {'median_ms': 1.0, 'queries': 1.0},
+                    'add_benefit': {'median_ms': 5.0, 'queries': 8.0}}
+
+        results = {'price_at': {'median_ms': 1.2, 'queries': 1.0},
+                   'add_benefit': {'median_ms': 9.0, 'queries': 9.0},
+                   'show_balances': {'median_ms': 50.0, 'queries': 9.0}}
+
+        self.assertEqual(
+            benchmark.regressions(results, baseline, 0.25),
+            ["add_benefit: median 9.000 ms, was 5.000 ms",
+             "add_benefit: 9.0 queries per call, was 8.0"])
+
+
+class DailySpendingTest(PurchasesCase):
+
+    def rollup(self):
+
+        return dict(
+            ((row.user_id, row.day), (row.paid, row.consumed))
+            for row in DailySpending.objects.filter(
+                currency=self.currency))
+
+    def test_follows_purchases_benefits_and_deletion(self):
+
+        other = self.create_user("other")
+        day = datetime.date(2013, 11, 14)
+
+        purchase = Purchase.objects.create(
+            product_price=self.price, payer=self.payer,
+            amount=Decimal(2), date=day)
+
+        self.assertEqual(
+            self.rollup(),
+            {(self.payer.id, day): (Decimal("20.00"), Decimal("20.00"))})
+
+        purchase.add_benefit(self.payer, 1)
+        purchase.add_benefit(other, 3)
+
+        self.assertEqual(
+            self.rollup(),
+            {(self.payer.id, day): (Decimal("20.00"), Decimal("5.00")),
+             (other.id, day): (Decimal("0.00"), Decimal("15.00"))})
+
+        purchase.delete()
+
+        self.assertEqual(
+            set(self.rollup().values()),
+            set([(Decimal("0.00"), Decimal("0.00"))]))
+
+    def test_moves_with_edited_purchase(self):
+
+        purchase = Purchase.objects.create(
+            product_price=self.price, payer=self.payer,
+            date=datetime.date(2013, 11, 14))
+
+        purchase.date = datetime.date(2013, 11, 15)
+        purchase.amount = Decimal(3)
+        purchase.save()
+
+        self.assertEqual(
+            self.rollup(),
+            {(self.payer.id, datetime.date(2013, 11, 14)):
+                (Decimal("0.00"), Decimal("0.00")),
+             (self.payer.id, datetime.date(2013, 11, 15)):
+                (Decimal("30.00"), Decimal("30.00"))})
+
+    def test_rebuild_matches_incremental_updates(self):
+
+        other = self.create_user("other")
+
+        for day in range(1, 4):
+
+            purchase = Purchase.objects.create(
+                product_price=self.price, payer=self.payer,
+                date=datetime.date(2013, 11, day))
+
+            purchase.add_benefit(other, day)
+
+        expected = self.rollup()
+
+        DailySpending.objects.all().delete()
+        call_command(
+            'rebuild_spending_rollup', chunk_size=2, stdout=StringIO())
+
+        self.assertEqual(self.rollup(), expected)
+
+    def test_report_of_consumption(self):
+
+        other = self.create_user("other")
+
+        purchase = Purchase.objects.create(
+            product_price=self.price, payer=self.payer,
+            date=datetime.date(2013, 11, 14))
+        purchase.add_benefit(other, 1)
+
+        rows = reports.spending(
+            other, datetime.date(2013, 11, 1), datetime.date(2013, 11, 30),
+            measure='consumed')
+
+        self.assertEqual(
+            [row['total'] for row in rows], [Decimal("10.00")])
+
+
+class SettlementTest(PurchasesCase):
+
+    def test_net_positions_use_one_query(self):
+
+        users = [self.create_user("user%d" % i) for i in range(3)]
+        balances = Balance.balances_with(self.payer, users, self.currency)
+
+        Balance.charge_many(
+            (balances[user.id], user, Decimal(i + 1))
+            for i, user in enumerate(users))
+
+        with self.assertNumQueries(1):
+
+            positions = settlement.net_positions(self.currency)
+
+        self.assertEqual(
+            positions,
+            {self.payer.id: 600, users[0].id: -100,
+             users[1].id: -200, users[2].id: -300})
+
+    def test_greedy_plan_settles_everybody(self):
+
+        positions = {1: 500, 2: -300, 3: -150, 4: -50}
+
+        transfers = settlement.plan(positions)
+
+        for debtor, creditor, amount in transfers:
+
+            positions[debtor] += int(amount * 100)
+            positions[creditor] -= int(amount * 100)
+
+        self.assertEqual(set(positions.values()), set([0]))
+        self.assertTrue(len(transfers) <= 3)
+
+    def test_exact_plan_uses_independent_groups(self):
+
+        # 1 and 2 can settle with each other, as can 3, 4 and 5.
+        positions = {1: 700, 2: -700, 3: 500, 4: -200, 5: -300}
+
+        self.assertEqual(len(settlement.plan(positions, exact=True)), 3)
+
+    def test_plan_rejects_unbalanced_positions(self):
+
+        self.assertRaises(ValueError, settlement.plan, {1: 100, 2: -50})
+
+    def test_api(self):
+
+        other = self.create_user("other")
+        balance = Balance.balance_between(self.payer, other, self.currency)
+        balance.charge(other, Decimal("2.50"))
+
+        self.client.login(username="payer", password="secret")
+
+        response = self.client.get(
+            reverse('purchases.views.settlement_api',
+                    args=[self.currency.id]))
+
+        self.assertEqual(
+            json.loads(response.content),
+            {'currency': "XEU",
+             'transfers': [{'from': "other", 'to': "payer",
+                            'amount': "2.50"}]})
+
+    def test_unknown_currency(self):
+
+        self.client.login(username="payer", password="secret")
+
+        for view in ['show_settlement', 'settlement_api']:
+
+            response = self.client.get(
+                reverse('purchases.views.%s' % view, args=(12345,)))
+
+            self.assertEqual(response.status_code, 404)
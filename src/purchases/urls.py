@@ -14,4 +14,17 @@ urlpatterns = patterns(
     url(r'^purchase/(\d+)/add_beneficiary/$', 'add_beneficiary'),
     url(r'^purchase/new/handle/$', 'handle_new_purchase'),
     url(r'^purchase/(\d+)/delete/$', 'delete_purchase'),
-    url(r'^debts/(\d+)/$', 'debts'))
+    url(r'^debts/(\d+)/$', 'debts'),
+    url(r'^spending/$', 'spending_report'),
+    url(r'^settlement/(\d+)/$', 'show_settlement'),
+    url(r'^api/settlement/(\d+)/$', 'settlement_api'),
+    url(r'^lists/$', 'shopping_lists'),
+    url(r'^lists/(\d+)/$', 'show_shopping_list'),
+    url(r'^lists/(\d+)/buy/$', 'buy_shopping_list'),
+    url(r'^export/(purchases|benefits|balances)\.(csv|json)$', 'export'))
+
+urlpatterns += patterns(
+    'purchases.api',
+    url(r'^api/purchases/$', 'purchases'),
+    url(r'^api/benefits/$', 'benefits'),
+    url(r'^api/balances/$', 'balances'))
@@ -1,16 +1,44 @@
 # -*- coding: utf-8 -*-
 
+import datetime
 from decimal import Decimal
+from functools import wraps
 
 from django.core.context_processors import csrf
-from django.db.models import Sum
-from django.shortcuts import render_to_response, redirect
+from django.db.models import Sum, Q
+from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
+from django.shortcuts import render_to_response, redirect, get_object_or_404
+from django.http import StreamingHttpResponse, Http404
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import require_POST
 from django.contrib.auth.models import User
+from django.utils.dateparse import parse_date
+from django.conf import settings
 
 from products.models import Product, Shop, Price, Currency
+from products.rates import MissingRate
 
-from purchases.models import Purchase, Benefit, Balance
+from shiny_ninja.api import json_response
+from purchases.models import (
+    Purchase, Benefit, Balance, ShoppingList, ShoppingListItem, balance_memo)
+from purchases import reports, settlement, exports
+
+
+def memoizing_balances(view):
+    """Runs the view with balance_memo on.
+
+    For views charging the same balances repeatedly, so each is only
+    looked up once per request.
+    """
+
+    @wraps(view)
+    def memoizing_view(request, *args, **kwargs):
+
+        with balance_memo():
+
+            return view(request, *args, **kwargs)
+
+    return memoizing_view
 
 
 @login_required
@@ -111,6 +139,7 @@ def show_purchase(request, purchase_id):
         ctx)
 
 
+@memoizing_balances
 def add_beneficiary(request, purchase_id):
 
     purchase = Purchase.objects.get(
@@ -136,6 +165,9 @@ def add_beneficiary(request, purchase_id):
     return redirect(show_purchase, purchase_id)
 
 
+BALANCES_PER_PAGE = 50
+
+
 @login_required
 def show_balances(request):
 
@@ -143,24 +175,49 @@ def show_balances(request):
 
     user = ctx['me'] = request.user
 
-    own_balances = ctx['own_balances'] = (Balance.objects.
-        filter(first_user=user, second_user=user))
+    ctx['own_balances'] = (Balance.objects.
+        filter(first_user=user, second_user=user).
+        select_related('currency'))
+
+    order = request.GET.get('order', 'counterparty')
+
+    if order not in Balance.ORDERS:
+
+        order = 'counterparty'
+
+    ctx['order'] = order
+
+    paginator = Paginator(Balance.balances_of(user, order), BALANCES_PER_PAGE)
+
+    try:
+
+        ctx['balances'] = paginator.page(request.GET.get('page', 1))
+
+    except PageNotAnInteger:
+
+        ctx['balances'] = paginator.page(1)
 
-    balances_me_first = ctx['balances_me_first'] = (Balance.objects.
-        filter(first_user=user).
-        exclude(second_user=user).
-        order_by('second_user'))
+    except EmptyPage:
 
-    balances_me_second = ctx['balances_me_second'] = (Balance.objects.
-        filter(second_user=user).
-        exclude(first_user=user).
-        order_by('first_user'))
+        ctx['balances'] = paginator.page(paginator.num_pages)
+
+    currency = ctx['net_currency'] = _chosen_currency(request)
+
+    if currency is not None:
+
+        ctx['net'], ctx['unconverted'] = Balance.net_of(user, currency)
+
+    ctx['currencies'] = Currency.objects.order_by('code')
 
     return render_to_response(
         'purchases/my_balance.html',
         ctx)
 
+DEBTS_PER_PAGE = 100
+
+
 @login_required
+@memoizing_balances
 def debts(request, obligor_id):
 
     if request.method == 'GET':
@@ -176,12 +233,31 @@ def show_debts(request, obligor_id):
 
     ctx = csrf(request)
 
-    obligor = ctx["obligor"] = User.objects.get(id=obligor_id)
+    obligor = ctx["obligor"] = get_object_or_404(User, id=obligor_id)
 
-    benefits = ctx["benefits"] = Benefit.objects.filter(
-        purchase__payer=request.user,
-        beneficiary=obligor,
-        paid_off=False)
+    benefits = (Benefit.objects.
+        filter(purchase__payer=request.user,
+               beneficiary=obligor,
+               paid_off=False).
+        select_related('purchase__product_price__product',
+                       'purchase__product_price__currency').
+        order_by('-purchase__date', '-id'))
+
+    paginator = Paginator(benefits, DEBTS_PER_PAGE)
+
+    try:
+
+        ctx["benefits"] = paginator.page(request.GET.get('page', 1))
+
+    except PageNotAnInteger:
+
+        ctx["benefits"] = paginator.page(1)
+
+    except EmptyPage:
+
+        ctx["benefits"] = paginator.page(paginator.num_pages)
+
+    ctx["totals"] = Balance.unpaid_debts(request.user, obligor)
 
     return render_to_response(
         "purchases/debts.html",
@@ -193,25 +269,58 @@ def settle_debts(request, obligor_id):
     obligor = User.objects.get(id=obligor_id)
 
     settled_debts = Benefit.objects.filter(
-        id__in=request.POST.getlist('settled'))
-
-    for benefit in settled_debts:
+        id__in=request.POST.getlist('settled'),
+        purchase__payer=request.user,
+        beneficiary=obligor)
 
-        benefit.purchase.settle_debt(benefit)
+    Purchase.settle_debts(settled_debts)
 
     return redirect(debts, obligor_id)
 
+PURCHASES_PER_PAGE = 50
+
+
 @login_required
 def list_purchases(request):
 
     user = request.user
 
-    purchases = Purchase.objects.filter(payer=user).order_by('date', '-id')
+    purchases = (Purchase.objects.
+        filter(payer=user).
+        select_related('product_price__product', 'product_price__shop').
+        order_by('date', '-id'))
+
+    # Keyset pagination: a page starts right after the (date, id) of the
+    # last purchase shown, so deep pages cost as much as the first one.
+    try:
+
+        after_date = parse_date(request.GET.get('after_date', ''))
+
+    except ValueError:
+
+        after_date = None
+
+    after_id = request.GET.get('after_id', '')
+
+    if after_date is not None and after_id.isdigit():
+
+        purchases = purchases.filter(
+            Q(date__gt=after_date) |
+            Q(date=after_date, id__lt=int(after_id)))
+
+    page = list(purchases[:PURCHASES_PER_PAGE + 1])
+
+    ctx = {'purchases': page[:PURCHASES_PER_PAGE]}
+
+    if len(page) > PURCHASES_PER_PAGE:
+
+        ctx['next_page'] = page[PURCHASES_PER_PAGE - 1]
 
     return render_to_response(
         'purchases/list_purchases.html',
-        {'purchases': purchases})
+        ctx)
 
+@memoizing_balances
 def delete_purchase(request, purchase_id):
 
     purchase = Purchase.objects.get(
@@ -230,3 +339,216 @@ def delete_purchase(request, purchase_id):
     purchase.delete()
 
     return redirect(list_purchases)
+
+
+@login_required
+def spending_report(request):
+
+    today = datetime.date.today()
+
+    try:
+
+        start = parse_date(request.GET.get('from', ''))
+        end = parse_date(request.GET.get('to', ''))
+
+    except ValueError:
+
+        start = end = None
+
+    start = start or today.replace(day=1) - datetime.timedelta(days=365)
+    end = end or today
+
+    period = request.GET.get('period', 'month')
+
+    if period not in reports.PERIODS:
+
+        period = 'month'
+
+    by = request.GET.getlist('by')
+
+    currency = None
+
+    if request.GET.get('currency'):
+
+        currency = _chosen_currency(request)
+
+    try:
+
+        rows = reports.spending(
+            request.user, start, end, period, by, currency=currency)
+        missing_rate = None
+
+    except MissingRate as error:
+
+        rows = []
+        missing_rate = error
+
+    return render_to_response(
+        'purchases/spending.html',
+        {'rows': rows,
+         'start': start,
+         'end': end,
+         'period': period,
+         'by_section': 'section' in by,
+         'by_shop': 'shop' in by,
+         'currency': currency,
+         'currencies': Currency.objects.order_by('code'),
+         'missing_rate': missing_rate})
+
+
+def _chosen_currency(request):
+
+    return Currency.objects.filter(
+        code=request.GET.get('currency', settings.BASE_CURRENCY)).first()
+
+
+def _plan_settlement(request, currency_id):
+
+    currency = get_object_or_404(Currency, id=currency_id)
+    positions = settlement.net_positions(currency)
+
+    transfers = settlement.plan(
+        positions, exact=request.GET.get('exact') == '1')
+
+    users = User.objects.in_bulk(positions.keys())
+
+    return currency, [(users[debtor], users[creditor], amount)
+                      for debtor, creditor, amount in transfers]
+
+
+@login_required
+def show_settlement(request, currency_id):
+
+    currency, transfers = _plan_settlement(request, currency_id)
+
+    return render_to_response(
+        'purchases/settlement.html',
+        {'currency': currency,
+         'transfers': transfers})
+
+
+@login_required
+def settlement_api(request, currency_id):
+
+    currency, transfers = _plan_settlement(request, currency_id)
+
+    return json_response(
+        request,
+        {'currency': currency.code,
+         'transfers': [{'from': debtor.username,
+                        'to': creditor.username,
+                        'amount': amount}
+                       for debtor, creditor, amount in transfers]})
+
+
+@login_required
+def shopping_lists(request):
+
+    if request.method == 'POST':
+
+        shopping_list = ShoppingList(
+            owner=request.user, name=request.POST['name'])
+
+        shopping_list.full_clean()
+        shopping_list.save()
+
+        return redirect(show_shopping_list, shopping_list.id)
+
+    ctx = csrf(request)
+    ctx['shopping_lists'] = ShoppingList.objects.filter(
+        owner=request.user).order_by('name')
+
+    return render_to_response(
+        'purchases/shopping_lists.html',
+        ctx)
+
+
+@login_required
+def show_shopping_list(request, list_id):
+
+    shopping_list = get_object_or_404(
+        ShoppingList, id=list_id, owner=request.user)
+
+    if request.method == 'POST':
+
+        item, created = ShoppingListItem.objects.get_or_create(
+            shopping_list=shopping_list,
+            product=Product.objects.get(id=request.POST['product_id']))
+
+        item.quantity = Decimal(
+            request.POST['quantity'].replace(',', '.'))
+        item.full_clean()
+        item.save()
+
+        return redirect(show_shopping_list, list_id)
+
+    ctx = csrf(request)
+    ctx.update({
+        'shopping_list': shopping_list,
+        'items': shopping_list.items.select_related('product'),
+        'totals': shopping_list.current_totals(),
+        'products': Product.objects.order_by('name')})
+
+    return render_to_response(
+        'purchases/show_shopping_list.html',
+        ctx)
+
+
+@login_required
+@require_POST
+@memoizing_balances
+def buy_shopping_list(request, list_id):
+
+    shopping_list = get_object_or_404(
+        ShoppingList, id=list_id, owner=request.user)
+
+    shop_id = request.POST.get('shop_id', '')
+
+    if not shop_id.isdigit():
+
+        raise Http404
+
+    shopping_list.buy(get_object_or_404(Shop, id=shop_id), request.user)
+
+    return redirect(list_purchases)
+
+
+@login_required
+def export(request, kind, format):
+
+    if kind not in exports.COLUMNS or format not in exports.FORMATS:
+
+        raise Http404
+
+    try:
+
+        start = parse_date(request.GET.get('from', ''))
+        end = parse_date(request.GET.get('to', ''))
+
+    except ValueError:
+
+        start = end = None
+
+    after = request.GET.get('after', '')
+
+    names, fields = zip(*exports.COLUMNS[kind])
+
+    rows = exports.rows(
+        exports.exported(kind, request.user, start, end),
+        fields,
+        int(after) if after.isdigit() else 0)
+
+    if format == 'csv':
+
+        response = StreamingHttpResponse(
+            exports.as_csv(names, rows), content_type='text/csv')
+
+    else:
+
+        response = StreamingHttpResponse(
+            exports.as_json(names, rows), content_type='application/json')
+
+    response['Content-Disposition'] = (
+        'attachment; filename="%s.%s"' % (kind, format))
+
+    return response
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import json
+import hashlib
+import datetime
+from decimal import Decimal
+from functools import wraps
+
+from django.http import HttpResponse, HttpResponseNotModified
+
+
+CENT = Decimal('0.01')
+
+# Most items a list endpoint returns at once.
+MAX_PAGE_SIZE = 1000
+
+
+def json_response(request, data, status=200):
+    """Renders data as JSON, with an ETag made from the rendered body.
+
+    A GET carrying the ETag in If-None-Match is answered with 304 and no
+    body. Items of data['results'] are cut down to the comma separated
+    names in the 'fields' parameter, if given.
+    """
+
+    fields = [field for field in request.GET.get('fields', '').split(',')
+              if field]
+
+    if fields and isinstance(data, dict) and 'results' in data:
+
+        data = dict(data, results=[
+            dict((field, item[field]) for field in fields if field in item)
+            for item in data['results']])
+
+    body = json.dumps(data, default=_encode, sort_keys=True)
+    etag = '"%s"' % hashlib.md5(body).hexdigest()
+
+    if request.method in ('GET', 'HEAD') and etag in [
+            tag.strip() for tag in
+            request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+
+        response = HttpResponseNotModified()
+
+    else:
+
+        response = HttpResponse(
+            body, content_type='application/json', status=status)
+
+    response['ETag'] = etag
+
+    return response
+
+
+def json_error(request, message, status=400):
+
+    return json_response(request, {'error': message}, status)
+
+
+def api_login_required(view):
+    """Like login_required, but answers 401 instead of redirecting."""
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+
+        if not request.user.is_authenticated():
+
+            return json_error(request, "Authentication required", 401)
+
+        return view(request, *args, **kwargs)
+
+    return wrapper
+
+
+def page_size(request, default=100):
+
+    size = request.GET.get('limit', '')
+
+    if not size.isdigit():
+
+        return default
+
+    return max(1, min(int(size), MAX_PAGE_SIZE))
+
+
+def parse_ids(text):
+    """Parses comma separated ids, raising ValueError on anything else."""
+
+    return [int(part) for part in text.split(',') if part.strip()]
+
+
+def _encode(value):
+
+    # Every amount has two decimal places, which SQLite does not keep.
+    if isinstance(value, Decimal):
+
+        return str(value.quantize(CENT))
+
+    if isinstance(value, (datetime.date, datetime.datetime)):
+
+        return value.isoformat()
+
+    raise TypeError("%r is not JSON serializable" % value)
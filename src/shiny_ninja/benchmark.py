@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+@contextmanager
+def scratch_database(verbosity=0):
+    """Runs the enclosed block against a freshly created test database.
+
+    Benchmarks fill the database with synthetic data, so they must never
+    touch the one the application uses.
+    """
+
+    old_name = connection.creation.create_test_db(
+        verbosity=verbosity, autoclobber=True)
+
+    try:
+
+        yield
+
+    finally:
+
+        connection.creation.destroy_test_db(old_name, verbosity)
+
+
+def timings(function, calls):
+
+    results = []
+    for args in calls:
+
+        start = time.time()
+        function(*args)
+        results.append(time.time() - start)
+
+    return sorted(results)
+
+
+def percentile(sorted_results, fraction):
+
+    if not sorted_results:
+
+        return None
+
+    index = int(round(fraction * (len(sorted_results) - 1)))
+
+    return sorted_results[index]
+
+
+def measure(function, calls):
+    """Times function over the calls, as a dict fit for JSON output.
+
+    Queries are counted during the timed calls themselves, since some
+    calls change the data. Logging them costs every query a little, alike
+    in every run.
+    """
+
+    with CaptureQueriesContext(connection) as queries:
+
+        results = timings(function, calls)
+
+    return {'calls': len(calls),
+            'median_ms': percentile(results, 0.5) * 1e3,
+            'p95_ms': percentile(results, 0.95) * 1e3,
+            'max_ms': results[-1] * 1e3 if results else None,
+            'queries': float(len(queries)) / max(len(calls), 1)}
+
+
+def regressions(results, baseline, tolerance):
+    """Lists what got slower or chattier than in the baseline results.
+
+    Both map names to dicts made by measure(). A median more than
+    `tolerance` times slower, or any more queries per call, is reported
+    as a line of text.
+    """
+
+    found = []
+    for name, result in sorted(results.items()):
+
+        old = baseline.get(name)
+
+        if old is None:
+
+            continue
+
+        if result['median_ms'] > old['median_ms'] * (1 + tolerance):
+
+            found.append("%s: median %.3f ms, was %.3f ms" % (
+                name, result['median_ms'], old['median_ms']))
+
+        if result['queries'] > old['queries']:
+
+            found.append("%s: %.1f queries per call, was %.1f" % (
+                name, result['queries'], old['queries']))
+
+    return found
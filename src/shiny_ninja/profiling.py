@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+import re
+import time
+import random
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import connection
+from django.template.base import Template
+
+from shiny_ninja.api import json_response, json_error, api_login_required
+from shiny_ninja.benchmark import percentile
+
+
+# Literals and lists of them are replaced when grouping statements, so the
+# same query run for different rows counts as a repeat.
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r"\(\?(?:, \?)*\)")
+
+# Statements reported per view as the most repeated ones.
+REPEATED_STATEMENTS = 5
+
+_local = threading.local()
+
+
+def normalize(sql):
+
+    return _LISTS.sub("(...)", _LITERALS.sub("?", sql))
+
+
+def _timed(render):
+
+    def timed_render(self, context):
+
+        depth = getattr(_local, 'depth', None)
+
+        # Requests which were not sampled only pay for the check above.
+        if depth is None:
+
+            return render(self, context)
+
+        _local.depth = depth + 1
+        start = time.time()
+
+        try:
+
+            return render(self, context)
+
+        finally:
+
+            _local.depth = depth
+
+            # Included and extended templates are part of the outermost one.
+            if depth == 0:
+
+                _local.template_seconds += time.time() - start
+
+    timed_render.untimed = render
+
+    return timed_render
+
+
+def _instrument_templates():
+
+    render = Template.__dict__['_render']
+
+    if not hasattr(render, 'untimed'):
+
+        Template._render = _timed(render)
+
+
+def summarize(queries):
+    """Returns the count, time and repeats of the queries Django logged.
+
+    Duplicates are statements run again with the very same parameters,
+    which could have been reused. Repeated statements are those run more
+    than once with any parameters, the usual sign of a query per row.
+    """
+
+    exact = {}
+    shapes = {}
+    seconds = 0.0
+    for query in queries:
+
+        seconds += float(query['time'])
+        exact[query['sql']] = exact.get(query['sql'], 0) + 1
+
+        shape = normalize(query['sql'])
+        shapes[shape] = shapes.get(shape, 0) + 1
+
+    return {'queries': len(queries),
+            'sql_seconds': seconds,
+            'duplicates': len(queries) - len(exact),
+            'repeated': dict((shape, count) for shape, count in shapes.items()
+                             if count > 1)}
+
+
+class QueryStats(object):
+    """Rolling statistics of the sampled requests of every view.
+
+    Only the last settings.QUERY_STATS_WINDOW samples of a view are kept,
+    in the memory of the process serving them.
+    """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.views = {}
+        self.sampled = 0
+
+    @property
+    def window(self):
+
+        return getattr(settings, 'QUERY_STATS_WINDOW', 100)
+
+    def record(self, view, sample):
+
+        with self.lock:
+
+            samples = self.views.get(view)
+
+            if samples is None or samples.maxlen != self.window:
+
+                samples = self.views[view] = deque(
+                    samples or (), maxlen=self.window)
+
+            samples.append(sample)
+            self.sampled += 1
+
+    def report(self):
+        """Returns a dict per view, those spending most time in SQL first."""
+
+        with self.lock:
+
+            views = [(view, list(samples))
+                     for view, samples in self.views.items()]
+
+        rows = []
+        for view, samples in views:
+
+            def mean(key):
+
+                return sum(sample[key] for sample in samples) / len(samples)
+
+            repeated = {}
+            for sample in samples:
+
+                for shape, count in sample['repeated'].items():
+
+                    repeated[shape] = repeated.get(shape, 0) + count
+
+            totals = sorted(sample['seconds'] for sample in samples)
+
+            rows.append({
+                'view': view,
+                'samples': len(samples),
+                'queries': mean('queries'),
+                'max_queries': max(sample['queries'] for sample in samples),
+                'duplicates': mean('duplicates'),
+                'sql_ms': mean('sql_seconds') * 1000,
+                'template_ms': mean('template_seconds') * 1000,
+                'total_ms': mean('seconds') * 1000,
+                'p95_ms': percentile(totals, 0.95) * 1000,
+                'repeated': [
+                    {'statement': shape, 'times': count}
+                    for shape, count in sorted(
+                        repeated.items(),
+                        key=lambda item: (-item[1], item[0]))[
+                            :REPEATED_STATEMENTS]]})
+
+        rows.sort(key=lambda row: (-row['sql_ms'], row['view']))
+
+        return rows
+
+    def clear(self):
+
+        with self.lock:
+
+            self.views.clear()
+            self.sampled = 0
+
+
+query_stats = QueryStats()
+
+
+class QueryStatsMiddleware(object):
+    """Measures the queries, SQL time and template time of some requests.
+
+    A settings.QUERY_STATS_SAMPLE_RATE fraction of requests is measured,
+    or with DEBUG on, any request sent with an X-Query-Stats header.
+    Measured responses carry the numbers in X-Query-* headers, and they
+    are added to the rolling statistics served by query_stats_view.
+    Other requests only cost a random number. Queries of streamed
+    responses run after the view returns and are not counted.
+    """
+
+    def __init__(self):
+
+        _instrument_templates()
+
+    def process_request(self, request):
+
+        rate = getattr(settings, 'QUERY_STATS_SAMPLE_RATE', 0)
+        forced = settings.DEBUG and 'HTTP_X_QUERY_STATS' in request.META
+
+        if not forced and (rate <= 0 or random.random() >= rate):
+
+            return None
+
+        request._query_stats = {
+            'start': time.time(),
+            'first_query': len(connection.queries),
+            'debug_cursor': connection.use_debug_cursor,
+            'view': None}
+
+        # Django only logs queries through its debug cursor.
+        connection.use_debug_cursor = True
+
+        _local.depth = 0
+        _local.template_seconds = 0.0
+
+    def process_view(self, request, view, args, kwargs):
+
+        state = getattr(request, '_query_stats', None)
+
+        if state is not None:
+
+            state['view'] = "%s.%s" % (view.__module__, view.__name__)
+
+    def process_response(self, request, response):
+
+        state = request.__dict__.pop('_query_stats', None)
+
+        if state is None:
+
+            return response
+
+        sample = summarize(connection.queries[state['first_query']:])
+        sample['seconds'] = time.time() - state['start']
+        sample['template_seconds'] = getattr(_local, 'template_seconds', 0.0)
+
+        connection.use_debug_cursor = state['debug_cursor']
+        _local.depth = None
+
+        response['X-Query-Count'] = str(sample['queries'])
+        response['X-Query-Duplicates'] = str(sample['duplicates'])
+        response['X-Query-Time'] = "%.1f" % (sample['sql_seconds'] * 1000)
+        response['X-Query-Template-Time'] = "%.1f" % (
+            sample['template_seconds'] * 1000)
+        response['X-Query-Total-Time'] = "%.1f" % (sample['seconds'] * 1000)
+
+        if state['view'] is not None:
+
+            query_stats.record(state['view'], sample)
+
+        return response
+
+
+@api_login_required
+def query_stats_view(request):
+
+    if not request.user.is_staff:
+
+        return json_error(request, "Only staff can see query stats", 403)
+
+    if request.method == 'POST':
+
+        query_stats.clear()
+
+    return json_response(request, {
+        'sample_rate': getattr(settings, 'QUERY_STATS_SAMPLE_RATE', 0),
+        'sampled': query_stats.sampled,
+        'results': query_stats.report()})
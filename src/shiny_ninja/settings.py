@@ -104,6 +104,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'shiny_ninja.profiling.QueryStatsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -138,6 +139,36 @@ INSTALLED_APPS = (
 
 SESSION_SERIALIZER = 'django.contrib.sessions.serializers.JSONSerializer'
 
+# Process-local cache of resolved prices, keyed by product, shop and
+# PRICE_CACHE_BUCKET seconds of time. Set PRICE_CACHE_SIZE to the maximum
+# number of entries to enable it. Writes invalidate it only in the process
+# making them, so with several workers an answer for "now" may lag behind
+# a price change by up to one bucket.
+PRICE_CACHE_SIZE = 0
+PRICE_CACHE_BUCKET = 60
+
+# Code of the currency prices and balances in several currencies are
+# compared and added up in when no other one is asked for. Amounts are
+# converted with the ExchangeRate history.
+BASE_CURRENCY = 'EUR'
+
+# Exchange rates are kept in memory by every process and reloaded once
+# they are this many seconds old, so rates saved elsewhere are picked up.
+EXCHANGE_RATE_CACHE_SECONDS = 300
+
+# Downsampling of old price history by the compact_prices command, as
+# (age in days, 'day', 'week' or 'month') steps. With ((30, 'day'),
+# (365, 'month')) only the last price of every day is kept once it is a
+# month old, and of every month once it is a year old. Prices which
+# purchases refer to are always kept.
+PRICE_HISTORY_RETENTION = ()
+
+# Fraction of requests QueryStatsMiddleware measures the queries and
+# timings of. Only the last QUERY_STATS_WINDOW samples of every view are
+# kept for the statistics page, separately in every process.
+QUERY_STATS_SAMPLE_RATE = 0.01
+QUERY_STATS_WINDOW = 100
+
 # A sample logging configuration. The only tangible logging
 # performed by this configuration is to send an email to
 # the site admins on every HTTP 500 error when DEBUG=False.
@@ -11,4 +11,5 @@ urlpatterns = patterns(
     url(r'^products/', include(products.urls)),
     url('^accounts/', include('django.contrib.auth.urls')),
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^stats/queries/$', 'shiny_ninja.profiling.query_stats_view'),
     url(r'^purchases/', include(purchases.urls)))